@@ -79,6 +79,12 @@ def main():
     # Connect to the original SQLite database with Reddit submissions
     conn = sqlite3.connect(path_submissions_db)
     subs = pd.read_sql_query(f"SELECT * FROM {submissions_table}", conn)
+    
+    # Only send one representative per near-duplicate cluster to the API
+    if 'dup_cluster_id' in subs.columns:
+        subs = subs[subs['dup_cluster_id'].isna() | 
+                    (subs['dup_cluster_id'] == subs['id'])]
+    
     c = conn.cursor()
     
     # Create a table in the submissions database to store GPT responses
@@ -0,0 +1,106 @@
+'''
+Helper functions for extracting ticker and company alias mentions from the
+body (selftext) of submissions. For use with submissions_to_db_tickers.py.
+
+Bodies can run to 10k+ words, so matching avoids per-ticker or per-alias regex
+scans entirely. The text is tokenized once, tickers are matched by set lookup,
+and aliases are matched by walking a token trie (prebuilt in the ticker
+universe artifact) from each token. The cost is linear in the length of the
+text, times the number of words in the longest alias.
+
+Author: Aaron M. Stahl (2024) // aaron.m.stahl@gmail.com // astahl3.github.io
+'''
+import re
+import ticker_universe as tu
+import title_processing_functions as tf
+
+# Tokens: optional $, a word (may contain &, ' and -), optional class suffix
+# (e.g., BRK.B); trailing sentence punctuation is not part of the token
+token_pattern = re.compile(r"\$?[A-Za-z0-9][A-Za-z0-9&'\-]*"
+                           r"(?:\.[A-Za-z](?![A-Za-z0-9]))?")
+
+# Key marking the end of an alias in the trie; maps to the alias ticker
+trie_end = ''
+
+def tokenize(text):
+    ''' Split text into the tokens used for body mention matching '''
+    return token_pattern.findall(text)
+
+def normalize_token(token):
+    ''' Lowercase a token and drop a possessive suffix (e.g., Apple's) '''
+    token = token.lower()
+    if token.endswith("'s"): token = token[:-2]
+    return token
+
+def build_alias_trie(alias_dict):
+    '''
+    Build a token trie from the alias -> ticker dict 'alias_dict'. Each node
+    is a dict of normalized token -> child node; a node that completes an alias
+    holds the alias ticker under the 'trie_end' key.
+    '''
+    trie = {}
+    for alias, ticker in alias_dict.items():
+        tokens = [normalize_token(t) for t in tokenize(alias)]
+        if not tokens: continue
+        node = trie
+        for token in tokens:
+            node = node.setdefault(token, {})
+        node[trie_end] = ticker
+    return trie
+
+def count_body_mentions(selftext_string, tickers=None):
+    '''
+    Count mentions of each ticker in the submission body. Returns a dict of
+    (ticker, match_type) -> number of mentions, with match types:
+    - ticker_with_symbol: $ ticker in the tickers set (e.g., $GME)
+    - ticker_no_symbol: bare ticker in the set, problem tickers excluded
+    - alias: company name or alias (longest alias wins, e.g., Bank of America)
+    '''
+    universe = tu.load_universe()
+    if tickers is None: tickers = universe['tickers']
+    tickers_no_sym = tf.get_matcher_table('tickers_no_sym', tickers)
+    alias_trie = universe['alias_trie']
+
+    tokens = tokenize(selftext_string)
+    lowered = [normalize_token(t) for t in tokens]
+
+    counts = {}
+    i = 0
+    n_tokens = len(tokens)
+    while i < n_tokens:
+        token = tokens[i]
+
+        # Tickers with a leading $ symbol e.g., $GME
+        if token[0] == '$':
+            if token[1:] in tickers:
+                key = (token[1:], 'ticker_with_symbol')
+                counts[key] = counts.get(key, 0) + 1
+            i += 1
+            continue
+
+        # Longest alias starting at this token e.g., Bank of America
+        node = alias_trie
+        alias_ticker = None
+        alias_end = i
+        j = i
+        while j < n_tokens:
+            node = node.get(lowered[j])
+            if node is None: break
+            j += 1
+            if trie_end in node:
+                alias_ticker = node[trie_end]
+                alias_end = j
+
+        if alias_ticker is not None:
+            key = (alias_ticker, 'alias')
+            counts[key] = counts.get(key, 0) + 1
+            i = alias_end
+            continue
+
+        # Tickers without a symbol e.g., GME
+        if token in tickers_no_sym:
+            key = (token, 'ticker_no_symbol')
+            counts[key] = counts.get(key, 0) + 1
+        i += 1
+
+    return counts
@@ -1,15 +1,19 @@
 '''
 Create a performance table for the reddit submission database which provides
-returns 
-
-
+returns of the matched security over 1, 2, 3, 6 and 12 months following each
+post, computed from the local CRSP returns database with returns_engine.py,
+along with the abnormal returns over the same horizons against a CRSP market
+index (market-adjusted, and beta-adjusted with the estimated beta)
 
+Author: Aaron M. Stahl (2024) // aaron.m.stahl@gmail.com // astahl3.github.io
 '''
-import wrds
-from datetime import datetime, timedelta
+from datetime import datetime
 import sqlite3
 import pandas as pd
-import crsp_performance_db as cpd
+import wrds_sql as ws
+import market_calendar as mc
+import returns_engine as rte
+import returns_store as rs
 
 ############################## GLOBAL PARAMETERS ##############################
 
@@ -28,14 +32,135 @@ performance_table = "crsp_performance"
 # WRDS username
 username = 'astahl3'
 
-# Latest available date ("lad") for CRSP stock data
+# Latest available date ("lad") for CRSP stock data; replaced by the latest
+# date of the local market index, which crsp_performance_db.py and
+# crsp_delta_sync.py extend through the new lad (see get_latest_available_date)
 lad = datetime(year=2024, month=3, day=28).date()
 lad_str = lad.strftime('%Y-%m-%d')
 
+# Performance rows per transaction
+insert_batch_size = 1000
+
+# Market index series of the abnormal returns (vwretd, ewretd or sprtrn), and
+# whether to estimate betas for beta-adjusted abnormal returns
+benchmark = 'vwretd'
+beta_adjusted = True
+
+# Columns computed by the returns engine: raw returns, market-adjusted
+# abnormal returns, the beta and beta-adjusted abnormal returns
+abnormal_columns = \
+    [rte.abnormal_column(name) for name in rte.default_horizons] + \
+    ['beta'] + \
+    [rte.abnormal_column(name, 'beta_abnormal')
+     for name in rte.default_horizons]
+perf_columns = list(rte.default_horizons) + abnormal_columns
+
+# Performance table schema: permno is INTEGER and added_day an integer day
+# number (market_calendar.day_number); the view crsp_performance_iso shows
+# added_day as the ISO date date_added. next_end_day is the day number of the
+# first horizon still after lad when the row was written, so the row is
+# pending again only once lad reaches it. Posts without a CRSP match are
+# written once with a NULL permno and NULL returns.
+performance_schema = f"""
+    CREATE TABLE IF NOT EXISTS {performance_table} (
+        post_id TEXT PRIMARY KEY,
+        ticker TEXT,
+        permno INTEGER,
+        return_1mo REAL,
+        return_2mo REAL,
+        return_3mo REAL,
+        return_6mo REAL,
+        return_12mo REAL,
+        added_day INTEGER,
+        abnormal_1mo REAL,
+        abnormal_2mo REAL,
+        abnormal_3mo REAL,
+        abnormal_6mo REAL,
+        abnormal_12mo REAL,
+        beta REAL,
+        beta_abnormal_1mo REAL,
+        beta_abnormal_2mo REAL,
+        beta_abnormal_3mo REAL,
+        beta_abnormal_6mo REAL,
+        beta_abnormal_12mo REAL,
+        benchmark TEXT,
+        next_end_day INTEGER)
+    """
+performance_day_columns = {'added_day': 'date_added'}
+
 ###############################################################################
 
+def mark_open_rows(cn):
+    '''
+    Mark rows written before next_end_day existed that have a NULL return as
+    pending from the day after they were added
+    '''
+    missing = ' OR '.join(f"{name} IS NULL" for name in rte.default_horizons)
+    cn.execute(f"""UPDATE {performance_table}
+                   SET next_end_day = added_day + 1
+                   WHERE permno IS NOT NULL AND ({missing})""")
+
+def add_abnormal_columns(cn):
+    '''
+    Add the abnormal return and next_end_day columns to a performance table
+    created before they existed, and recreate its ISO view to include them
+    '''
+    columns = [r[1] for r in
+               cn.execute(f"PRAGMA table_info({performance_table})")]
+    added = [(col, 'REAL') for col in abnormal_columns if col not in columns]
+    if 'benchmark' not in columns: added.append(('benchmark', 'TEXT'))
+    if 'next_end_day' not in columns: added.append(('next_end_day', 'INTEGER'))
+    if not added: return
+
+    with cn:
+        for col, col_type in added:
+            cn.execute(f"ALTER TABLE {performance_table} "
+                       f"ADD COLUMN {col} {col_type}")
+        if 'next_end_day' not in columns: mark_open_rows(cn)
+        ws.create_iso_view(cn, performance_table, performance_day_columns)
+
+def get_latest_available_date(cn):
+    '''
+    Return the latest date of the market index in the local returns database
+    on connection 'cn', or the hard-coded 'lad' if none is stored
+    '''
+    exists = cn.execute("SELECT 1 FROM sqlite_master WHERE name = ?",
+                        (rte.market_table,)).fetchone()
+    if exists is None: return lad
+    last = cn.execute(f"SELECT MAX(mkt_day) FROM {rte.market_table}")
+    last = last.fetchone()[0]
+    return mc.day_date(last) if last is not None else lad
+
+def next_end_days(market_dates):
+    '''
+    Return the day number of the first horizon ending after lad for each of
+    the market dates, or None if every horizon has ended
+    '''
+    ends = pd.DataFrame(rte.horizon_end_dates(market_dates))
+    open_ends = ends.where(ends > pd.Timestamp(lad)).min(axis=1)
+    return [mc.day_number(end) if pd.notna(end) else None
+            for end in open_ends]
+
+def load_pending_submissions(cn):
+    '''
+    Return the submissions whose performance is missing, was computed against
+    another benchmark, or has a horizon that has ended since (next_end_day on
+    or before lad), with one anti-join against the performance table instead
+    of a lookup per submission
+    '''
+    query = f"""
+            SELECT s.*
+            FROM {submissions_table} s
+            LEFT JOIN {performance_table} p
+            ON p.post_id = s.id
+            AND p.benchmark = ?
+            AND (p.next_end_day IS NULL OR p.next_end_day > ?)
+            WHERE p.post_id IS NULL
+            """
+    return pd.read_sql_query(query, cn, params=(benchmark, mc.day_number(lad)))
+
 def main():
-    global path_logfile_write
+    global path_logfile_write, lad, lad_str
 
     # Open logfile to print header information
     current_date = datetime.date(datetime.now()).strftime('%Y-%m-%d')
@@ -50,145 +175,175 @@ def main():
         lf.write(f"********** Table read name: {returns_table}\n")
         lf.write(f"********** Table write name: {performance_table}\n\n")
 
-    # Load in the submissions database and store as a dataframe
+    # Connect to the submissions database and the local returns database
     conn_subs = sqlite3.connect(path_submissions_db)
-    df = pd.read_sql_query(f"SELECT * FROM {submissions_table}", conn_subs)
-    
-    # Connect to the local returns database
     conn_crsp = sqlite3.connect(path_returns_db)
 
-    # Prepare to write new table in the submissions db
+    # Prepare to write new table in the submissions db, migrating a table
+    # with TEXT permnos and dates in place
     c = conn_subs.cursor()
-    c.execute(f"""
-              CREATE TABLE IF NOT EXISTS {performance_table} (
-                  post_id TEXT PRIMARY KEY,
-                  ticker TEXT,
-                  permno TEXT,
-                  return_1mo REAL,
-                  return_2mo REAL,
-                  return_3mo REAL,
-                  return_6mo REAL,
-                  return_12mo REAL,
-                  date_added DATE)
-              """)    
-    conn_subs.commit()
-
-    # Connect to WRDS for security metainfo as of post dates
-    db = wrds.Connection(wrds_username=username)
-
-    # Iterate over submissions dataframe to populate new table
-    count = 0
+    if ws.create_local_table(conn_subs, performance_table, performance_schema,
+                             performance_day_columns, ('permno',)):
+        print(f"Migrated {performance_table} to integer permnos and days")
+    add_abnormal_columns(conn_subs)
+
+    # Latest date of the local CRSP data
+    lad = get_latest_available_date(conn_crsp)
+    lad_str = lad.strftime('%Y-%m-%d')
+
+    # Load only the submissions still needing performance rows
+    df = load_pending_submissions(conn_subs)
+    c.execute(f"SELECT COUNT(*) FROM {submissions_table}")
+    n_submissions = c.fetchone()[0]
+    print(f"{len(df)} of {n_submissions} submissions need performance rows")
+    with open(path_logfile_write, 'a') as lf:
+        lf.write(f"Pending submissions: {len(df)} of {n_submissions} "
+                 f"(others up to date through {lad})\n\n")
+    if df.empty:
+        conn_subs.close()
+        conn_crsp.close()
+        return
+
+    # Map each post to its nearest market date, then resolve CRSP security
+    # info in bulk for the distinct (ticker, market date) pairs of posts
+    # without a permno from point-in-time matching; WRDS is only connected
+    # to if there are such posts
+    df['market_date_dt'] = mc.nearest_sessions(df['created_utc'], unit='s')
+    df['market_date'] = df['market_date_dt'].dt.strftime('%Y-%m-%d')
+    unresolved = df[df['permno'].isna()] if 'permno' in df else df
+    if unresolved.empty:
+        names = pd.DataFrame(columns=['ticker', 'market_date'] +
+                             ws.crsp_name_fields)
+    else:
+        db = ws.connect_wrds()
+        try:
+            names = ws.resolve_crsp_names(
+                db, unresolved.rename(columns={'company_match': 'ticker'}))
+        finally:
+            db.close()
+    name_groups = ws.group_crsp_names(names)
+    no_names = names.iloc[0:0]
+
+    # Iterate over submissions dataframe to collect the permno of each post;
+    # posts without a CRSP match are recorded once with NULL returns
+    posts = []
+    unmatched = []
     for index, row in df.iterrows():
         '''
-        Obtain the appropriate permno given the post date, then get the
-        performance history from the local CRSP returns database and populate
-        the performance table.
+        Obtain the appropriate permno given the post date; returns for all
+        posts are computed together after the loop.
         '''
         
         ticker = row['company_match']
         post_id = row['id']
-        post_date = datetime.utcfromtimestamp(row['created_utc'])
-        post_date_str = post_date.strftime('%Y-%m-%d')
-        market_date_dt = cpd.get_nearest_market_date(post_date)
-        market_date = market_date_dt.strftime('%Y-%m-%d')
-        
-        # CRSP query for security metainfo as of post date
-        sql_query = f"""
-                    SELECT * 
-                    FROM crsp_q_stock.stocknames_v2
-                    WHERE ticker = '{ticker}'
-                    AND namedt <= '{market_date}'
-                    AND nameenddt >= '{market_date}'
-                    """
-        stockinfo_crsp = db.raw_sql(sql_query)
+        market_date = row['market_date']
         
-        # Skip to next entry if query result is empty; no result implies the
-        # ticker is probably invalid or not traded on a conventional exchange
-        if stockinfo_crsp.empty:
-            print(f"stockinfo_crsp is empty for: {ticker}")
-            with open(path_logfile_write, 'a') as lf:
-                lf.write("No ticker match in CRSP:\n")
-                lf.write(f"Ticker = {ticker}\n")
-                lf.write(f"Post Date = {market_date}\n")
-                lf.write(f"Submission ID = {row['id']}\n\n")
-            continue
-
-        # TODO: Logic for if the ticker query contains more than one row
-        # For now, just select the last row of the query result, as each row 
-        # likely contains the same permno given the query's date restriction
-        if stockinfo_crsp.shape[0] > 1:
-            print(f"stockinfo_crsp has more than one entry for: {ticker}")
-            with open(path_logfile_write, 'a') as lf:
-                lf.write("More than one ticker match in CRSP:\n")
-                lf.write(f"Ticker = {ticker}\n")
-                lf.write(f"Post Date = {market_date}\n")
-                lf.write(f"Submission ID = {row['id']}\n\n")
-            #stockinfo_crsp = stockinfo_crsp.tail(1).reset_index(drop=True)
-            stockinfo_crsp = stockinfo_crsp.tail(1)
-
-        permno_temp = str(stockinfo_crsp['permno'].iloc[0])
+        # Use the permno from point-in-time matching if the submission has one,
+        # otherwise query CRSP for security metainfo as of post date
+        if 'permno' in row and pd.notna(row['permno']):
+            permno_temp = str(int(row['permno']))
+        else:
+            # CRSP security metainfo as of post date (resolved in bulk)
+            stockinfo_crsp = name_groups.get((ticker, market_date), no_names)
         
-        # If permno already up-to-date in table, skip to next submission
-        local_query = f"""
-                        SELECT date_added
-                        FROM {performance_table}
-                        WHERE post_id = '{post_id}'
-                        """
-        c.execute(local_query)
-        result = c.fetchone()
-        
-        # Logic sequence for if permno is already populated in performance db
-        if result is not None:
-            print(f"Performance for post_id = {post_id} already exists")
-            lad_temp = datetime.strptime(result[0], '%Y-%m-%d').date()
-            with open(path_logfile_write, 'a') as lf:
-                lf.write(f"Perf for post_id = {post_id} already exists\n")
-                lf.write(f"Last updated on {lad_temp}\n\n")
-            
-                # If the last time security info was updated was after the 
-                # current desired end date range, then don't update security
-                if lad_temp >= lad:
-                    continue
-                
-        # Calculate returns starting from the post date for desired ranges
-        date_offsets = [30, 60, 90, 182, 365]
-        dates_dt = [market_date_dt + timedelta(dt) for dt in date_offsets]
-        mdates_dt = [cpd.get_nearest_market_date(d) for d in dates_dt]
-        mdates_str = [d.strftime('%Y-%m-%d') for d in mdates_dt]
-
-        ret_dict = {}
-        for i, end_date in enumerate(mdates_str):
-            perf_query = f"""
-                        SELECT ret
-                        FROM {returns_table}
-                        WHERE permno = '{permno_temp}'
-                        AND mkt_date > '{market_date}'
-                        AND mkt_date <= '{end_date}'
-                        """
-            df_temp = pd.read_sql_query(perf_query, conn_crsp)
-            
-            # Calculate total return over the current period
-            totret = 1
-            for _, row_temp in df_temp.iterrows():
-                ret = row_temp['ret'] if row_temp['ret'] is not None else 0.0
-                totret *= (1 + ret)
-                
-            ret_dict[date_offsets[i]] = totret - 1
-
-        # Insert calculated returns into the performance table
-        c.execute(f"""
-            INSERT OR REPLACE INTO {performance_table} 
-            (post_id, ticker, permno, return_1mo, return_2mo, 
-             return_3mo, return_6mo, return_12mo, date_added)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-            """, 
-            (post_id, ticker, permno_temp, ret_dict.get(30), ret_dict.get(60), 
-             ret_dict.get(90), ret_dict.get(182), ret_dict.get(365), lad_str))
-    
-        print(f"Populated database for post_id = {post_id}")
-        conn_subs.commit()
-        count += 1
-        if count % 10 == 0: print(f"Submission returns entered: {count}")
+            # Skip to next entry if query result is empty; no result implies
+            # the ticker is probably invalid or not traded on an exchange
+            if stockinfo_crsp.empty:
+                print(f"stockinfo_crsp is empty for: {ticker}")
+                with open(path_logfile_write, 'a') as lf:
+                    lf.write("No ticker match in CRSP:\n")
+                    lf.write(f"Ticker = {ticker}\n")
+                    lf.write(f"Post Date = {market_date}\n")
+                    lf.write(f"Submission ID = {row['id']}\n\n")
+                unmatched.append((post_id, ticker, benchmark,
+                                  mc.day_number(lad)))
+                continue
+
+            # TODO: Logic for if the ticker query contains more than one row
+            # For now, just select the last row of the query result, as each
+            # row likely contains the same permno given the date restriction
+            if stockinfo_crsp.shape[0] > 1:
+                print(f"stockinfo_crsp has more than one entry for: {ticker}")
+                with open(path_logfile_write, 'a') as lf:
+                    lf.write("More than one ticker match in CRSP:\n")
+                    lf.write(f"Ticker = {ticker}\n")
+                    lf.write(f"Post Date = {market_date}\n")
+                    lf.write(f"Submission ID = {row['id']}\n\n")
+                #stockinfo_crsp = stockinfo_crsp.tail(1).reset_index(drop=True)
+                stockinfo_crsp = stockinfo_crsp.tail(1)
+
+            permno_temp = str(stockinfo_crsp['permno'].iloc[0])
+
+        posts.append((post_id, ticker, permno_temp, market_date))
+
+    with conn_subs:
+        c.executemany(f"""
+            INSERT OR REPLACE INTO {performance_table}
+            (post_id, ticker, benchmark, added_day)
+            VALUES (?, ?, ?, ?)
+            """, unmatched)
+    if not posts:
+        print(f"No CRSP match for {len(unmatched)} submissions")
+        conn_subs.close()
+        conn_crsp.close()
+        return
+
+    # Compute every post's returns and abnormal returns over all horizons
+    # from the memory-mapped returns store if built, otherwise from the local
+    # returns table, loading each permno's daily returns, fetched date ranges
+    # and the market index once; windows across a gap in the fetched ranges
+    # are left empty
+    posts = pd.DataFrame(posts, columns=['post_id', 'ticker', 'permno',
+                                         'market_date'])
+    permnos = posts['permno'].unique()
+    if rs.store_exists():
+        return_index = rte.build_return_index_from_store(rs.load_store(),
+                                                         permnos)
+    else:
+        returns = rte.load_returns(conn_crsp, permnos)
+        return_index = rte.build_return_index(returns)
+    coverage = rte.load_coverage(conn_crsp, permnos)
+    market_index = rte.load_market_index(conn_crsp)
+    perf = rte.abnormal_returns(return_index, market_index, posts['permno'],
+                                posts['market_date'], benchmark=benchmark,
+                                beta_adjusted=beta_adjusted,
+                                coverage=coverage)
+    perf = perf.reindex(columns=perf_columns)
+    perf = perf.astype(object).where(perf.notna(), None)
+
+    # Without the benchmark series the abnormal returns are NULL; leave the
+    # benchmark NULL as well so the rows stay pending until it is fetched
+    # (see crsp_performance_db.fetch_market_index)
+    benchmark_used = benchmark if benchmark in market_index else None
+    if benchmark_used is None:
+        print(f"No {benchmark} market index in {path_returns_db}; "
+              "abnormal returns left empty")
+        with open(path_logfile_write, 'a') as lf:
+            lf.write(f"No {benchmark} market index; abnormal returns left "
+                     "empty\n\n")
+
+    # Insert calculated returns into the performance table, one transaction
+    # per batch of rows
+    rows = [(post_id, ticker, int(permno), *horizon_returns, benchmark_used,
+             mc.day_number(lad), next_end_day)
+            for (post_id, ticker, permno, _), horizon_returns, next_end_day
+            in zip(posts.itertuples(index=False),
+                   perf.itertuples(index=False),
+                   next_end_days(posts['market_date']))]
+    columns = ['post_id', 'ticker', 'permno'] + perf_columns + \
+              ['benchmark', 'added_day', 'next_end_day']
+    for i in range(0, len(rows), insert_batch_size):
+        with conn_subs:
+            c.executemany(f"""
+                INSERT OR REPLACE INTO {performance_table}
+                ({', '.join(columns)})
+                VALUES ({', '.join('?' * len(columns))})
+                """, rows[i:i + insert_batch_size])
+
+    print(f"Submission returns entered: {len(rows)}")
+    with open(path_logfile_write, 'a') as lf:
+        lf.write("********** Program complete \n")
+        lf.write(f"********** Returns populated for {len(rows)} posts \n\n")
 
     conn_subs.close()
     conn_crsp.close()
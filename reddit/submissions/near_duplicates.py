@@ -0,0 +1,150 @@
+'''
+Streaming near-duplicate and cross-post detection for reddit submissions using
+MinHash signatures and locality-sensitive hashing (LSH).
+
+The same write-up is often posted to several subreddits (e.g., r/stocks,
+r/investing, r/wallstreetbets) or reposted with small edits. Each post's
+selftext is reduced to a set of word shingles, summarized by a MinHash
+signature, and split into bands for the LSH index. Posts sharing any band are
+candidates; candidates whose estimated Jaccard similarity clears the
+threshold join the same cluster. The cluster id is the id of the first post
+seen in the cluster, so downstream stages can keep one representative per
+cluster by selecting rows where dup_cluster_id = id.
+
+Signatures are persisted in the submissions database, so posts ingested from
+different subreddit files in separate runs are still matched to each other.
+
+With 16 bands of 8 rows, the probability that two posts become candidates,
+1 - (1 - s^8)^16 at Jaccard similarity s, is about 61% at 0.7 (50% at about
+0.67) and above 99% at 0.85.
+
+Author: Aaron M. Stahl (2024) // aaron.m.stahl@gmail.com // astahl3.github.io
+'''
+import re
+import sqlite3
+import zlib
+import numpy as np
+
+# MinHash and LSH parameters
+num_perm = 128 # hash permutations per signature
+n_bands = 16 # LSH bands; rows per band = num_perm / n_bands
+shingle_size = 5 # words per shingle
+jaccard_threshold = 0.7 # minimum estimated similarity for a duplicate
+seed = 1
+
+# Table for persisted signatures in the submissions database
+minhash_table = 'submission_minhash'
+
+# Universal hash family h(x) = ((a*x + b) mod p) mod 2^32; a, b < 2^32 keep
+# a*x + b within uint64 for 32-bit shingle hashes
+mersenne_prime = np.uint64((1 << 61) - 1)
+max_hash = np.uint64((1 << 32) - 1)
+_rng = np.random.RandomState(seed)
+perm_a = _rng.randint(1, 1 << 32, size=num_perm, dtype=np.uint64)
+perm_b = _rng.randint(0, 1 << 32, size=num_perm, dtype=np.uint64)
+rows_per_band = num_perm // n_bands
+
+word_pattern = re.compile(r'\w+')
+
+def get_shingles(text):
+    '''
+    Return the set of 32-bit hashes of the word shingles of 'text', after
+    lowercasing and dropping punctuation and whitespace differences
+    '''
+    words = word_pattern.findall(text.lower())
+    if len(words) < shingle_size:
+        return {zlib.crc32(' '.join(words).encode('utf-8'))}
+    return {zlib.crc32(' '.join(words[i:i + shingle_size]).encode('utf-8'))
+            for i in range(len(words) - shingle_size + 1)}
+
+def minhash_signature(text):
+    ''' Return the MinHash signature of 'text' as a uint32 array '''
+    hv = np.fromiter(get_shingles(text), dtype=np.uint64)
+    phv = (np.outer(perm_a, hv) + perm_b[:, None]) % mersenne_prime & max_hash
+    return phv.min(axis=1).astype(np.uint32)
+
+def band_keys(signature):
+    ''' Return the LSH bucket key of each band of the signature '''
+    return [signature[i * rows_per_band:(i + 1) * rows_per_band].tobytes()
+            for i in range(n_bands)]
+
+def new_lsh_index():
+    '''
+    Return an empty LSH index: one bucket dict per band (band key -> post ids),
+    the signature and cluster id of each post, and signatures not yet saved
+    '''
+    return {'buckets': [{} for _ in range(n_bands)],
+            'signatures': {},
+            'clusters': {},
+            'pending': []}
+
+def add_to_index(index, post_id, signature, cluster_id):
+    ''' Add a post with a known signature and cluster id to the LSH index '''
+    for buckets, key in zip(index['buckets'], band_keys(signature)):
+        buckets.setdefault(key, []).append(post_id)
+    index['signatures'][post_id] = signature
+    index['clusters'][post_id] = cluster_id
+
+def insert_post(index, post_id, text):
+    '''
+    Compute the post's signature, find its near-duplicate cluster in the LSH
+    index (or start a new one), add it to the index, and return the cluster id
+    '''
+    if post_id in index['clusters']: return index['clusters'][post_id]
+
+    signature = minhash_signature(text)
+
+    # Collect candidates that share at least one band with the post
+    candidates = set()
+    for buckets, key in zip(index['buckets'], band_keys(signature)):
+        candidates.update(buckets.get(key, ()))
+
+    # Join the cluster of the most similar candidate above the threshold
+    cluster_id = post_id
+    best_similarity = jaccard_threshold
+    for candidate in candidates:
+        similarity = np.mean(index['signatures'][candidate] == signature)
+        if similarity >= best_similarity:
+            best_similarity = similarity
+            cluster_id = index['clusters'][candidate]
+
+    add_to_index(index, post_id, signature, cluster_id)
+    index['pending'].append((post_id, cluster_id, signature.tobytes()))
+    return cluster_id
+
+def load_lsh_index(path_db):
+    ''' Load the LSH index from the signatures saved in the database '''
+    index = new_lsh_index()
+
+    conn = sqlite3.connect(path_db)
+    c = conn.cursor()
+    c.execute("SELECT name FROM sqlite_master WHERE type='table' AND name=?",
+              (minhash_table,))
+    if c.fetchone() is not None:
+        c.execute(f"SELECT id, dup_cluster_id, signature FROM {minhash_table}")
+        for post_id, cluster_id, blob in c.fetchall():
+            signature = np.frombuffer(blob, dtype=np.uint32)
+            if signature.shape[0] != num_perm: continue
+            add_to_index(index, post_id, signature, cluster_id)
+    conn.close()
+
+    return index
+
+def save_signatures(c, rows):
+    '''
+    Save signature rows (id, dup_cluster_id, signature bytes) to the database
+    via cursor 'c'
+    '''
+    c.execute(f'''CREATE TABLE IF NOT EXISTS {minhash_table} (
+                id TEXT PRIMARY KEY,
+                dup_cluster_id TEXT,
+                signature BLOB
+                )''')
+    c.executemany(f'''INSERT OR REPLACE INTO {minhash_table}
+                  (id, dup_cluster_id, signature) VALUES (?, ?, ?)''', rows)
+
+def pop_pending(index):
+    ''' Return and clear the signature rows not yet saved to the database '''
+    rows = index['pending']
+    index['pending'] = []
+    return rows
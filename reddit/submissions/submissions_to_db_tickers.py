@@ -9,10 +9,12 @@ Author: Aaron M. Stahl (2024) // aaron.m.stahl@gmail.com // astahl3.github.io
 import json
 import sqlite3
 import pathlib
-import pandas as pd
-import re
 from datetime import datetime
 import title_processing_functions as tf
+import ticker_universe as tu
+import ticker_history as th
+import body_processing_functions as bf
+import near_duplicates as nd
 #import pdb # for debugging only
 
 # Global parameters
@@ -23,11 +25,19 @@ counts_ticker_match_nosymbol = 0 # ticker match without $ symbol
 counts_alias_match = 0 # company alias matches
 counts_dd_nomatch = 0 # tagged due diligence but no ticker or alias match
 counts_dd = 0 # total submissions tagged as due diligence 
+counts_not_listed = 0 # ticker matches not listed in CRSP on the post date
+counts_multiple_tickers = 0 # titles mentioning more than one ticker
+counts_body_only = 0 # qualified on body (selftext) mentions alone
+counts_near_duplicates = 0 # near-duplicates / cross-posts of earlier posts
 ticker_matches = {} # dictionary for ticker matches
 alias_matches = {} # dictionary for alias matches
 min_L = 60 # minimum number of words required for the post
 single_match = True
-alias_dict = {}
+point_in_time = True # only accept tickers listed on the post date (CRSP)
+extract_all_mentions = False # keep all title mentions, not only single matches
+extract_body_mentions = True # count ticker mentions in the selftext
+body_mentions_qualify = False # qualify posts on body mentions alone
+detect_duplicates = True # cluster near-duplicate selftext (MinHash LSH)
 
 # Subreddit submissions path: /Users/astahl/fin_nlp_data/reddit/...
 # r/stocks: stocks_submissions.txt
@@ -36,17 +46,157 @@ alias_dict = {}
 
 subreddit_domain = 'self.investing' # must match file path(s) below
 table_name = 'single_ticker_match'
+multiple_table_name = 'multiple_ticker_match'
+mentions_table = 'submission_mentions'
+body_mentions_table = 'submission_body_mentions'
+single_match_view = 'single_mention_submissions'
+representatives_view = 'cluster_representatives'
 
 # File paths
 path_reddit_db_read = \
     "/Users/astahl/fin_nlp_data/reddit/investing_submissions.txt"
 path_reddit_db_write = \
     "/Users/astahl/fin_nlp_data/reddit/sqlite/submissions.db"
-path_stocks_db_read = \
-    "/Users/astahl/fin_nlp_data/ticker_lists/us_companies_5000.csv"
 path_logfile_write = \
     "/Users/astahl/fin_nlp_data/reddit/logfiles/logfile"
     
+def check_ticker_history():
+    '''
+    Load the point-in-time ticker history if point-in-time matching is
+    enabled; without the stocknames_v2 extract, fall back to matching against
+    the ticker lists alone and log a warning
+    '''
+    global point_in_time
+    if not point_in_time: return
+    
+    try:
+        th.load_ticker_history()
+    except FileNotFoundError as e:
+        point_in_time = False
+        print(f"WARNING: {e}; point-in-time matching disabled")
+        with open(path_logfile_write, 'a') as lf:
+            lf.write(f"WARNING: {e}; point-in-time matching disabled\n")
+
+def assign_permno(submission):
+    '''
+    Set the permno of the matched ticker as of the post date using the
+    point-in-time ticker history. Returns False if the ticker was not listed
+    on the post date (always True if point-in-time matching is disabled).
+    '''
+    if not point_in_time: return True
+    
+    permno = th.lookup_permno(submission['company_match'],
+                              submission['created_utc'])
+    if permno is None: return False
+    
+    submission['permno'] = permno
+    return True
+
+def process_mentions(submission, fields, tickers=None):
+    '''
+    Extract every ticker and alias mention in the title in a single scan and
+    store them on the submission under 'mentions' as rows of (id, ticker,
+    match_type, position, permno). The company_match field holds the ticker
+    if exactly one distinct ticker is mentioned, else 'multiple_matches'
+    (such submissions are written to the multiple-match table, not the
+    single-match table read by the performance scripts).
+    '''
+    global counts_not_listed
+    global counts_multiple_tickers
+    global counts_ticker_match_symbol
+    global counts_ticker_nomatch_symbol
+    global counts_ticker_match_nosymbol
+    global counts_alias_match
+    
+    title_string = submission.get('title')
+    mentions = tf.extract_title_mentions(title_string, tickers)
+    
+    # Drop mentions of tickers that were not listed on the post date
+    rows = []
+    for ticker, match_type, position in mentions:
+        permno = None
+        if point_in_time:
+            permno = th.lookup_permno(ticker, submission['created_utc'])
+            if permno is None:
+                counts_not_listed += 1
+                continue
+        rows.append((submission['id'], ticker, match_type, position, permno))
+        
+    if not rows: return None
+    
+    distinct_tickers = {r[1] for r in rows}
+    if len(distinct_tickers) == 1:
+        submission['company_match'] = rows[0][1]
+        submission['match_type'] = rows[0][2]
+        submission['permno'] = rows[0][4]
+        
+        # Tally the match type of the first mention, as in single-match mode
+        match_type = rows[0][2]
+        if match_type == 'ticker_with_symbol':
+            counts_ticker_match_symbol += 1
+        elif match_type == 'symbol_no_match':
+            counts_ticker_nomatch_symbol += 1
+        elif match_type == 'alias':
+            counts_alias_match += 1
+        else:
+            counts_ticker_match_nosymbol += 1
+    else:
+        counts_multiple_tickers += 1
+        submission['company_match'] = 'multiple_matches'
+        submission['match_type'] = 'multiple'
+        
+    for tmatch in distinct_tickers:
+        ticker_matches[tmatch] = ticker_matches.get(tmatch,0)+1
+        
+    # Check if this is a due diligence post
+    submission['is_DD'] = tf.check_if_DD(title_string)
+    submission['mentions'] = rows
+    
+    return tuple(submission.get(field) for field in fields)
+
+def process_body_mentions(submission, tickers=None):
+    '''
+    Count ticker mentions in the selftext and store them on the submission
+    under 'body_mentions' as rows of (id, ticker, match_type, n_mentions)
+    '''
+    counts = bf.count_body_mentions(submission.get('selftext'), tickers)
+    
+    # Drop tickers that were not listed on the post date
+    if point_in_time:
+        listed = {ticker for ticker, _ in counts
+                  if th.lookup_permno(ticker, submission['created_utc'])}
+        counts = {k: n for k, n in counts.items() if k[0] in listed}
+        
+    submission['body_mentions'] = [(submission['id'], ticker, match_type, n)
+                                   for (ticker, match_type), n 
+                                   in counts.items()]
+
+def qualify_on_body(submission, fields):
+    '''
+    Qualify a submission without a title match on its body mentions alone,
+    using the most-mentioned ticker as the company match
+    '''
+    global counts_body_only
+    
+    if not body_mentions_qualify or not submission.get('body_mentions'):
+        return None
+    
+    ticker_totals = {}
+    for _, ticker, _, n in submission['body_mentions']:
+        ticker_totals[ticker] = ticker_totals.get(ticker, 0) + n
+    tmatch = max(ticker_totals, key=ticker_totals.get)
+    
+    counts_body_only += 1
+    submission['company_match'] = tmatch
+    submission['match_type'] = 'body'
+    submission['is_DD'] = tf.check_if_DD(submission.get('title'))
+    if point_in_time:
+        submission['permno'] = th.lookup_permno(tmatch, 
+                                                submission['created_utc'])
+    ticker_matches[tmatch] = ticker_matches.get(tmatch,0)+1
+    
+    return tuple(submission.get(field) for field in fields)
+
 def process_submission(submission, fields, tickers=None, aliases=None):
     '''
     (1) Process submissions and title text by performing the following:
@@ -61,11 +211,21 @@ def process_submission(submission, fields, tickers=None, aliases=None):
     [(2a) or (2b)] and (2c) required to qualify 
     
     (3) If qualified, check title for due diligence tag and update is_DD field
+    
+    (4) If point-in-time matching is enabled, require the matched ticker to be
+        listed on the post date and record its permno
+    
+    If 'extract_all_mentions' is set, every mention in the title is kept (see
+    process_mentions) instead of discarding titles with multiple matches
+    
+    If 'extract_body_mentions' is set, per-ticker mention counts in the
+    selftext are recorded as well (see process_body_mentions)
     '''
     global counts_ticker_match_symbol
     global counts_ticker_nomatch_symbol
     global counts_ticker_match_nosymbol
     global counts_dd_nomatch
+    global counts_not_listed
     
     if (submission.get('domain') == subreddit_domain and 
        submission.get('selftext') != '[removed]' and
@@ -77,6 +237,16 @@ def process_submission(submission, fields, tickers=None, aliases=None):
         # Confirm that post satisfies minimum length requirement
         if len(selftext_string.split()) > min_L:
             
+            ''' Ticker mentions in the body (selftext) '''
+            if extract_body_mentions:
+                process_body_mentions(submission, tickers)
+
+            ''' All match types in a single scan of the title '''
+            if extract_all_mentions:
+                submission_row = process_mentions(submission, fields, tickers)
+                if submission_row is None:
+                    submission_row = qualify_on_body(submission, fields)
+                return submission_row
 
             ''' Match type #1: ticker match with symbol e.g., $GME '''
             submission_qual = \
@@ -85,6 +255,9 @@ def process_submission(submission, fields, tickers=None, aliases=None):
             if submission_qual:
                 if submission_qual == 'multiple_matches':
                     return None
+                if not assign_permno(submission_qual):
+                    counts_not_listed += 1
+                    return None
                 
                 counts_ticker_match_symbol += 1
                 tmatch = submission['company_match']
@@ -98,6 +271,9 @@ def process_submission(submission, fields, tickers=None, aliases=None):
             if submission_qual:
                 if submission_qual == 'multiple_matches':
                     return None
+                if not assign_permno(submission_qual):
+                    counts_not_listed += 1
+                    return None
                 
                 counts_ticker_nomatch_symbol += 1
                 tmatch = submission['company_match']
@@ -128,10 +304,17 @@ def process_submissions_file(submissions_file, fields, batch_size=2000,
     - None: function only processes submissions and outputs to a SQlite db
 
     '''
+    global counts_near_duplicates
+    
+    # Load MinHash signatures of previously ingested posts (any subreddit)
+    if detect_duplicates: lsh_index = nd.load_lsh_index(path_reddit_db_write)
     
     # Process the submissions file in batches and extract desired fields
     with open(submissions_file, "r", encoding="utf-8") as file:
         batch = []
+        multiple_batch = []
+        mention_batch = []
+        body_batch = []
         batch_count = 0
         for line in file:
             submission_data = json.loads(line.strip())
@@ -142,21 +325,50 @@ def process_submissions_file(submissions_file, fields, batch_size=2000,
             processed_submission = process_submission(submission, fields, 
                                                       tickers, aliases)
             if processed_submission:
-                batch.append(processed_submission)
-                if len(batch) >= batch_size:
+                
+                # Assign the post to a near-duplicate cluster
+                if detect_duplicates:
+                    cluster_id = nd.insert_post(lsh_index, submission['id'],
+                                                submission['selftext'])
+                    if cluster_id != submission['id']:
+                        counts_near_duplicates += 1
+                    submission['dup_cluster_id'] = cluster_id
+                    processed_submission = tuple(submission.get(field) 
+                                                 for field in fields)
+                    
+                # Multi-ticker titles go to their own table
+                if submission.get('company_match') == 'multiple_matches':
+                    multiple_batch.append(processed_submission)
+                else:
+                    batch.append(processed_submission)
+                mention_batch.extend(submission.get('mentions', []))
+                body_batch.extend(submission.get('body_mentions', []))
+                if len(batch) + len(multiple_batch) >= batch_size:
                     processed_batch = process_batch(batch)
-                    write_submissions_to_database(processed_batch)
+                    signatures = nd.pop_pending(lsh_index) \
+                                 if detect_duplicates else None
+                    write_submissions_to_database(processed_batch, fields,
+                                                  mention_batch, body_batch,
+                                                  signatures, multiple_batch)
                     batch = []
+                    multiple_batch = []
+                    mention_batch = []
+                    body_batch = []
                     batch_count += 1
                     print(f"Wrote {batch_count*batch_size} entries to db")
                     with open(path_logfile_write, 'a') as lf:
                         lf.write(f"Wrote {batch_count*batch_size} entries\n")
                         
         # Process the remaining submissions in the last batch
-        if batch:
+        if batch or multiple_batch:
             processed_batch = process_batch(batch)
-            write_submissions_to_database(processed_batch)
-            total_processed = batch_count * batch_size + len(batch)
+            signatures = nd.pop_pending(lsh_index) \
+                         if detect_duplicates else None
+            write_submissions_to_database(processed_batch, fields,
+                                          mention_batch, body_batch,
+                                          signatures, multiple_batch)
+            total_processed = batch_count * batch_size + len(batch) + \
+                              len(multiple_batch)
             print(f"Wrote {total_processed} entries to db")
             with open(path_logfile_write, 'a') as lf:
                 lf.write(f"Wrote {total_processed} entries\n")
@@ -172,15 +384,20 @@ def process_batch(batch):
             processed_batch.append(submission)
     return processed_batch
 
-def write_submissions_to_database(submissions):
-    ''' Write passed submissions list to SQLite database '''
-    
-    # Connect to SQLite database
-    conn = sqlite3.connect(path_reddit_db_write)
-    c = conn.cursor()
+def add_missing_columns(c, table, columns):
+    '''
+    Add any of the passed 'columns' (dict of name -> SQL type) that are missing
+    from an existing 'table'
+    '''
+    c.execute(f"PRAGMA table_info({table})")
+    existing = {row[1] for row in c.fetchall()}
+    for name, col_type in columns.items():
+        if name not in existing:
+            c.execute(f"ALTER TABLE {table} ADD COLUMN {name} {col_type}")
 
-    # Create submissions table if it doesn't already exist
-    c.execute(f'''CREATE TABLE IF NOT EXISTS {table_name} (
+def create_submissions_table(c, table):
+    ''' Create a submissions 'table' if it doesn't already exist '''
+    c.execute(f'''CREATE TABLE IF NOT EXISTS {table} (
                 author TEXT,
                 author_created_utc INTEGER,
                 author_fullname TEXT,
@@ -206,21 +423,126 @@ def write_submissions_to_database(submissions):
                 upvote_ratio REAL,
                 company_match TEXT,
                 match_type TEXT,
-                is_DD BOOLEAN
+                is_DD BOOLEAN,
+                permno INTEGER,
+                dup_cluster_id TEXT
                 )''')
+    
+    # Tables written by earlier versions lack the newer columns
+    add_missing_columns(c, table, {'permno': 'INTEGER',
+                                   'dup_cluster_id': 'TEXT'})
+
+def write_submissions_to_database(submissions, fields, mentions=None,
+                                  body_mentions=None, signatures=None,
+                                  multiple=None):
+    '''
+    Write passed submissions list to SQLite database, along with any title
+    mentions (rows of id, ticker, match_type, position, permno), body mention
+    counts (rows of id, ticker, match_type, n_mentions), MinHash signatures
+    (rows of id, dup_cluster_id, signature) and submissions mentioning more
+    than one ticker ('multiple', written to the multiple-match table)
+    '''
+    
+    # Connect to SQLite database
+    conn = sqlite3.connect(path_reddit_db_write)
+    c = conn.cursor()
+
+    # Create submissions table if it doesn't already exist
+    create_submissions_table(c, table_name)
+    
+    # One representative (the first post seen) per near-duplicate cluster
+    c.execute(f'''CREATE VIEW IF NOT EXISTS {representatives_view} AS
+                SELECT *
+                FROM {table_name}
+                WHERE dup_cluster_id IS NULL OR dup_cluster_id = id''')
 
     # Write submissions to database
-    insert_query = f'''INSERT OR REPLACE INTO {table_name} VALUES (?, ?, ?, ?,
-        ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)'''
+    insert_query = f'''INSERT OR REPLACE INTO {table_name} 
+        ({', '.join(fields)}) VALUES ({', '.join('?' for _ in fields)})'''
     
     for submission in submissions:
         if submission:  # Check if submission is not None
             c.execute(insert_query, submission)
     
+    # Multi-ticker submissions are kept out of the single-match table
+    if multiple:
+        create_submissions_table(c, multiple_table_name)
+        c.executemany(f'''INSERT OR REPLACE INTO {multiple_table_name}
+            ({', '.join(fields)}) VALUES ({', '.join('?' for _ in fields)})''',
+            multiple)
+    
+    # Write all title mentions to the normalized mentions table
+    if mentions:
+        write_mentions_to_database(c, mentions)
+    
+    # Write per-ticker body mention counts
+    if body_mentions:
+        write_body_mentions_to_database(c, body_mentions)
+    
+    # Save MinHash signatures for near-duplicate detection in later runs
+    if signatures:
+        nd.save_signatures(c, signatures)
+    
     # Close connection until next batch
     conn.commit()
     conn.close()
 
+def write_mentions_to_database(c, mentions):
+    '''
+    Write title mentions to the mentions table using the passed cursor 'c'.
+    Also creates the single-match view, which keeps only the submissions of
+    the single- and multiple-match tables that mention exactly one distinct
+    ticker across all of their title mentions.
+    '''
+    c.execute(f'''CREATE TABLE IF NOT EXISTS {mentions_table} (
+                id TEXT,
+                ticker TEXT,
+                match_type TEXT,
+                position INTEGER,
+                permno INTEGER,
+                PRIMARY KEY (id, position)
+                )''')
+    c.execute(f'''CREATE INDEX IF NOT EXISTS idx_{mentions_table}_ticker
+                ON {mentions_table} (ticker)''')
+
+    # Submissions of both tables, with the columns they share
+    create_submissions_table(c, multiple_table_name)
+    c.execute(f"PRAGMA table_info({multiple_table_name})")
+    shared = {r[1] for r in c.fetchall()}
+    c.execute(f"PRAGMA table_info({table_name})")
+    columns = ', '.join(r[1] for r in c.fetchall() if r[1] in shared)
+    c.execute(f"DROP VIEW IF EXISTS {single_match_view}")
+    c.execute(f'''CREATE VIEW {single_match_view} AS
+                SELECT s.*
+                FROM (SELECT {columns} FROM {table_name}
+                      UNION ALL
+                      SELECT {columns} FROM {multiple_table_name}) s
+                JOIN (SELECT id
+                      FROM {mentions_table}
+                      GROUP BY id
+                      HAVING COUNT(DISTINCT ticker) = 1) m
+                ON m.id = s.id''')
+    
+    c.executemany(f'''INSERT OR REPLACE INTO {mentions_table}
+                  (id, ticker, match_type, position, permno)
+                  VALUES (?, ?, ?, ?, ?)''', mentions)
+
+def write_body_mentions_to_database(c, body_mentions):
+    ''' Write body mention counts to the body mentions table via cursor 'c' '''
+    c.execute(f'''CREATE TABLE IF NOT EXISTS {body_mentions_table} (
+                id TEXT,
+                ticker TEXT,
+                match_type TEXT,
+                n_mentions INTEGER,
+                PRIMARY KEY (id, ticker, match_type)
+                )''')
+    c.execute(f'''CREATE INDEX IF NOT EXISTS idx_{body_mentions_table}_ticker
+                ON {body_mentions_table} (ticker)''')
+    
+    c.executemany(f'''INSERT OR REPLACE INTO {body_mentions_table}
+                  (id, ticker, match_type, n_mentions)
+                  VALUES (?, ?, ?, ?)''', body_mentions)
+
 def main():
     global path_logfile_write
     
@@ -245,36 +567,15 @@ def main():
               "is_video", "name", "num_comments", "num_crossposts", "over_18",
               "pinned", "retrieved_on", "score", "selftext", "send_replies", 
               "subreddit", "subreddit_id", "subreddit_subscribers", "title",
-              "upvote_ratio", "company_match", "match_type", "is_DD"]
-    
-    # Load tickers and company names to cross-reference with submission titles
-    company_list = pd.read_csv(path_stocks_db_read)
-        
-    # The function pd.read_csv() imports NA as not available number "nan"
-    company_list.loc[company_list['alias'] == "Nano Labs", 'ticker'] = "NA" 
-    
-    # Make sure all entries to be strings
-    company_list['ticker'] = company_list['ticker'].astype(str)
-
-    # Create set of all company tickers 
-    ticker_set = set(company_list['ticker'])
-    
-    # Isolate aliases in new list
-    alias_raw_list = list(company_list['alias'])
-    alias_dict = {}
-    for j in range(0,len(alias_raw_list)):
-        alias_ticker = company_list[company_list['alias'] == 
-                                    alias_raw_list[j]]['ticker'].values[0]
-        aliases = [al.strip() for al in alias_raw_list[j].split(';')]
-        for a in aliases:
-            alias_dict[a] = alias_ticker
-        
-    # Make new set of dicts
-    alias_set = set(alias_dict)
+              "upvote_ratio", "company_match", "match_type", "is_DD",
+              "permno", "dup_cluster_id"]
     
-    # Assume alias is a set of company aliases; may contain multiple words
-    alias_pattern = r'\b(' + '|'.join(re.escape(alias) \
-                    for alias in alias_set) + r')\b'
+    # Load the compiled ticker universe (tickers, aliases, matcher tables);
+    # rebuilt from the source ticker lists only if they have changed
+    universe = tu.load_universe()
+    ticker_set = universe['tickers']
+    alias_pattern = universe['alias_pattern']
+    check_ticker_history()
 
     # Process submissions file and extract desired fields of qualified 
     # submissions in batches; then write each batch to SQlite database
@@ -307,6 +608,18 @@ def main():
         lf.write("due diligence with no ticker or match: %2.0d\n" 
                  % (counts_dd_nomatch))
         
+        lf.write("ticker matches not listed on post date: %2.0d\n"
+                 % (counts_not_listed))
+        
+        lf.write("titles mentioning multiple tickers: %2.0d\n"
+                 % (counts_multiple_tickers))
+        
+        lf.write("qualified on body mentions only: %2.0d\n"
+                 % (counts_body_only))
+        
+        lf.write("near-duplicates of earlier posts: %2.0d\n"
+                 % (counts_near_duplicates))
+        
         lf.write("total due diligence tags %2.0d\n"
                  % (counts_dd))
         
@@ -0,0 +1,150 @@
+'''
+Point-in-time ticker universe for date-aware title matching. Built from a local
+extract of the CRSP stocknames_v2 table (ticker, namedt, nameenddt, permno) and
+held in an interval index, so a matcher can ask which permno (if any) a ticker
+referred to on a submission's post date in O(log n).
+
+For each ticker, the name intervals are stored as parallel lists sorted by
+start date, along with a running maximum of the end dates. A lookup bisects on
+the start dates and only walks back while an earlier interval could still
+cover the date, so overlapping intervals (rare) are handled correctly.
+
+Dates are stored as proleptic Gregorian ordinals (datetime.date.toordinal).
+The compiled index is cached next to the extract and keyed by its content hash,
+in the same manner as ticker_universe.py.
+
+Author: Aaron M. Stahl (2024) // aaron.m.stahl@gmail.com // astahl3.github.io
+'''
+import bisect
+import csv
+import os
+import pickle
+from datetime import date, datetime
+import ticker_universe as tu
+
+# Version of the index layout; bump whenever the contents below change
+history_version = 1
+
+# File paths for the stocknames_v2 extract and the compiled interval index
+path_stocknames_read = \
+    "/Users/astahl/fin_nlp_data/ticker_lists/crsp_stocknames_v2.csv"
+path_history_artifact = \
+    "/Users/astahl/fin_nlp_data/ticker_lists/ticker_history.pkl"
+
+# Loaded interval index (populated on first use)
+_history = None
+
+def to_ordinal(dt):
+    '''
+    Convert a date, datetime, ISO date string, or posix utc timestamp to a
+    proleptic Gregorian ordinal
+    '''
+    if isinstance(dt, datetime): return dt.date().toordinal()
+    if isinstance(dt, date): return dt.toordinal()
+    if isinstance(dt, str): return date.fromisoformat(dt[:10]).toordinal()
+    return datetime.utcfromtimestamp(dt).date().toordinal()
+
+def build_ticker_history(path_read=None):
+    '''
+    Read the stocknames_v2 extract and return the interval index as a dict of
+    ticker -> (starts, ends, max_ends, permnos), each list sorted by start
+    '''
+    if path_read is None: path_read = path_stocknames_read
+
+    intervals = {}
+    with open(path_read, 'r', newline='', encoding='utf-8') as f:
+        for row in csv.DictReader(f):
+            ticker = (row['ticker'] or '').strip()
+            if not ticker or not row['namedt']: continue
+
+            # Open-ended names (missing nameenddt) are valid through today
+            start = to_ordinal(row['namedt'])
+            if row['nameenddt']: end = to_ordinal(row['nameenddt'])
+            else: end = date.max.toordinal()
+            permno = int(float(row['permno']))
+            intervals.setdefault(ticker, []).append((start, end, permno))
+
+    index = {}
+    for ticker, rows in intervals.items():
+        rows.sort()
+        starts = [r[0] for r in rows]
+        ends = [r[1] for r in rows]
+        permnos = [r[2] for r in rows]
+        max_ends = []
+        running_max = None
+        for end in ends:
+            running_max = end if running_max is None else max(running_max, end)
+            max_ends.append(running_max)
+        index[ticker] = (starts, ends, max_ends, permnos)
+
+    return index
+
+def load_ticker_history():
+    '''
+    Return the interval index, loading it on first use. The cached index is
+    rebuilt if the extract's content hash no longer matches.
+    '''
+    global _history
+    if _history is not None: return _history
+
+    source_hashes = tu.hash_source_files({'stocknames': path_stocknames_read})
+
+    cached = None
+    if os.path.exists(path_history_artifact):
+        with open(path_history_artifact, 'rb') as f:
+            cached = pickle.load(f)
+        if cached.get('version') != history_version: cached = None
+
+    if cached is None or (source_hashes is not None and
+                          cached['source_hashes'] != source_hashes):
+        if source_hashes is None:
+            raise FileNotFoundError("No stocknames_v2 extract found at "
+                                    f"{path_stocknames_read}")
+        cached = {'version': history_version,
+                  'source_hashes': source_hashes,
+                  'index': build_ticker_history()}
+        tmp_path = path_history_artifact + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(cached, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path_history_artifact)
+
+    _history = cached['index']
+    return _history
+
+def lookup_permno(ticker, post_date, history=None):
+    '''
+    Return the permno that 'ticker' referred to on 'post_date', or None if the
+    ticker was not listed on that date. If several name intervals cover the
+    date, the one with the latest start date is used.
+    '''
+    if history is None: history = load_ticker_history()
+
+    entry = history.get(ticker)
+    if entry is None and '.' in ticker:
+        entry = history.get(ticker.replace('.', ''))
+    if entry is None: return None
+
+    starts, ends, max_ends, permnos = entry
+    d = to_ordinal(post_date)
+
+    # Walk back from the last interval starting on or before the date; stop
+    # as soon as no earlier interval can still be open on the date
+    i = bisect.bisect_right(starts, d) - 1
+    while i >= 0 and max_ends[i] >= d:
+        if ends[i] >= d: return permnos[i]
+        i -= 1
+    return None
+
+def is_ticker_valid(ticker, post_date, history=None):
+    ''' Return True if 'ticker' was listed on 'post_date' '''
+    return lookup_permno(ticker, post_date, history) is not None
+
+def tickers_valid_on(post_date, history=None):
+    ''' Return a dict of ticker -> permno for all tickers valid on a date '''
+    if history is None: history = load_ticker_history()
+
+    valid = {}
+    for ticker in history:
+        permno = lookup_permno(ticker, post_date, history)
+        if permno is not None: valid[ticker] = permno
+    return valid
@@ -0,0 +1,199 @@
+'''
+Compiles the ticker universe used for submission title screening into a single
+versioned binary artifact, and loads it lazily on first use.
+
+The artifact bundles the company tickers, the alias -> ticker map, the problem
+and ETF ticker sets, and the prebuilt matcher tables (including the combined
+single-scan mention pattern and the alias token trie) used by the functions
+in title_processing_functions.py and body_processing_functions.py. It is keyed
+by the SHA-256 content hashes of the source CSV files, so it is rebuilt
+automatically whenever a source list changes and otherwise loaded straight
+from disk in a few milliseconds. Importing this module does not read any of
+the source files.
+
+Build the artifact ahead of an ingestion run with:
+    python ticker_universe.py
+
+Author: Aaron M. Stahl (2024) // aaron.m.stahl@gmail.com // astahl3.github.io
+'''
+import hashlib
+import os
+import pickle
+import re
+
+# Version of the artifact layout; bump whenever the contents below change
+artifact_version = 3
+
+# File paths for the source ticker lists and the compiled artifact
+path_stocks_db_read = \
+    "/Users/astahl/fin_nlp_data/ticker_lists/us_companies_5000.csv"
+path_problem_tickers_db_read = \
+    "/Users/astahl/fin_nlp_data/ticker_lists/problem_tickers.csv"
+path_etf_tickers_db_read = \
+    "/Users/astahl/fin_nlp_data/ticker_lists/etf_tickers.csv"
+path_universe_artifact = \
+    "/Users/astahl/fin_nlp_data/ticker_lists/ticker_universe.pkl"
+
+# Loaded artifact and compiled regexes (populated on first use)
+_universe = None
+_alias_regex = None
+_mention_regex = None
+
+def source_paths():
+    ''' Return the source CSV paths keyed by their role in the artifact '''
+    return {'stocks': path_stocks_db_read,
+            'problem_tickers': path_problem_tickers_db_read,
+            'etf_tickers': path_etf_tickers_db_read}
+
+def hash_source_files(paths):
+    '''
+    Return a dict of SHA-256 content hashes for the passed dict of 'paths', or
+    None if any of the source files is missing
+    '''
+    hashes = {}
+    for key, path in paths.items():
+        if not os.path.exists(path): return None
+        h = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                h.update(block)
+        hashes[key] = h.hexdigest()
+    return hashes
+
+def build_universe(source_hashes=None):
+    '''
+    Read the source CSV files and return the compiled universe as a dict. The
+    alias map is built in a single pass over the company list.
+    '''
+    import pandas as pd
+    import body_processing_functions as bf
+
+    paths = source_paths()
+    if source_hashes is None: source_hashes = hash_source_files(paths)
+
+    # Load tickers and company names to cross-reference with titles
+    company_list = pd.read_csv(paths['stocks'])
+
+    # The function pd.read_csv() imports NA as not available number "nan"
+    company_list.loc[company_list['alias'] == "Nano Labs", 'ticker'] = "NA"
+
+    # Make sure all entries to be strings
+    company_list['ticker'] = company_list['ticker'].astype(str)
+    tickers = frozenset(company_list['ticker'])
+
+    # Map each alias (entries may hold several, separated by ';') to ticker
+    alias_dict = {}
+    for ticker, alias_raw in zip(company_list['ticker'],
+                                 company_list['alias'].astype(str)):
+        for a in alias_raw.split(';'):
+            alias_dict[a.strip()] = ticker
+    alias_dict.pop('', None)
+
+    # Problem tickers (common acronyms, words) and ETF tickers
+    problem_tickers_df = pd.read_csv(paths['problem_tickers'])
+    etf_tickers_df = pd.read_csv(paths['etf_tickers'])
+    problem_tickers = frozenset(problem_tickers_df['stock_ticker'].astype(str))
+    etf_tickers = frozenset(etf_tickers_df['ticker'].astype(str))
+
+    # Assume alias is a set of company aliases; may contain multiple words
+    alias_pattern = r'\b(' + '|'.join(re.escape(alias) \
+                    for alias in alias_dict) + r')\b'
+
+    # Combined pattern for a single scan over a title: $ tickers, tickers in
+    # parenthesis, case-insensitive aliases, then bare uppercase tickers.
+    # Longer aliases are tried first so multi-word names win over prefixes.
+    alias_alternation = '|'.join(re.escape(alias) for alias in 
+                                 sorted(alias_dict, key=len, reverse=True))
+    mention_pattern = (r'(?P<symbol>\$[A-Z]{1,4}\.[A-Z]|\$[A-Z]{1,5}\b)'
+                       r'|(?P<parenthesis>\([A-Z]{1,5}(?:\.[A-Z])?\))'
+                       r'|(?P<alias>\b(?i:' + alias_alternation + r')\b)'
+                       r'|(?P<word>\b[A-Z]{1,5}(?:\.[A-Z])?\b)')
+
+    return {'version': artifact_version,
+            'source_hashes': source_hashes,
+            'tickers': tickers,
+            'alias_dict': alias_dict,
+            'problem_tickers': problem_tickers,
+            'etf_tickers': etf_tickers,
+            'tickers_with_sym': frozenset('$' + t for t in tickers),
+            'tickers_with_parenthesis':
+                frozenset('(' + t + ')' for t in tickers),
+            'tickers_no_sym': tickers - problem_tickers,
+            'alias_pattern': alias_pattern,
+            'alias_lookup': {a.lower(): t for a, t in alias_dict.items()},
+            'mention_pattern': mention_pattern,
+            'alias_trie': bf.build_alias_trie(alias_dict)}
+
+def compile_universe(path_write=None):
+    '''
+    Build the universe from the source CSV files and write it to the artifact
+    path; returns the compiled universe dict
+    '''
+    if path_write is None: path_write = path_universe_artifact
+
+    universe = build_universe()
+    tmp_path = path_write + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        pickle.dump(universe, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, path_write)
+    return universe
+
+def read_artifact(path_read=None):
+    ''' Return the artifact stored on disk, or None if missing or outdated '''
+    if path_read is None: path_read = path_universe_artifact
+    if not os.path.exists(path_read): return None
+
+    with open(path_read, 'rb') as f:
+        universe = pickle.load(f)
+    if universe.get('version') != artifact_version: return None
+    return universe
+
+def load_universe():
+    '''
+    Return the compiled ticker universe, loading it on first use. The artifact
+    is rebuilt if the source CSV hashes no longer match; if the source files
+    are unavailable, the existing artifact is used as-is.
+    '''
+    global _universe
+    if _universe is not None: return _universe
+
+    universe = read_artifact()
+    source_hashes = hash_source_files(source_paths())
+
+    if universe is None or (source_hashes is not None and
+                            universe['source_hashes'] != source_hashes):
+        if source_hashes is None:
+            raise FileNotFoundError("No ticker universe artifact found at "
+                                    f"{path_universe_artifact} and source "
+                                    "ticker lists are unavailable")
+        universe = compile_universe()
+
+    _universe = universe
+    return _universe
+
+def get_alias_regex():
+    ''' Return the compiled (case-insensitive) alias regex, built once '''
+    global _alias_regex
+    if _alias_regex is None:
+        _alias_regex = re.compile(load_universe()['alias_pattern'],
+                                  re.IGNORECASE)
+    return _alias_regex
+
+def get_mention_regex():
+    ''' Return the compiled single-scan mention regex, built once '''
+    global _mention_regex
+    if _mention_regex is None:
+        _mention_regex = re.compile(load_universe()['mention_pattern'])
+    return _mention_regex
+
+def main():
+    universe = compile_universe()
+    print(f"Wrote ticker universe artifact: {path_universe_artifact}")
+    print(f"Artifact version: {universe['version']}")
+    print(f"Tickers: {len(universe['tickers'])}")
+    print(f"Aliases: {len(universe['alias_dict'])}")
+    print(f"Problem tickers: {len(universe['problem_tickers'])}")
+    print(f"ETF tickers: {len(universe['etf_tickers'])}")
+
+if __name__ == "__main__":
+    main()
@@ -5,30 +5,35 @@ alias matching. For use with submission_data_to_db.py.
 
 Author: Aaron M. Stahl (2024) // aaron.m.stahl@gmail.com // astahl3.github.io
 '''
-import pandas as pd
 import re
+import ticker_universe as tu
 
 # Global screening parameters
 single_match = True
 
-# File paths for screening
-path_problem_tickers_db_read = \
-    "/Users/astahl/fin_nlp_data/ticker_lists/problem_tickers.csv"
-path_etf_tickers_db_read = \
-    "/Users/astahl/fin_nlp_data/ticker_lists/etf_tickers.csv"
-
-    
-# Create sets for problem tickers (common acronyms, words) and ETF tickers
-problem_tickers_df = pd.read_csv(path_problem_tickers_db_read)
-etf_tickers_df = pd.read_csv(path_etf_tickers_db_read)
-problem_tickers = set(problem_tickers_df['stock_ticker'])
-etf_tickers = set(etf_tickers_df['ticker'])
-
 # Characters to remove from title strings
 chars_to_remove = {'~', '!', '@', '#', '$', '%', '^', '&', '*', '(', ')', 
                    '-', '[', ']', '{', '}', '>', '<', '.', ',', '=', '|',
                    '/', ':', ';', '\\', '"', "'", '?'}
 
+def get_matcher_table(name, tickers=None):
+    '''
+    Return the prebuilt matcher table 'name' from the compiled ticker universe
+    if 'tickers' is None or the universe ticker set; otherwise build the table
+    from the passed 'tickers' set
+    '''
+    universe = tu.load_universe()
+    if tickers is None or tickers is universe['tickers']:
+        return universe[name]
+
+    if name == 'tickers_with_sym':
+        return {'$' + ticker for ticker in tickers}
+    if name == 'tickers_with_parenthesis':
+        return {'(' + ticker + ')' for ticker in tickers}
+    if name == 'tickers_no_sym':
+        return set(tickers) - universe['problem_tickers']
+    raise KeyError(f"Unknown matcher table: {name}")
+
 def ticker_match_with_symbol(submission, fields, tickers=None):
     ''' 
     Checks for tickers with leading $ symbol in title string that match a
@@ -53,7 +58,7 @@ def ticker_match_with_symbol(submission, fields, tickers=None):
     '''
     
     # Check for ticker match in title string where $ symbol precedes ticker
-    tickers_with_sym = {'$' + ticker for ticker in tickers}
+    tickers_with_sym = get_matcher_table('tickers_with_sym', tickers)
     for word in title_string.split():
         if word in tickers_with_sym:
             word_A = word
@@ -106,7 +111,7 @@ def ticker_nomatch_with_symbol(submission, fields):
     else: return None
 
     # Ignore ETF tickers
-    if matched_ticker.replace('$','') in etf_tickers:
+    if matched_ticker.replace('$','') in tu.load_universe()['etf_tickers']:
         return None
         
     if single_match:
@@ -147,7 +152,7 @@ def ticker_match_with_parenthesis(submission, fields, tickers=None):
         title_string = title_string.replace(char, '')
     
     # Check for ticker match in title string where $ symbol precedes ticker
-    tickers_with_sym = {'(' + ticker + ')' for ticker in tickers}
+    tickers_with_sym = get_matcher_table('tickers_with_parenthesis', tickers)
     for word in title_string.split():
         if word in tickers_with_sym:
             word_A = word
@@ -206,7 +211,7 @@ def ticker_nomatch_with_parenthesis(submission, fields):
     else: return None
 
     # Ignore ETF tickers
-    if matched_ticker.replace('$','') in etf_tickers:
+    if matched_ticker.replace('$','') in tu.load_universe()['etf_tickers']:
         return None
         
     if single_match:
@@ -243,9 +248,7 @@ def ticker_match_no_symbol(submission, fields, tickers=None):
         title_string = title_string.replace(char, '')
     
     # Check for ticker match in title string
-    tickers_no_sym = tickers.copy()
-    for t in problem_tickers:
-        tickers_no_sym.remove(t)
+    tickers_no_sym = get_matcher_table('tickers_no_sym', tickers)
    
     for word in title_string.split():
         if word in tickers_no_sym:
@@ -274,7 +277,8 @@ def ticker_match_no_symbol(submission, fields, tickers=None):
 
 def alias_match(submission, fields, aliases=None):
     ''' 
-    Checks for company name and alias matches using the aliases regex string.
+    Checks for company name and alias matches using the aliases regex string,
+    or the compiled universe alias regex if 'aliases' is None.
     '''
     
     title_string = submission.get('title')
@@ -283,7 +287,10 @@ def alias_match(submission, fields, aliases=None):
     for char in chars_to_remove_temp:
         title_string = title_string.replace(char, '')
             
-    match_A = re.search(aliases, title_string, re.IGNORECASE)
+    if aliases is None: alias_regex = tu.get_alias_regex()
+    else: alias_regex = re.compile(aliases, re.IGNORECASE)
+
+    match_A = alias_regex.search(title_string)
     if match_A is None: return None
     
     matched_alias = match_A.group(0)    
@@ -291,7 +298,7 @@ def alias_match(submission, fields, aliases=None):
     if single_match:
         
         title_string_reduced = title_string.replace(matched_alias, '')
-        match_B = re.search(aliases, title_string_reduced, re.IGNORECASE)
+        match_B = alias_regex.search(title_string_reduced)
         if match_B: return None
                 
     submission['company_match'] = matched_alias
@@ -304,6 +311,58 @@ def alias_match(submission, fields, aliases=None):
     
     return submission
 
+def extract_title_mentions(title_string, tickers=None):
+    '''
+    Extract all ticker and alias mentions of every match type from the title
+    string in a single scan. Returns a list of (ticker, match_type, position)
+    tuples in order of appearance, where position is the character offset of
+    the mention in the title.
+    
+    Match types:
+    - ticker_with_symbol: $ ticker in the tickers set (e.g., $GME)
+    - symbol_no_match: $ ticker not in the tickers set, ETFs excluded
+    - ticker_with_parenthesis: ticker in parenthesis in the set (e.g., (GME))
+    - alias: company name or alias (e.g., Gamestop)
+    - ticker_no_symbol: bare ticker in the set, problem tickers excluded
+    '''
+    universe = tu.load_universe()
+    if tickers is None: tickers = universe['tickers']
+    tickers_no_sym = get_matcher_table('tickers_no_sym', tickers)
+    
+    matches_to_redirect = {'GOOG': 'GOOGL'}
+    
+    mentions = []
+    for match in tu.get_mention_regex().finditer(title_string):
+        kind = match.lastgroup
+        text = match.group(kind)
+        
+        if kind == 'symbol':
+            ticker = text[1:]
+            if ticker in tickers: match_type = 'ticker_with_symbol'
+            elif ticker in universe['etf_tickers']: continue
+            else:
+                match_type = 'symbol_no_match'
+                ticker = matches_to_redirect.get(ticker, ticker)
+                
+        elif kind == 'parenthesis':
+            ticker = text[1:-1]
+            if ticker not in tickers: continue
+            match_type = 'ticker_with_parenthesis'
+            
+        elif kind == 'alias':
+            ticker = universe['alias_lookup'].get(text.lower())
+            if ticker is None: continue
+            match_type = 'alias'
+            
+        else:
+            ticker = text
+            if ticker not in tickers_no_sym: continue
+            match_type = 'ticker_no_symbol'
+            
+        mentions.append((ticker, match_type, match.start()))
+        
+    return mentions
+
 def check_if_DD(input_string):
     ''' Return True if title indicates a due diligence post '''
     
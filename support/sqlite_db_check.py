@@ -20,7 +20,7 @@ path_sample = '/reddit/submissions_sample.db'
 
 # Table names
 table_ticker_matches = 'single_ticker_matches'
-table_performance = 'crsp_performance'
+table_performance = 'crsp_performance_iso' # view with ISO dates
 table_sample = 'sample_1'
 
 path_ext = path_sample
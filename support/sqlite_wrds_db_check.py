@@ -9,25 +9,39 @@ Author: Aaron M. Stahl (2024) // aaron.m.stahl@gmail.com // astahl3.github.io
 '''
 import pandas as pd
 import sqlite3
+import returns_store as rs
 
 # Root database path
 root_path = '/Users/astahl/fin_nlp_data/sqlite/wrds'
 
-# Connect to the SQLite database
+# Database file under the root path
 path_ext = '/stock_performance.db'
-conn = sqlite3.connect(root_path + path_ext)
 
-# Table names
-table_security = 'crsp_securities'
-table_performance = 'crsp_returns'
+# Table names; dates are stored as integer day numbers, so read the views
+# (<table>_iso) that show them as ISO dates
+table_security = 'crsp_securities_iso'
+table_performance = 'crsp_returns_iso'
 desired_table = table_performance
 
-# Query the database and load the results into a DataFrame
-df = pd.read_sql_query(f"SELECT * FROM {desired_table}", conn)
-#df = pd.read_sql_query("SELECT * FROM gpt_responses", conn)
-
-# Close the database connection
-conn.close()
+# Single permno (and optional date window) to read from the memory-mapped
+# returns store built by wrds/returns_store.py instead of loading the whole
+# table; None reads desired_table
+desired_permno = None
+desired_start = None
+desired_end = None
+
+if desired_permno is not None and rs.store_exists():
+    # Read the permno's rows as zero-copy views of the store (no SQL)
+    store = rs.load_store()
+    df = rs.to_frame(store, desired_permno, desired_start, desired_end)
+else:
+    # Query the database and load the results into a DataFrame
+    conn = sqlite3.connect(root_path + path_ext)
+    df = pd.read_sql_query(f"SELECT * FROM {desired_table}", conn)
+    #df = pd.read_sql_query("SELECT * FROM gpt_responses", conn)
+
+    # Close the database connection
+    conn.close()
 
 # Now you can explore the DataFrame
 print(df.head())  # Print the first few rows of the DataFrame
\ No newline at end of file
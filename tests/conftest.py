@@ -0,0 +1,14 @@
+'''
+Test configuration: the project modules are flat scripts imported by name
+(e.g., import wrds_sql as ws), so put their directories on the import path.
+
+Author: Aaron M. Stahl (2024) // aaron.m.stahl@gmail.com // astahl3.github.io
+'''
+import os
+import sys
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+for subdir in ['wrds', os.path.join('wrds', 'crsp'),
+               os.path.join('reddit', 'submissions')]:
+    path = os.path.join(root, subdir)
+    if path not in sys.path: sys.path.insert(0, path)
@@ -0,0 +1,86 @@
+'''
+Betas and abnormal returns of the returns engine against a plain per-post
+loop, on the returns and coverage of test_returns_engine.py: betas limited to
+the covered range holding the market date, and market- and beta-adjusted
+returns over the same windows as the raw returns.
+
+Author: Aaron M. Stahl (2024) // aaron.m.stahl@gmail.com // astahl3.github.io
+'''
+import math
+import sqlite3
+import pytest
+
+np = pytest.importorskip('numpy')
+pytest.importorskip('pandas')
+import market_calendar as mc
+import returns_engine as rte
+from test_returns_engine import data, sample_days, reference_return, \
+    gap_permno, legacy_permno
+
+def reference_beta(dates, r, market_ret, ranges, market_day):
+    ''' OLS beta over the beta_window rows through 'market_day' '''
+    holding = [s for s, e in ranges if s <= market_day <= e]
+    if not holding: return math.nan
+    rows = [k for k in range(dates.size) if dates[k] <= market_day]
+    rows = [k for k in rows[-rte.beta_window:] if dates[k] >= holding[0]]
+    pairs = [(market_ret[dates[k]], 0.0 if np.isnan(r[k]) else r[k])
+             for k in rows if dates[k] in market_ret]
+    n = len(pairs)
+    if n < rte.beta_min_obs: return math.nan
+    sm = sum(x for x, _ in pairs)
+    sr = sum(y for _, y in pairs)
+    smm = sum(x * x for x, _ in pairs)
+    smr = sum(x * y for x, y in pairs)
+    var = n * smm - sm * sm
+    return (n * smr - sm * sr) / var if var > 0 else math.nan
+
+def reference_market_return(market_ret, start, end):
+    ''' Compounded benchmark return after 'start' through 'end' '''
+    if end > max(market_ret): return math.nan
+    growth = 1.0
+    for d, x in market_ret.items():
+        if start < d <= end: growth *= 1 + x
+    return growth - 1
+
+def test_betas_match_per_post_loop(data):
+    days = sample_days(data)
+    posts = [(p, d) for p in [gap_permno, legacy_permno] for d in days]
+    permnos, market_days = map(np.array, zip(*posts))
+
+    out = rte.estimate_betas(data['index'], data['market_index'], permnos,
+                             market_days, coverage=data['coverage'])
+    expected = [reference_beta(*data['rets'][p], data['market_ret'],
+                               data['ranges'][p], d) for p, d in posts]
+    np.testing.assert_allclose(out, expected, rtol=1e-6, atol=1e-9)
+    assert np.isfinite(expected).sum() > 0
+
+    # Betas are estimated from the true 1.3 up to noise
+    finite = np.asarray(expected)[np.isfinite(expected)]
+    assert abs(np.median(finite) - 1.3) < 0.3
+
+def test_abnormal_returns_match_per_post_loop(data, monkeypatch):
+    monkeypatch.setattr(mc, '_sessions', data['sessions'])
+    dates, r = data['rets'][gap_permno]
+    market_dates = dates[[100, 150, 158, 200, 300]]
+    horizons = {'return_5d': ('trading', 5)}
+
+    perf = rte.abnormal_returns(data['index'], data['market_index'],
+                                [gap_permno] * 5, market_dates, horizons,
+                                beta_adjusted=True,
+                                coverage=data['coverage'])
+    sessions = list(data['sessions'])
+    for k, market_date in enumerate(market_dates):
+        end = sessions[sessions.index(market_date) + 5]
+        ret = reference_return(dates, r, data['ranges'][gap_permno],
+                               market_date, end)
+        market = reference_market_return(data['market_ret'], market_date,
+                                          end)
+        beta = reference_beta(dates, r, data['market_ret'],
+                              data['ranges'][gap_permno], market_date)
+        np.testing.assert_allclose(
+            [perf['return_5d'][k], perf['abnormal_5d'][k], perf['beta'][k],
+             perf['beta_abnormal_5d'][k]],
+            [ret, ret - market, beta, ret - beta * market], rtol=1e-6)
+
+def test_missing_market_index_loads_empty():
+    assert rte.load_market_index(sqlite3.connect(':memory:')) == {}
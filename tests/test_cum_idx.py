@@ -0,0 +1,58 @@
+'''
+Cumulative return index (cum_idx) of the local CRSP returns table: filled for
+every stored row, returns over any covered window from two lookups, and no
+separate index on the WITHOUT ROWID table.
+
+Author: Aaron M. Stahl (2024) // aaron.m.stahl@gmail.com // astahl3.github.io
+'''
+import math
+import sqlite3
+import pytest
+
+pytest.importorskip('numpy')
+pytest.importorskip('pandas')
+pytest.importorskip('wrds')
+import market_calendar as mc
+import crsp_performance_db as cpd
+
+returns = [('2020-01-02', 0.01), ('2020-01-03', -0.02), ('2020-01-06', None),
+           ('2020-01-07', 0.03), ('2020-01-08', 0.005)]
+
+@pytest.fixture
+def cn(tmp_path):
+    cn = sqlite3.connect(str(tmp_path / 'stock_performance.db'))
+    cpd.create_local_tables(cn)
+    cn.executemany(f"""INSERT INTO {cpd.performance_table}
+                       (permno, mkt_day, ret) VALUES (?, ?, ?)""",
+                   [(14593, mc.day_number(d), ret) for d, ret in returns])
+    cn.commit()
+    yield cn
+    cn.close()
+
+def test_cum_idx_gives_compounded_window_returns(cn):
+    cpd.fill_cum_idx(cn)
+    assert cn.execute(f"""SELECT COUNT(*) FROM {cpd.performance_table}
+                          WHERE cum_idx IS NULL""").fetchone()[0] == 0
+
+    # Stored returns are covered from the first to the last row
+    cpd.load_coverage(cn)
+    for start, end in [('2020-01-02', '2020-01-08'),
+                       ('2020-01-03', '2020-01-07'),
+                       ('2020-01-06', '2020-01-08')]:
+        growth = 1.0
+        for date, ret in returns:
+            if start < date <= end: growth *= 1 + (ret or 0.0)
+        assert math.isclose(cpd.period_return(cn, 14593, start, end),
+                            growth - 1, rel_tol=1e-12)
+
+    # Windows outside the covered range have no return
+    assert cpd.period_return(cn, 14593, '2020-01-02', '2020-01-09') is None
+    assert cpd.period_return(cn, 10107, '2020-01-02', '2020-01-08') is None
+
+def test_without_rowid_table_has_no_cum_idx_index(cn):
+    index_name = f"idx_{cpd.performance_table}_cum"
+    cn.execute(f"""CREATE INDEX {index_name}
+                   ON {cpd.performance_table} (permno, mkt_day, cum_idx)""")
+    cpd.add_cum_idx_column(cn)
+    assert cn.execute("SELECT COUNT(*) FROM sqlite_master WHERE name = ?",
+                      (index_name,)).fetchone()[0] == 0
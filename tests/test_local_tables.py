@@ -0,0 +1,117 @@
+'''
+Migration of local CRSP tables with the former schema (rowid tables with TEXT
+permnos and ISO date columns) to integer permnos and day numbers, in place,
+with ISO date views under the former column names.
+
+Author: Aaron M. Stahl (2024) // aaron.m.stahl@gmail.com // astahl3.github.io
+'''
+import sqlite3
+import pytest
+
+pytest.importorskip('numpy')
+pytest.importorskip('pandas')
+pytest.importorskip('wrds')
+import market_calendar as mc
+import wrds_sql as ws
+import crsp_performance_db as cpd
+
+# Former schemas, as created by crsp_performance_db.py before integer days
+old_security_sql = """
+    CREATE TABLE crsp_securities (
+        permno TEXT PRIMARY KEY,
+        cusip9 TEXT,
+        ticker TEXT,
+        issuernm TEXT,
+        primaryexch TEXT,
+        securitytype TEXT,
+        securitysubtype TEXT,
+        lastupd DATE)
+    """
+old_returns_sql = """
+    CREATE TABLE crsp_returns (
+        permno TEXT,
+        hsiccd INTEGER,
+        mkt_date DATE,
+        numtrd REAL,
+        ret REAL,
+        shrout REAL,
+        vol REAL,
+        FOREIGN KEY (permno) REFERENCES crsp_securities(permno),
+        PRIMARY KEY (permno, mkt_date))
+    """
+
+returns = {'14593': [('2020-01-02', 0.01), ('2020-01-03', -0.02),
+                     ('2020-01-06', None), ('2020-01-07', 0.03),
+                     ('2020-01-08', 0.005)],
+           '10107': [('2020-01-02', -0.01), ('2020-01-03', 0.04)]}
+
+@pytest.fixture
+def cn(tmp_path):
+    cn = sqlite3.connect(str(tmp_path / 'stock_performance.db'))
+    cn.execute(old_security_sql)
+    cn.execute(old_returns_sql)
+    cn.executemany("""INSERT INTO crsp_securities (permno, ticker, lastupd)
+                      VALUES (?, ?, ?)""",
+                   [('14593', 'AAPL', '2024-03-28'),
+                    ('10107', 'MSFT', '2024-03-28')])
+    cn.executemany("""INSERT INTO crsp_returns (permno, mkt_date, ret)
+                      VALUES (?, ?, ?)""",
+                   [(permno, date, ret) for permno, rows in returns.items()
+                    for date, ret in rows])
+    cn.commit()
+    yield cn
+    cn.close()
+
+def table_sql(cn, table):
+    return cn.execute("SELECT sql FROM sqlite_master WHERE name = ?",
+                      (table,)).fetchone()[0].upper()
+
+def column_types(cn, table):
+    return {r[1]: r[2] for r in cn.execute(f"PRAGMA table_info({table})")}
+
+def test_create_local_table_migrates_rowid_table(cn):
+    old_columns = ws.create_local_table(
+        cn, cpd.performance_table, cpd.local_schemas[cpd.performance_table],
+        cpd.day_columns[cpd.performance_table], ('permno',))
+    assert 'mkt_date' in old_columns
+
+    assert 'WITHOUT ROWID' in table_sql(cn, cpd.performance_table)
+    types = column_types(cn, cpd.performance_table)
+    assert types['permno'] == 'INTEGER' and types['mkt_day'] == 'INTEGER'
+    assert 'mkt_date' not in types
+
+    rows = cn.execute(f"""SELECT permno, mkt_day, ret
+                          FROM {cpd.performance_table}
+                          ORDER BY permno, mkt_day""").fetchall()
+    expected = sorted((int(permno), mc.day_number(date), ret)
+                      for permno, dates in returns.items()
+                      for date, ret in dates)
+    assert rows == expected
+    assert all(type(p) is int and type(d) is int for p, d, _ in rows)
+
+    # The ISO view shows the former dates; rerunning is a no-op
+    iso = cn.execute(f"""SELECT permno, mkt_date
+                         FROM {cpd.performance_table}_iso
+                         WHERE permno = 14593
+                         ORDER BY mkt_date""").fetchall()
+    assert [d for _, d in iso] == [d for d, _ in returns['14593']]
+    assert ws.create_local_table(
+        cn, cpd.performance_table, cpd.local_schemas[cpd.performance_table],
+        cpd.day_columns[cpd.performance_table], ('permno',)) is None
+    assert cn.execute(f"SELECT COUNT(*) FROM {cpd.performance_table}"
+                      ).fetchone()[0] == len(rows)
+
+def test_create_local_tables_migrates_every_table(cn):
+    cpd.create_local_tables(cn)
+
+    types = column_types(cn, cpd.security_table)
+    assert types['permno'] == 'INTEGER' and 'lastupd_day' in types
+    assert cn.execute(f"""SELECT lastupd_day FROM {cpd.security_table}
+                          WHERE permno = 14593""").fetchone()[0] == \
+           mc.day_number('2024-03-28')
+    assert cn.execute(f"""SELECT lastupd FROM {cpd.security_table}_iso
+                          WHERE permno = 14593""").fetchone()[0] == \
+           '2024-03-28'
+    for table in [cpd.performance_table, cpd.coverage_table,
+                  cpd.market_table]:
+        assert 'WITHOUT ROWID' in table_sql(cn, table)
@@ -0,0 +1,38 @@
+'''
+Session lookups of the NYSE calendar: dates roll forward to the next session,
+and dates or shifted sessions outside the cached calendar give NaT rather
+than the last session.
+
+Author: Aaron M. Stahl (2024) // aaron.m.stahl@gmail.com // astahl3.github.io
+'''
+import pytest
+
+np = pytest.importorskip('numpy')
+pd = pytest.importorskip('pandas')
+import market_calendar as mc
+
+@pytest.fixture(autouse=True)
+def sessions(monkeypatch):
+    days = np.arange(np.datetime64('2020-01-01'), np.datetime64('2020-02-01'))
+    sessions = days[np.is_busday(days)]
+    monkeypatch.setattr(mc, '_sessions', sessions)
+    return sessions
+
+def test_dates_roll_forward_to_sessions():
+    out = mc.nearest_sessions(['2020-01-03', '2020-01-04', '2020-01-31'])
+    assert list(out.strftime('%Y-%m-%d')) == \
+           ['2020-01-03', '2020-01-06', '2020-01-31']
+    assert mc.add_trading_days(['2020-01-03'], 2)[0] == \
+           pd.Timestamp('2020-01-07')
+
+def test_dates_past_calendar_end_give_nat():
+    assert pd.isna(mc.nearest_sessions(['2020-02-01'])[0])
+    assert pd.isna(mc.get_nearest_market_date('2020-03-15'))
+
+    # Shifts past either end, or from a date past the end, are not clipped
+    out = mc.add_trading_days(['2020-01-30', '2020-01-02', '2020-02-03'],
+                              [5, -5, -10])
+    assert out.isna().all()
+    np.testing.assert_array_equal(
+        mc.trading_days_between(['2020-01-02', '2020-01-02'],
+                                ['2020-01-06', '2020-02-03']), [2, np.nan])
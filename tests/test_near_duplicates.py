@@ -0,0 +1,84 @@
+'''
+Recall of the MinHash LSH near-duplicate detection on known duplicates: light
+edits and cross-posts of a post join its cluster, unrelated posts do not, and
+signatures saved to the database match posts of a later run.
+
+Author: Aaron M. Stahl (2024) // aaron.m.stahl@gmail.com // astahl3.github.io
+'''
+import random
+import sqlite3
+import pytest
+
+np = pytest.importorskip('numpy')
+import near_duplicates as nd
+
+# Corpus size, words per post and words replaced in each edited duplicate
+n_posts = 200
+n_words = 200
+n_edits = 2
+
+def random_post(rng, vocab):
+    return [rng.choice(vocab) for _ in range(n_words)]
+
+def edit_post(rng, words, vocab):
+    words = list(words)
+    for k in rng.sample(range(len(words)), n_edits):
+        words[k] = rng.choice(vocab)
+    return words
+
+@pytest.fixture
+def corpus():
+    rng = random.Random(0)
+    vocab = [f"word{k}" for k in range(5000)]
+    originals = [random_post(rng, vocab) for _ in range(n_posts)]
+    edits = [edit_post(rng, words, vocab) for words in originals]
+    unrelated = [random_post(rng, vocab) for _ in range(n_posts)]
+    return originals, edits, unrelated
+
+def test_edited_duplicates_join_the_original_cluster(corpus):
+    originals, edits, unrelated = corpus
+    index = nd.new_lsh_index()
+    for k, words in enumerate(originals):
+        assert nd.insert_post(index, f"o{k}", ' '.join(words)) == f"o{k}"
+
+    # 2 edits in 196 five-word shingles leave a Jaccard similarity near
+    # 0.9, where a pair becomes a candidate with probability above 0.9999
+    matched = sum(nd.insert_post(index, f"e{k}", ' '.join(words)) == f"o{k}"
+                  for k, words in enumerate(edits))
+    assert matched / n_posts >= 0.98
+
+    # Unrelated posts start their own clusters
+    for k, words in enumerate(unrelated):
+        assert nd.insert_post(index, f"u{k}", ' '.join(words)) == f"u{k}"
+
+def test_cross_posts_and_formatting_changes_match(corpus):
+    originals, _, _ = corpus
+    index = nd.new_lsh_index()
+    text = ' '.join(originals[0])
+    nd.insert_post(index, 'a', text)
+    assert nd.insert_post(index, 'b', text) == 'a'
+    assert nd.insert_post(index, 'c', text.upper() + ' !!') == 'a'
+
+    # Reinserting a known post returns its cluster without a new signature
+    n_pending = len(index['pending'])
+    assert nd.insert_post(index, 'b', text) == 'a'
+    assert len(index['pending']) == n_pending
+
+def test_saved_signatures_match_posts_of_a_later_run(corpus, tmp_path):
+    originals, edits, _ = corpus
+    path_db = str(tmp_path / 'submissions.db')
+
+    index = nd.new_lsh_index()
+    for k, words in enumerate(originals[:20]):
+        nd.insert_post(index, f"o{k}", ' '.join(words))
+    conn = sqlite3.connect(path_db)
+    nd.save_signatures(conn.cursor(), nd.pop_pending(index))
+    conn.commit()
+    conn.close()
+    assert index['pending'] == []
+
+    index = nd.load_lsh_index(path_db)
+    assert len(index['signatures']) == 20
+    matched = sum(nd.insert_post(index, f"e{k}", ' '.join(words)) == f"o{k}"
+                  for k, words in enumerate(edits[:20]))
+    assert matched >= 19
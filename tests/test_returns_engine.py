@@ -0,0 +1,154 @@
+'''
+Vectorized returns engine against a plain per-post loop: compounded returns
+over windows at the edges of the stored returns, across a gap between
+fetched ranges of the coverage table, and for permnos without coverage rows.
+
+Author: Aaron M. Stahl (2024) // aaron.m.stahl@gmail.com // astahl3.github.io
+'''
+import math
+import sqlite3
+import pytest
+
+np = pytest.importorskip('numpy')
+pd = pytest.importorskip('pandas')
+import market_calendar as mc
+import returns_engine as rte
+
+# Permno with two fetched ranges and a gap between them, and permno stored
+# before coverage was tracked (no coverage rows)
+gap_permno = '10001'
+legacy_permno = '10002'
+
+def day(d):
+    return mc.day_number(d)
+
+@pytest.fixture
+def data():
+    rng = np.random.RandomState(0)
+    sessions = np.arange(np.datetime64('2019-12-02'),
+                         np.datetime64('2021-06-01'))
+    sessions = sessions[np.is_busday(sessions)]
+
+    # Range A: 160 sessions; gap of 40 sessions; range B: 200 sessions
+    dates = np.concatenate((sessions[:160], sessions[200:400]))
+    market = sessions[:400]
+    market = market[np.arange(market.size) % 13 != 5]
+    m = rng.normal(0.0, 0.01, market.size)
+    market_ret = dict(zip(market, m))
+
+    rets = {}
+    for permno, permno_dates in [(gap_permno, dates),
+                                 (legacy_permno, sessions[:300])]:
+        r = np.array([1.3 * market_ret.get(d, 0.0) for d in permno_dates])
+        r += rng.normal(0.0, 0.02, permno_dates.size)
+        r[7] = np.nan
+        rets[permno] = (permno_dates, r)
+
+    cn = sqlite3.connect(':memory:')
+    cn.execute("""CREATE TABLE crsp_coverage (permno INTEGER,
+                  start_day INTEGER, end_day INTEGER)""")
+    # Range A is stored as two adjacent rows; fetched ranges start before
+    # and may end after the sessions they hold
+    a_start, a_end = dates[0] - 3, dates[159] + 2
+    a_mid = dates[80]
+    b_start, b_end = dates[160] - 1, dates[-1]
+    cn.executemany("INSERT INTO crsp_coverage VALUES (?, ?, ?)",
+                   [(int(gap_permno), day(a_start), day(a_mid)),
+                    (int(gap_permno), day(a_mid) + 1, day(a_end)),
+                    (int(gap_permno), day(b_start), day(b_end))])
+    cn.execute("""CREATE TABLE crsp_market_index (mkt_day INTEGER PRIMARY KEY,
+                  vwretd REAL, ewretd REAL, sprtrn REAL)""")
+    cn.executemany("INSERT INTO crsp_market_index VALUES (?, ?, ?, ?)",
+                   [(day(d), float(x), float(x), float(x))
+                    for d, x in zip(market, m)])
+
+    returns = pd.DataFrame(
+        [(permno, d, x) for permno, (ds, r) in rets.items()
+         for d, x in zip(ds, r)], columns=['permno', 'mkt_date', 'ret'])
+    ranges = {gap_permno: [(a_start, a_end), (b_start, b_end)],
+              legacy_permno: [(sessions[0], sessions[299])]}
+    return {'cn': cn, 'sessions': sessions, 'rets': rets,
+            'market_ret': market_ret, 'ranges': ranges,
+            'index': rte.build_return_index(returns),
+            'coverage': rte.load_coverage(cn),
+            'market_index': rte.load_market_index(cn)}
+
+def reference_return(dates, r, ranges, start, end):
+    ''' Compounded return after 'start' through 'end', one row at a time '''
+    if end > dates[-1]: return math.nan
+    if not any(s <= start and e >= end for s, e in ranges): return math.nan
+    growth = 1.0
+    for d, x in zip(dates, r):
+        if start < d <= end: growth *= 1 + (0.0 if np.isnan(x) else x)
+    return growth - 1
+
+def sample_days(data):
+    ''' Days at the edges of every range and of the gap, plus a grid '''
+    dates = data['rets'][gap_permno][0]
+    edges = [dates[0], dates[159], dates[160], dates[-1]]
+    days = {d + k for d in edges for k in range(-4, 5)}
+    days |= set(np.arange(dates[0] - 10, dates[-1] + 10, 9))
+    return sorted(days)
+
+def test_load_coverage_merges_adjacent_rows(data):
+    starts, ends = data['coverage'][gap_permno]
+    expected = data['ranges'][gap_permno]
+    assert list(starts) == [s for s, _ in expected]
+    assert list(ends) == [e for _, e in expected]
+    assert legacy_permno not in data['coverage']
+
+def test_period_returns_match_per_post_loop(data):
+    days = sample_days(data)
+    windows = [(p, s, e) for p in [gap_permno, legacy_permno]
+               for s in days for e in days if s < e]
+    permnos, starts, ends = map(np.array, zip(*windows))
+
+    out = rte.period_returns(data['index'], permnos, starts, ends,
+                             data['coverage'])
+    expected = [reference_return(*data['rets'][p], data['ranges'][p], s, e)
+                for p, s, e in windows]
+    np.testing.assert_allclose(out, expected, rtol=1e-9, atol=1e-12)
+
+    # Both NaN and finite windows are exercised, including across the gap
+    dates = data['rets'][gap_permno][0]
+    assert np.isnan(expected).sum() > 0 and np.isfinite(expected).sum() > 0
+    across = rte.period_returns(data['index'], [gap_permno], [dates[150]],
+                                [dates[170]], data['coverage'])
+    assert np.isnan(across[0])
+
+def test_period_returns_without_coverage_only_cut_at_last_return(data):
+    dates, r = data['rets'][gap_permno]
+    whole = [(dates[0], dates[-1])]
+    starts = [dates[150], dates[10], dates[-5]]
+    ends = [dates[170], dates[-1], dates[-1] + 1]
+    out = rte.period_returns(data['index'], [gap_permno] * 3, starts, ends)
+    expected = [reference_return(dates, r, whole, s, e)
+                for s, e in zip(starts, ends)]
+    np.testing.assert_allclose(out, expected, rtol=1e-9)
+
+def test_unknown_permnos_give_nan(data):
+    dates = data['rets'][gap_permno][0]
+    out = rte.period_returns(data['index'], ['99999'], [dates[0]],
+                             [dates[5]], data['coverage'])
+    assert np.isnan(out[0])
+
+def test_forward_returns_use_session_horizons(data, monkeypatch):
+    monkeypatch.setattr(mc, '_sessions', data['sessions'])
+    dates, r = data['rets'][legacy_permno]
+    market_dates = dates[[0, 50, 120, 280]]
+    horizons = {'return_5d': ('trading', 5), 'return_1mo': ('calendar', 30)}
+
+    perf = rte.forward_returns(data['index'], [legacy_permno] * 4,
+                               market_dates, horizons, data['coverage'])
+    sessions = list(data['sessions'])
+    for name, (kind, n) in horizons.items():
+        expected = []
+        for market_date in market_dates:
+            if kind == 'trading':
+                end = sessions[sessions.index(market_date) + n]
+            else:
+                end = min(s for s in sessions if s >= market_date + n)
+            expected.append(reference_return(dates, r,
+                                             data['ranges'][legacy_permno],
+                                             market_date, end))
+        np.testing.assert_allclose(perf[name], expected, rtol=1e-9)
@@ -0,0 +1,66 @@
+'''
+Memory-mapped returns store: built from the local returns table, read back
+per permno and date window, and rebuilt over directories left by an
+interrupted earlier build.
+
+Author: Aaron M. Stahl (2024) // aaron.m.stahl@gmail.com // astahl3.github.io
+'''
+import os
+import sqlite3
+import pytest
+
+np = pytest.importorskip('numpy')
+pytest.importorskip('pandas')
+import market_calendar as mc
+import returns_store as rs
+
+returns = {14593: [('2020-01-02', 0.01), ('2020-01-03', -0.02),
+                   ('2020-01-06', None), ('2020-01-07', 0.03)],
+           10107: [('2020-01-03', 0.04), ('2020-01-06', -0.01)]}
+
+@pytest.fixture
+def cn(monkeypatch):
+    sessions = np.arange(np.datetime64('2019-12-02'),
+                         np.datetime64('2020-03-01'))
+    monkeypatch.setattr(mc, '_sessions', sessions[np.is_busday(sessions)])
+    cn = sqlite3.connect(':memory:')
+    cn.execute(f"""CREATE TABLE {rs.returns_table} (permno INTEGER,
+                   mkt_day INTEGER, ret REAL, vol REAL, shrout REAL)""")
+    cn.executemany(f"""INSERT INTO {rs.returns_table} (permno, mkt_day, ret)
+                       VALUES (?, ?, ?)""",
+                   [(permno, mc.day_number(d), ret)
+                    for permno, rows in returns.items() for d, ret in rows])
+    yield cn
+    cn.close()
+
+def test_store_round_trip(cn, tmp_path):
+    path_dir = str(tmp_path / 'returns_store')
+    rs.build_store(cn, path_dir)
+    assert rs.store_exists(path_dir)
+
+    store = rs.load_store(path_dir)
+    frame = rs.to_frame(store, 14593)
+    assert list(frame['mkt_date'].astype(str)) == \
+           [d for d, _ in returns[14593]]
+    np.testing.assert_array_equal(
+        frame['ret'], [np.nan if r is None else r for _, r in returns[14593]])
+
+    window = rs.to_frame(store, 14593, '2020-01-03', '2020-01-06')
+    assert len(window) == 2
+    assert rs.get_block(store, 99999) is None
+
+def test_rebuild_over_leftover_directories(cn, tmp_path):
+    path_dir = str(tmp_path / 'returns_store')
+    rs.build_store(cn, path_dir)
+
+    # An interrupted build may leave the temporary and old directories
+    for suffix in ['.tmp', '.old']:
+        os.makedirs(path_dir + suffix)
+        with open(os.path.join(path_dir + suffix, 'stale.npy'), 'w') as f:
+            f.write('stale')
+
+    rs.build_store(cn, path_dir)
+    assert not os.path.exists(path_dir + '.old')
+    assert not os.path.exists(path_dir + '.tmp')
+    assert 'stale.npy' not in os.listdir(path_dir)
+    assert rs.load_store(path_dir)['permnos'].tolist() == [10107, 14593]
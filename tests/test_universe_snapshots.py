@@ -0,0 +1,59 @@
+'''
+Monthly universe snapshots: every fetched month is logged, including months
+that return no rows, so reruns skip them; tables built before the log are
+backfilled from their membership rows.
+
+Author: Aaron M. Stahl (2024) // aaron.m.stahl@gmail.com // astahl3.github.io
+'''
+import sqlite3
+import pytest
+
+np = pytest.importorskip('numpy')
+pd = pytest.importorskip('pandas')
+pytest.importorskip('wrds')
+import market_calendar as mc
+import universe_snapshots as us
+
+@pytest.fixture
+def fetched(monkeypatch):
+    days = np.arange(np.datetime64('2020-01-01'), np.datetime64('2020-05-01'))
+    monkeypatch.setattr(mc, '_sessions', days[np.is_busday(days)])
+
+    # Server stand-in: one security in January only
+    fetched = []
+    def iter_snapshots(db, sessions):
+        fetched.extend(sessions)
+        rows = [s for s in sessions if s.month == 1]
+        yield pd.DataFrame({'marketdate': pd.to_datetime(rows),
+                            'permno': [14593] * len(rows),
+                            'dscode': ['992816'] * len(rows),
+                            'mktcap': [1.3e6] * len(rows),
+                            'primexchmnem': ['NASD'] * len(rows)})
+    monkeypatch.setattr(us, 'iter_snapshots', iter_snapshots)
+    return fetched
+
+def test_empty_months_are_not_fetched_again(fetched):
+    cn = sqlite3.connect(':memory:')
+    assert us.build_membership(None, cn, '2020-01-01', '2020-03-31') == 3
+    assert us.stored_months(cn) == {202001, 202002, 202003}
+    assert cn.execute(f"""SELECT month, n_rows FROM {us.snapshot_log_table}
+                          ORDER BY month""").fetchall() == \
+           [(202001, 1), (202002, 0), (202003, 0)]
+
+    # Only April is new on the rerun
+    del fetched[:]
+    assert us.build_membership(None, cn, '2020-01-01', '2020-04-30') == 1
+    assert [us.month_key(s) for s in fetched] == [202004]
+
+def test_log_backfilled_from_membership(fetched):
+    cn = sqlite3.connect(':memory:')
+    cn.execute(us.membership_schema)
+    cn.execute(f"""INSERT INTO {us.membership_table} (month, permno,
+                   snapshot_day) VALUES (202001, 14593, ?)""",
+               (mc.day_number('2020-01-02'),))
+    assert us.build_membership(None, cn, '2020-01-01', '2020-02-29') == 1
+    assert [us.month_key(s) for s in fetched] == [202002]
+
+def test_month_key_of_utc_timestamp():
+    assert us.month_key(1580515199) == 202001
+    assert us.month_key(1580515200) == 202002
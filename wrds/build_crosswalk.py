@@ -0,0 +1,115 @@
+'''
+Build a local crosswalk of security identifiers across CRSP and Datastream:
+
+    permno <-> cusip <-> cusip9 <-> isin <-> dscode
+
+CRSP (crsp_q_stock.stocknames_v2) identifies securities by permno and CUSIP,
+while Datastream (tr_ds_equities.wrds_ds_names) uses dscode and ISIN. The ISIN
+of a US security is 'US' + CUSIP9 + check digit, so the two tables are joined
+once on the ISIN computed from each CUSIP9 (wrds_sql.cusip9s_to_isins, one
+check-digit computation per distinct CUSIP9) and saved to an indexed SQLite
+table. Downstream resolution (e.g., the dscode of a post's security in
+create_performance_db.py) is then a local lookup instead of a WRDS query.
+
+The name tables are read from the local security master mirror when synced
+(sync_security_master.py --ds), otherwise from WRDS.
+
+Author: Aaron M. Stahl (2024) // aaron.m.stahl@gmail.com // astahl3.github.io
+'''
+import os
+import sqlite3
+import pandas as pd
+import wrds_sql as ws
+
+# Indexed crosswalk columns
+index_columns = ['permno', 'cusip', 'cusip9', 'isin', 'dscode']
+
+def get_crsp_links(db):
+    '''
+    Return one row per (permno, cusip9) from CRSP stocknames_v2 with the
+    first and last name dates and the latest ticker, plus the computed ISIN
+    '''
+    query = """
+            SELECT permno, permco, cusip, cusip9, ticker, namedt, nameenddt
+            FROM crsp_q_stock.stocknames_v2
+            WHERE cusip9 IS NOT NULL
+            """
+    names = ws.get_name_connection(db).raw_sql(query)
+    names = names.sort_values(['permno', 'cusip9', 'nameenddt'])
+
+    links = names.groupby(['permno', 'cusip9'], as_index=False) \
+                 .agg(permco=('permco', 'last'),
+                      cusip=('cusip', 'last'),
+                      crsp_ticker=('ticker', 'last'),
+                      crsp_startdate=('namedt', 'min'),
+                      crsp_enddate=('nameenddt', 'max'))
+    links['isin'] = ws.cusip9s_to_isins(links['cusip9'])
+    return links
+
+def get_ds_links(db):
+    '''
+    Return one row per (dscode, isin) of US securities from Datastream
+    wrds_ds_names with the latest name fields and the first and last dates
+    '''
+    query = f"""
+            SELECT {', '.join(ws.ds_name_fields)}, startdate, enddate
+            FROM tr_ds_equities.wrds_ds_names
+            WHERE isin LIKE 'US%'
+            """
+    names = ws.get_name_connection(db, 'tr_ds_equities').raw_sql(query)
+    names = names.sort_values(['dscode', 'isin', 'enddate'])
+
+    dates = names.groupby(['dscode', 'isin'], as_index=False) \
+                 .agg(ds_startdate=('startdate', 'min'),
+                      ds_enddate=('enddate', 'max'))
+    latest = names.drop_duplicates(['dscode', 'isin'], keep='last') \
+                  .drop(columns=['startdate', 'enddate'])
+    return latest.merge(dates, on=['dscode', 'isin'])
+
+def build_crosswalk(db):
+    '''
+    Join the CRSP and Datastream links on ISIN; CRSP securities without a
+    Datastream match are kept with an empty dscode
+    '''
+    return get_crsp_links(db).merge(get_ds_links(db), on='isin', how='left')
+
+def write_crosswalk(crosswalk, path_write=None):
+    '''
+    Write the crosswalk to a fresh SQLite file with an index on each
+    identifier column, then swap it in for the old one
+    '''
+    if path_write is None: path_write = ws.path_crosswalk_db
+    tmp_path = path_write + '.tmp'
+    if os.path.exists(tmp_path): os.remove(tmp_path)
+
+    cn = sqlite3.connect(tmp_path)
+    crosswalk.to_sql(ws.crosswalk_table, cn, index=False)
+    for col in index_columns:
+        cn.execute(f"""CREATE INDEX idx_{ws.crosswalk_table}_{col}
+                       ON {ws.crosswalk_table} ({col})""")
+    cn.commit()
+    cn.close()
+
+    os.replace(tmp_path, path_write)
+
+def main():
+
+    # Read the name tables from the local mirror if both are synced,
+    # otherwise from WRDS (or its stand-in)
+    mirror = ws.connect_local_mirror()
+    if mirror is not None and set(ws.mirror_libraries) <= \
+       set(mirror.libraries):
+        db = mirror
+    else:
+        db = ws.connect_wrds()
+
+    crosswalk = build_crosswalk(db)
+    db.close()
+
+    os.makedirs(os.path.dirname(ws.path_crosswalk_db), exist_ok=True)
+    write_crosswalk(crosswalk)
+    print(f"Wrote {len(crosswalk)} crosswalk rows "
+          f"({crosswalk['dscode'].notna().sum()} with a dscode)")
+
+if __name__ == "__main__":
+    main()
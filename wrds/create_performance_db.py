@@ -6,9 +6,9 @@ platform.
 Author: Aaron M. Stahl (2024) // aaron.m.stahl@gmail.com // astahl3.github.io 
 '''
 import pandas as pd
-import pandas_market_calendars as mcal
-import wrds
 import sqlite3
+import wrds_sql as ws
+import market_calendar as mc
 from datetime import datetime, timedelta
 
 # Global parameters
@@ -17,6 +17,24 @@ username = 'astahl3'
 # Desired table in local submission database
 submissions_table = "single_ticker_matches"
 return_table = "stock_performance"
+return_columns = ['id', 'created_utc', 'market_date', 'ticker', 'ticker_final',
+                  'dscode', 'ismajorsec', 'dsname', 'dsqtname', 'exchange',
+                  'ret_1m', 'ret_3m', 'ret_1y', 'added_day', 'next_end_day']
+
+# Horizons of ret_1m, ret_3m and ret_1y in calendar days after the market
+# date (rolled forward to a session)
+horizon_days = [30, 90, 365]
+
+# Latest available date ("lad") for Datastream return indices, which are
+# updated daily. Horizons ending after lad are left NULL; added_day records
+# the lad of the run that wrote a row and next_end_day the end of its first
+# horizon still after lad, so the row is pending again only once lad reaches
+# it. Posts without a resolvable security are written once with NULL returns.
+lad = (datetime.now() - timedelta(days=1)).date()
+lad_str = lad.strftime('%Y-%m-%d')
+
+# Entries per transaction when writing to the return table
+insert_batch_size = 200
 
 # Read and write paths for databases
 path_submissions_db_write = \
@@ -27,65 +45,6 @@ path_logfile_write = \
     "/Users/astahl/fin_nlp_data/reddit/logfiles/logfile"
 
 
-def cusip9_to_isin(cusip9, country_code='US'):
-    '''
-    Calculate the check digit for the security ISIN using the passed 'cusip9'
-    and (optional) 'country_code' via the Luhn algorithm and return the result
-    '''
-
-    base_isin = country_code + cusip9
-
-    # Convert letters to their ASCII numbers minus 55 (A = 10, B = 11, ...)
-    check_str = ''.join(str(int(char) if char.isdigit() else ord(char) - 55)
-                        for char in base_isin)
-
-    # Split into groups, with 1st, 3rd, 5th, ... digits to left group, and the
-    # 2nd, 4th, 6th, ... digits to right group. Then double the values in the
-    # group with the last digit and sum digits in each group
-    left_group = [int(check_str[i]) for i in range(0, len(check_str), 2)]
-    right_group = [int(check_str[i]) for i in range(1, len(check_str), 2)]
-
-    if len(check_str) % 2 == 0:
-        doubled_group = [sum(divmod(d * 2, 10)) for d in right_group]
-        unchanged_group = left_group
-    else:
-        # Odd length: double the left group
-        doubled_group = [sum(divmod(d * 2, 10)) for d in left_group]
-        unchanged_group = right_group
-
-    # Sum up digits in both groups, subtract modulus 10 of result for digit
-    totsum = sum(doubled_group) + sum(unchanged_group)
-    check_digit = (10 - (totsum % 10)) % 10
-    return base_isin + str(check_digit)
-
-
-def get_nearest_market_date(dt):
-    '''
-    Returns the nearest market date given the passed datetime 'dt' using the
-    New York Stock Exchange (NYSE) market calendar
-    '''
-    # Load the NYSE calendar
-    nyse = mcal.get_calendar('NYSE')
-
-    date_str = dt.strftime('%Y-%m-%d')
-
-    # Get the market schedule for a range around the date
-    start_range = (dt - timedelta(days=10)).strftime('%Y-%m-%d')
-    end_range = (dt + timedelta(days=10)).strftime('%Y-%m-%d')
-    schedule = nyse.schedule(start_date=start_range, end_date=end_range)
-    schedule['market_date'] = schedule['market_open'].dt.date
-
-    # Check if the given date is a market day
-    if date_str in schedule['market_date']:
-        return pd.Timestamp(dt)
-
-    # If given date is not a market day, return next market date if available
-    future_schedule = schedule[schedule.index > dt]
-    if future_schedule.empty:
-        return pd.Timestamp(schedule.index[-1])
-    else:
-        return pd.Timestamp(future_schedule.index[0])
-
 def are_returns_populated(conn, permno, start_date, end_date):
     '''
     Checks if there is a return in the desired time range; returns true
@@ -101,6 +60,62 @@ def are_returns_populated(conn, permno, start_date, end_date):
     ret_row = c_temp.fetchone()[0]
     return ret_row > 0
 
+def add_pending_columns(cn):
+    '''
+    Add the added_day and next_end_day columns to a return table created
+    before they existed
+    '''
+    columns = [r[1] for r in cn.execute(f"PRAGMA table_info({return_table})")]
+    with cn:
+        for col in ['added_day', 'next_end_day']:
+            if col not in columns:
+                cn.execute(f"ALTER TABLE {return_table} "
+                           f"ADD COLUMN {col} INTEGER")
+
+def load_pending_submissions(cn):
+    '''
+    Return the submissions still needing returns, with one anti-join instead
+    of a lookup per submission: those without a row in the return table,
+    those whose row has a NULL horizon that has since ended (next_end_day on
+    or before lad), and incomplete rows written before added_day was tracked
+    '''
+    source = submissions_table
+    if path_submissions_db_read != path_submissions_db_write:
+        cn.execute("ATTACH DATABASE ? AS source", (path_submissions_db_read,))
+        source = 'source.' + submissions_table
+
+    query = f"""
+            SELECT s.*
+            FROM {source} s
+            LEFT JOIN {return_table} p
+            ON p.id = s.id
+            WHERE p.id IS NULL
+            OR p.next_end_day <= ?
+            OR (p.added_day IS NULL
+                AND (p.ret_1m IS NULL OR p.ret_3m IS NULL
+                     OR p.ret_1y IS NULL))
+            """
+    return pd.read_sql_query(query, cn, params=(mc.day_number(lad),))
+
+def unresolved_entry(row, market_date):
+    '''
+    Return the return table entry of a post whose security could not be
+    resolved: NULL security fields and returns, so it is not looked up again
+    '''
+    entry = {'id': row['id'], 'created_utc': row['created_utc'],
+             'market_date': market_date, 'ticker': row['company_match'],
+             'added_day': mc.day_number(lad)}
+    return tuple(entry.get(col) for col in return_columns)
+
+def write_entries(conn, entries):
+    '''
+    Write a batch of return table entries (tuples in return_columns order)
+    in a single transaction
+    '''
+    with conn:
+        ws.bulk_insert(conn, return_table,
+                       pd.DataFrame(entries, columns=return_columns))
+
 def main():
     global path_logfile_write
 
@@ -117,14 +132,6 @@ def main():
         lf.write(f"********** Table read name: {submissions_table}\n")
         lf.write(f"********** Table write name: {return_table}\n\n")
 
-    # Load in the desired submissions database and store as a dataframe
-    conn = sqlite3.connect(path_submissions_db_read)
-    df = pd.read_sql_query(f"SELECT * FROM {submissions_table}", conn)
-    conn.close()
-
-    # Connect to the WRDS database
-    db = wrds.Connection(wrds_username=username)
-
     # Prepare to write to the SQlite database
     conn_out = sqlite3.connect(path_submissions_db_write)
     c = conn_out.cursor()
@@ -142,39 +149,48 @@ def main():
                   exchange TEXT,
                   ret_1m REAL,
                   ret_3m REAL,
-                  ret_1y REAL)
+                  ret_1y REAL,
+                  added_day INTEGER,
+                  next_end_day INTEGER)
               """)
     conn_out.commit()
+    add_pending_columns(conn_out)
+
+    # Load only the submissions still needing returns
+    df = load_pending_submissions(conn_out)
+    print(f"{len(df)} submissions need returns")
+    with open(path_logfile_write, 'a') as lf:
+        lf.write(f"Pending submissions: {len(df)}\n\n")
+    if df.empty:
+        conn_out.close()
+        return
 
-    # Iterate over submissions dataframe to populate new table
+    # Connect to the WRDS database
+    db = ws.connect_wrds()
+
+    # Map each post to its nearest market date, then resolve CRSP security
+    # info for all distinct (ticker, market date) pairs in bulk
+    df['market_date_dt'] = mc.nearest_sessions(df['created_utc'], unit='s')
+    df['market_date'] = df['market_date_dt'].dt.strftime('%Y-%m-%d')
+    names = ws.resolve_crsp_names(
+        db, df.rename(columns={'company_match': 'ticker'}))
+    name_groups = ws.group_crsp_names(names)
+    no_names = names.iloc[0:0]
+
+    # Iterate over submissions dataframe to collect the Datastream security
+    # and horizon dates of each post; posts without a unique security are
+    # recorded once with NULL returns
+    posts = []
+    unresolved = []
     for index, row in df.iterrows():
         ticker = row['company_match']
         post_date = datetime.utcfromtimestamp(row['created_utc'])
-        market_date_dt = get_nearest_market_date(post_date)
-        market_date = market_date_dt.strftime('%Y-%m-%d')
+        market_date_dt = row['market_date_dt']
+        market_date = row['market_date']
         market_date_day = datetime.date(market_date_dt)
 
-        # Skip row if this entry is already populated with returns
-        local_query = f"""
-                        SELECT ret_1m, ret_3m, ret_1y
-                        FROM '{return_table}'
-                        WHERE id = '{row['id']}'
-                        """
-        c.execute(local_query)
-        result = c.fetchone()
-        if result is not None and all(result):
-            print(f"Returns for {ticker} is already populated")
-            continue
-
-        # CRSP query
-        sql_query = f"""
-                    SELECT * 
-                    FROM crsp_q_stock.stocknames_v2
-                    WHERE ticker = '{ticker}'
-                    AND namedt <= '{market_date}'
-                    AND nameenddt >= '{market_date}'
-                    """
-        stockinfo_crsp = db.raw_sql(sql_query)
+        # CRSP security metainfo as of post date (resolved in bulk)
+        stockinfo_crsp = name_groups.get((ticker, market_date), no_names)
 
         # Skip to next entry if query result is empty; no result implies that
         # the ticker is likely invalid 
@@ -185,6 +201,7 @@ def main():
                 lf.write(f"Ticker = {ticker}\n")
                 lf.write(f"Post Date = {market_date}\n")
                 lf.write(f"Submission ID = {row['id']}\n\n")
+            unresolved.append(unresolved_entry(row, market_date))
             continue
 
         #  Skip to next entry if query result contains more than one row
@@ -195,19 +212,15 @@ def main():
                 lf.write(f"Ticker = {ticker}\n")
                 lf.write(f"Post Date = {market_date}\n")
                 lf.write(f"Submission ID = {row['id']}\n\n")
+            unresolved.append(unresolved_entry(row, market_date))
             continue
 
         crsp_cusip9 = stockinfo_crsp['cusip9'][0]
-        crsp_isin = cusip9_to_isin(crsp_cusip9)
-
-        # Get dscode for stock returns from Datastream
-        sql_query = f"""
-                    SELECT *
-                    FROM tr_ds_equities.wrds_ds_names
-                    WHERE isin = '{crsp_isin}'
-                    """
+        crsp_isin = ws.cusip9_to_isin(crsp_cusip9)
+
+        # Get dscode for stock returns from Datastream (local crosswalk)
         print(f"current isin = {crsp_isin}")
-        stockinfo_ds = db.raw_sql(sql_query)
+        stockinfo_ds = ws.get_ds_names_by_isin(db, crsp_isin)
 
         # Skip to next entry if query result is empty
         if stockinfo_ds.empty:
@@ -217,6 +230,7 @@ def main():
                 lf.write(f"Ticker: {ticker}\n")
                 lf.write(f"Post Date: {market_date}\n")
                 lf.write(f"Submission ID: {row['id']}\n\n")
+            unresolved.append(unresolved_entry(row, market_date))
             continue
 
         #  Skip to next entry if query result contains more than one row
@@ -228,6 +242,7 @@ def main():
                 lf.write(f"ISIN = {crsp_isin}\n")
                 lf.write(f"Post Date = {market_date}\n")
                 lf.write(f"Submission ID = {row['id']}\n\n")
+            unresolved.append(unresolved_entry(row, market_date))
             continue
 
         dscode = stockinfo_ds['dscode'][0]
@@ -247,9 +262,8 @@ def main():
         ticker_upd = ticker_upd.replace(' ', '')
 
         # Get 1 month, 3 months, 1 year returns
-        date_offsets = [30, 90, 365]
-        dates_dt = [market_date_dt + timedelta(dt) for dt in date_offsets]
-        mdates_dt = [get_nearest_market_date(d) for d in dates_dt]
+        dates_dt = [market_date_dt + timedelta(dt) for dt in horizon_days]
+        mdates_dt = mc.nearest_sessions(dates_dt)
         mdates_str = [d.strftime('%Y-%m-%d') for d in mdates_dt]
         mdates_str.insert(0, market_date)
 
@@ -258,9 +272,9 @@ def main():
         date_3m = market_date_dt + timedelta(days=90)
         date_1y = market_date_dt + timedelta(days=365)
         
-        md_1m = get_nearest_market_date(date_1m).date() 
-        md_3m = get_nearest_market_date(date_3m).date() 
-        md_1y = get_nearest_market_date(date_1y).date() 
+        md_1m = mc.get_nearest_market_date(date_1m).date() 
+        md_3m = mc.get_nearest_market_date(date_3m).date() 
+        md_1y = mc.get_nearest_market_date(date_1y).date() 
         
         md_1m_str = md_1m.strftime('%Y-%m-%d')
         md_3m_str = md_3m.strftime('%Y-%m-%d')
@@ -284,99 +298,91 @@ def main():
         ret_1y = ri_1y/ri_curr - 1
         '''
 
-        # Retrieve return indices over desired date range
-        sql_query = f"""
-                    SELECT ri, ri_usd, marketdate, close
-                    FROM tr_ds_equities.wrds_ds2dsf
-                    AND marketdate >= '{market_date}'
-                    AND marketdate <= '{mdates_str[-1]}'
-                    """
-
-        # Treat each date individually; returns may only exist for some ranges
-        retidx = []
-        for k in range(0, len(mdates_str)):
-
-            temp_date = mdates_str[k]
-
-            # Fetch performance data
-            print(f"Fetching data for {ticker} on {temp_date}...")
-            sql_query = f"""
-                        SELECT ri, ri_usd, marketdate, close
-                        FROM tr_ds_equities.wrds_ds2dsf
-                        WHERE dscode = '{dscode}'
-                        AND marketdate = '{temp_date}'
-                        """
-
-            returninfo = db.raw_sql(sql_query)
-
-            # Skip to next entry if stock return query result is empty
-            if returninfo.empty:
-                print(f"Return info is empty for {ticker} at offset {k}")
-                with open(path_logfile_write, 'a') as lf:
-                    lf.write("No match in Datastream: wrds_ds2dsf\n")
-                    lf.write(f"Ticker = {ticker}\n")
-                    lf.write(f"Post Date = {market_date}\n")
-                    lf.write(f"Submission ID = {row['id']}\n\n")
-
-                # Check last date available
-                sql_query = f"""
-                            SELECT ri, ri_usd, marketdate, close
-                            FROM tr_ds_equities.wrds_ds2dsf
-                            WHERE dscode = '{dscode}'
-                            AND marketdate <= '{temp_date}'
-                            AND marketdate >= '{mdates_str[0]}'
-                            ORDER BY marketdate DESC
-                            LIMIT 1
-                            """
-                returninfo = db.raw_sql(sql_query)
-                if returninfo.empty: ret_temp='Error'
-                else: ret_temp = returninfo['ri'][0]
-             
-                for i in range(k, len(mdates_str)):
-                    retidx.append(ret_temp)
-                    with open(path_logfile_write, 'a') as lf:
-                        lf.write("Incomplete return data:\n")
-                        lf.write(f"Ticker = {ticker}\n")
-                        lf.write(f"Post Date = {market_date}\n")
-                        last_date = returninfo['marketdate'][0]
-                        lf.write(f"Last Available Date (LAD) = {last_date}\n")
-                        lf.write(f"Entering LAD for offset {i}\n\n")
+        # Queue the post; return indices for all posts are fetched together
+        # after the loop
+        posts.append({'id': row['id'], 'created_utc': row['created_utc'],
+                      'market_date': market_date, 'ticker': ticker,
+                      'ticker_final': ticker_upd, 'dscode': dscode,
+                      'ismajorsec': ismajorsec, 'dsname': dsname,
+                      'dsqtname': dsqtname, 'exchange': exchange,
+                      'isin': crsp_isin, 'dates': mdates_str})
+
+    write_entries(conn_out, unresolved)
+
+    # Fetch the return index series of every dscode over the merged date
+    # range of its posts, in batched queries
+    ranges = {}
+    for post in posts:
+        start, end = post['dates'][0], post['dates'][-1]
+        if post['dscode'] in ranges:
+            prev_start, prev_end = ranges[post['dscode']]
+            start, end = min(start, prev_start), max(end, prev_end)
+        ranges[post['dscode']] = (start, end)
+    print(f"Fetching return indices for {len(ranges)} dscodes")
+    series = ws.get_ds_return_indices(
+        db, [(dscode, start, end) for dscode, (start, end) in ranges.items()])
+    series_groups = dict(tuple(series.groupby('dscode')))
+
+    # Resolve each post's horizon dates locally with as-of semantics: a date
+    # without data takes the last return index available since the post
+    pending = []
+    for post in posts:
+        group = series_groups.get(post['dscode'])
+        if group is None:
+            found = [(None, None)] * len(post['dates'])
+        else:
+            found = ws.asof_lookup(group['marketdate'], group['ri'],
+                                   post['dates'], floor=post['dates'][0])
+
+        for k, (target, (_, found_date)) in enumerate(zip(post['dates'],
+                                                          found)):
+            if target > lad_str: continue
+            if found_date is not None and \
+               found_date.strftime('%Y-%m-%d') == target:
                 continue
-
-            retidx.append(returninfo['ri'][0])
-
-        # Calculate returns
-        if retidx[1] is None: ret_1m = 'Error'
-        if retidx[2] is None: ret_3m = 'Error'
-        if retidx[3] is None: ret_1y = 'Error'
-        ret_1m = retidx[1]/retidx[0] - 1
-        ret_3m = retidx[2]/retidx[0] - 1
-        ret_1y = retidx[3]/retidx[0] - 1
-
-        # Insert the data into the SQLite database
-        c.execute(f"""INSERT OR REPLACE INTO {return_table} 
-                 (id, created_utc, market_date, ticker, ticker_final, dscode, 
-                  ismajorsec, dsname, dsqtname, exchange, 
-                  ret_1m, ret_3m, ret_1y) 
-                 VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
-                  (row['id'], row['created_utc'], market_date, ticker,
-                   ticker_upd, dscode, ismajorsec, dsname, dsqtname, exchange,
-                   ret_1m, ret_3m, ret_1y))
-        
-        conn_out.commit()
+            with open(path_logfile_write, 'a') as lf:
+                lf.write("Incomplete return data:\n")
+                lf.write(f"Ticker = {post['ticker']}\n")
+                lf.write(f"Post Date = {post['market_date']}\n")
+                lf.write(f"Last Available Date (LAD) = {found_date}\n")
+                lf.write(f"Entering LAD for offset {k}\n\n")
+
+        # Calculate returns; None where a return index is unavailable or the
+        # horizon ends after lad
+        retidx = [value for value, _ in found]
+        ret_1m, ret_3m, ret_1y = [
+            retidx[k] / retidx[0] - 1
+            if retidx[0] and retidx[k] is not None
+            and post['dates'][k] <= lad_str else None
+            for k in range(1, len(retidx))]
+        open_ends = [end for end in post['dates'][1:] if end > lad_str]
+        next_end_day = mc.day_number(open_ends[0]) if open_ends else None
+
+        # Queue the entry; entries are written to the SQLite database in
+        # batches with one transaction each
+        pending.append((post['id'], post['created_utc'], post['market_date'],
+                        post['ticker'], post['ticker_final'], post['dscode'],
+                        post['ismajorsec'], post['dsname'], post['dsqtname'],
+                        post['exchange'], ret_1m, ret_3m, ret_1y,
+                        mc.day_number(lad), next_end_day))
+        if len(pending) >= insert_batch_size:
+            write_entries(conn_out, pending)
+            pending = []
 
         # Print write info
-        print(f"wrote entry for {ticker} on {market_date}")
+        print(f"wrote entry for {post['ticker']} on {post['market_date']}")
         with open(path_logfile_write, 'a') as lf:
             lf.write("Wrote returns to database:\n")
-            lf.write(f"Ticker = {ticker}\n")
-            lf.write(f"Updated ticker = {ticker_upd}\n")
-            lf.write(f"ISIN = {crsp_isin}\n")
+            lf.write(f"Ticker = {post['ticker']}\n")
+            lf.write(f"Updated ticker = {post['ticker_final']}\n")
+            lf.write(f"ISIN = {post['isin']}\n")
             lf.write(f"1m = {ret_1m}, 3m = {ret_3m}, 1y = {ret_1y}\n")
-            lf.write(f"Post Date: {market_date}\n")
-            lf.write(f"Submission ID: {row['id']}\n\n")
+            lf.write(f"Post Date: {post['market_date']}\n")
+            lf.write(f"Submission ID: {post['id']}\n\n")
 
+    write_entries(conn_out, pending)
     conn_out.close()
+    db.close()
 
 
 if __name__ == "__main__":
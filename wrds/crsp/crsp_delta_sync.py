@@ -0,0 +1,136 @@
+'''
+Incremental refresh of the local CRSP returns database (stock_performance.db)
+when WRDS publishes a new quarterly update of crsp_q_stock.dsf.
+
+The latest available date ("lad") is read from WRDS. Permnos whose stored
+returns were cut off at the previous lad (their coverage reaches it) are
+extended from their last stored date through the new lad. The new rows are
+pulled with the same batched multi-permno queries as crsp_performance_db.py,
+so a quarterly refresh costs one query per batch of permnos instead of a full
+history per security. Permnos whose windows ended before the previous lad
+(e.g., delisted securities or old posts) are not touched.
+
+Each refresh updates crsp_securities.lastupd_day for the extended permnos and
+is recorded in the crsp_sync_log table.
+
+Usage:
+    python crsp_delta_sync.py         # extend permnos cut off at the old lad
+    python crsp_delta_sync.py --all   # extend every stored permno
+
+Author: Aaron M. Stahl (2024) // aaron.m.stahl@gmail.com // astahl3.github.io
+'''
+import sqlite3
+import sys
+from datetime import datetime, timedelta
+import wrds_sql as ws
+import crsp_performance_db as cpd
+import wrds_executor as we
+import market_calendar as mc
+import returns_store as rs
+
+# Table recording each refresh
+sync_log_table = "crsp_sync_log"
+
+def create_sync_log(cn):
+    ''' Create the sync log table if it does not exist '''
+    cn.execute(f"""
+               CREATE TABLE IF NOT EXISTS {sync_log_table} (
+                   synced_at TEXT,
+                   previous_lad DATE,
+                   lad DATE,
+                   n_permnos INTEGER,
+                   n_ranges INTEGER,
+                   n_rows INTEGER)
+               """)
+    cn.commit()
+
+def get_previous_lad(cn):
+    '''
+    Return the lad of the last refresh (from the sync log, else the latest
+    lastupd of the security table), or None for a database never synced
+    '''
+    c = cn.cursor()
+    c.execute(f"SELECT MAX(lad) FROM {sync_log_table}")
+    previous = c.fetchone()[0]
+    if previous is not None:
+        return datetime.strptime(str(previous)[:10], '%Y-%m-%d').date()
+
+    c.execute(f"SELECT MAX(lastupd_day) FROM {cpd.security_table}")
+    previous = c.fetchone()[0]
+    return mc.day_date(previous) if previous is not None else None
+
+def get_last_stored_dates(cn):
+    ''' Return a dict of permno -> last stored market date (as a date) '''
+    c = cn.cursor()
+    c.execute(f"""SELECT permno, MAX(mkt_day)
+                  FROM {cpd.performance_table}
+                  GROUP BY permno""")
+    return {permno: mc.day_date(last) for permno, last in c.fetchall()}
+
+def plan_delta(coverage, last_stored, previous_lad, new_lad,
+               all_permnos=False):
+    '''
+    Return the (permno, start, end) ranges extending each permno cut off at
+    'previous_lad' (every permno if 'all_permnos') through 'new_lad'
+    '''
+    plan = []
+    for permno in sorted(set(coverage) | set(last_stored)):
+        ends = [end for _, end in coverage.get(permno, [])]
+        if permno in last_stored: ends.append(last_stored[permno])
+        last = max(ends)
+        if not all_permnos and previous_lad is not None and \
+           last < previous_lad:
+            continue
+        start = last + timedelta(days=1)
+        if start <= new_lad: plan.append((permno, start, new_lad))
+    return plan
+
+def main():
+
+    all_permnos = '--all' in sys.argv[1:]
+
+    db = ws.connect_wrds()
+    new_lad = cpd.get_latest_available_date(db)
+    cpd.set_lad(new_lad)
+
+    cn = sqlite3.connect(cpd.path_submissions_db_write)
+    create_sync_log(cn)
+    cpd.create_local_tables(cn)
+
+    previous_lad = get_previous_lad(cn)
+    print(f"Previous lad: {previous_lad}; latest available: {new_lad}")
+
+    coverage = cpd.load_coverage(cn)
+    plan = plan_delta(coverage, get_last_stored_dates(cn), previous_lad,
+                      new_lad, all_permnos)
+    permnos = sorted({permno for permno, _, _ in plan})
+    print(f"Extending {len(permnos)} permnos through {new_lad}")
+
+    # Pull only the new rows, in batched multi-permno queries
+    executor = we.QueryExecutor(connection=db)
+    n_rows = cpd.fetch_planned_returns(db, cn, plan, coverage, executor)
+    executor.close()
+    cpd.fetch_market_index(db, cn)
+    db.close()
+
+    # Mark the extended securities as updated and record the refresh
+    with cn:
+        cn.executemany(f"""UPDATE {cpd.security_table}
+                           SET lastupd_day = ? WHERE permno = ?""",
+                       [(mc.day_number(cpd.lad), permno)
+                        for permno in permnos])
+        cn.execute(f"""INSERT INTO {sync_log_table}
+                       (synced_at, previous_lad, lad, n_permnos, n_ranges,
+                        n_rows)
+                       VALUES (?, ?, ?, ?, ?, ?)""",
+                   (datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+                    previous_lad.strftime('%Y-%m-%d') if previous_lad
+                    else None, cpd.lad_str, len(permnos), len(plan), n_rows))
+
+    # Rebuild the memory-mapped returns store from the updated table
+    rs.build_store(cn)
+    cn.close()
+    print(f"Wrote {n_rows} new returns for {len(permnos)} permnos")
+
+if __name__ == "__main__":
+    main()
@@ -2,7 +2,8 @@
 This program creates a database of US stock performance for securities that
 appear in posts submitted across investing-related subreddits. Performance
 history is queried from the Wharton Research Data Services (WRDS) API using
-the CRSP security tables (crsp_q_stock: dsf, stocknames_v2).
+the CRSP security tables (crsp_q_stock: dsf, stocknames_v2), along with the
+CRSP daily market index series (dsi) used as abnormal return benchmarks.
 
 Resulting database is part of the larger fin_nlp project, where the merit
 of investment or trade ideas communicated on social media are assessed.
@@ -11,9 +12,11 @@ Author: Aaron M. Stahl (2024) // aaron.m.stahl@gmail.com // astahl3.github.io
 '''
 
 import pandas as pd
-import pandas_market_calendars as mcal
-import wrds
 import sqlite3
+import wrds_sql as ws
+import wrds_executor as we
+import market_calendar as mc
+import returns_store as rs
 from datetime import datetime, timedelta
 
 # Global parameters
@@ -23,6 +26,12 @@ username = 'astahl3'
 submissions_table = "single_ticker_matches"
 security_table = "crsp_securities"
 performance_table = "crsp_returns"
+coverage_table = "crsp_coverage"
+market_table = "crsp_market_index"
+
+# CRSP daily market index series stored locally: value- and equal-weighted
+# returns including distributions, and the S&P 500 return
+market_columns = ['vwretd', 'ewretd', 'sprtrn']
  
 # Read and write paths for databases
 path_submissions_db_write = \
@@ -36,23 +45,117 @@ path_logfile_write = \
 # Start date for performance and return data
 start_dt = datetime(year=2012, month=1, day=1).strftime('%Y-%m-%d')
 
-# Latest available date ("lad") for CRSP stock data
+# Latest available date ("lad") for CRSP stock data; replaced by the latest
+# date in crsp_q_stock.dsi once connected (see get_latest_available_date)
 lad = datetime(year=2024, month=3, day=28).date()
 lad_str = lad.strftime('%Y-%m-%d')
 
+# Window of daily returns needed around each post: calendar days before the
+# post (covering the 250-session beta estimation window of returns_engine.py),
+# and after it through the longest return horizon (365 days, plus slack for
+# rolling the horizon end forward to a market date)
+lookback_days = 372
+max_horizon_days = 372
+
+# Permno date ranges per batched dsf query
+fetch_batch_size = 50
+
+# Local table schemas: permnos are INTEGER and dates are integer day numbers
+# (market_calendar.day_number). Each table has a view (<table>_iso) showing
+# the day columns as ISO dates under their former names (day_columns).
+local_schemas = {
+    security_table: f"""
+        CREATE TABLE IF NOT EXISTS {security_table} (
+            permno INTEGER PRIMARY KEY,
+            cusip9 TEXT,
+            ticker TEXT,
+            issuernm TEXT,
+            primaryexch TEXT,
+            securitytype TEXT,
+            securitysubtype TEXT,
+            lastupd_day INTEGER)
+        """,
+    performance_table: f"""
+        CREATE TABLE IF NOT EXISTS {performance_table} (
+            permno INTEGER,
+            hsiccd INTEGER,
+            mkt_day INTEGER,
+            numtrd REAL,
+            ret REAL,
+            shrout REAL,
+            vol REAL,
+            cum_idx REAL,
+            FOREIGN KEY (permno) REFERENCES {security_table}(permno),
+            PRIMARY KEY (permno, mkt_day))
+        WITHOUT ROWID
+        """,
+    coverage_table: f"""
+        CREATE TABLE IF NOT EXISTS {coverage_table} (
+            permno INTEGER,
+            start_day INTEGER,
+            end_day INTEGER,
+            PRIMARY KEY (permno, start_day))
+        WITHOUT ROWID
+        """,
+    market_table: f"""
+        CREATE TABLE IF NOT EXISTS {market_table} (
+            mkt_day INTEGER PRIMARY KEY,
+            vwretd REAL,
+            ewretd REAL,
+            sprtrn REAL)
+        WITHOUT ROWID
+        """,
+}
+day_columns = {security_table: {'lastupd_day': 'lastupd'},
+               performance_table: {'mkt_day': 'mkt_date'},
+               coverage_table: {'start_day': 'start_date',
+                                'end_day': 'end_date'},
+               market_table: {'mkt_day': 'mkt_date'}}
+
+# Return of a permno after :start through :end from the cumulative return
+# index (cum_idx) of the last stored rows on or before each date
+period_return_sql = f"""
+    SELECT e.cum_idx / s.cum_idx - 1
+    FROM (SELECT cum_idx FROM {performance_table}
+          WHERE permno = :permno AND mkt_day <= :start
+          ORDER BY mkt_day DESC LIMIT 1) s,
+         (SELECT cum_idx FROM {performance_table}
+          WHERE permno = :permno AND mkt_day <= :end
+          ORDER BY mkt_day DESC LIMIT 1) e
+    """
+
+def get_latest_available_date(db):
+    """
+    Returns the latest date in the CRSP daily market index file (dsi, one row
+    per session of the daily stock file, so much cheaper to scan than dsf),
+    or the hard-coded 'lad' if the query returns nothing
+    """
+    result = db.raw_sql("SELECT MAX(date) AS lad FROM crsp_q_stock.dsi")
+    if result.empty or pd.isna(result['lad'].iloc[0]): return lad
+    return pd.Timestamp(result['lad'].iloc[0]).date()
+
+def set_lad(new_lad):
+    """ Set the latest available date used for fetches and security info """
+    global lad, lad_str
+    lad = new_lad
+    lad_str = lad.strftime('%Y-%m-%d')
+
+current_ticker_sql = """
+    SELECT permno, ticker
+    FROM crsp_q_stock.stocknames_v2
+    WHERE permno {match}
+    AND namedt <= :lad
+    AND nameenddt >= :lad
+    ORDER BY permno, namedt
+    """
+
 def get_current_ticker(db, permno):
     """
     Returns current ticker (as of desired through-date 'lad') for given permno
     """
-    query = f"""
-            SELECT *
-            FROM crsp_q_stock.stocknames_v2
-            WHERE permno = '{permno}'
-            AND namedt <= '{lad_str}'
-            AND nameenddt >= '{lad_str}'
-            """
-    
-    nameinfo = db.raw_sql(query)
+    nameinfo = ws.run_query(ws.get_name_connection(db),
+                            current_ticker_sql.format(match='= :permno'),
+                            {'permno': int(permno), 'lad': lad_str})
     
     # If no current ticker for permno, security no longer trading, use NA
     if nameinfo.empty: return 'NONE'
@@ -61,89 +164,323 @@ def get_current_ticker(db, permno):
     if nameinfo.shape[0] > 1: nameinfo = nameinfo.tail(1)
 
     return nameinfo['ticker'].iloc[0]    
-    
-def cusip9_to_isin(cusip9, country_code='US'):
+
+def get_current_tickers(db, permnos):
     """
-    Calculate the check digit for the security ISIN using the passed 'cusip9'
-    and (optional) 'country_code' via the Luhn algorithm and return the result
+    Returns a dict of permno (int) -> current ticker as of 'lad' for many
+    permnos, with one query per chunk of permnos; permnos no longer trading
+    are absent
     """
+    nameinfo = ws.run_query_chunked(
+        ws.get_name_connection(db),
+        current_ticker_sql.format(match='= ANY(:permnos)'),
+        {'permnos': [int(p) for p in permnos], 'lad': lad_str}, 'permnos')
+
+    # Keep the last entry per permno, as in get_current_ticker
+    return {int(permno): ticker for permno, ticker
+            in zip(nameinfo['permno'], nameinfo['ticker'])}
+    
+def is_stockinfo_updated(cn, permno, desired_update_dt):
+    '''
+    Checks if the lastupd field for the security info matches the end date
+    '''
+    
+    query = f""" SELECT lastupd_day FROM {security_table} WHERE permno = ? """
+    c_temp = cn.cursor()
+    c_temp.execute(query, (permno))
+    return c_temp.fetchone()
 
-    base_isin = country_code + cusip9
-
-    # Convert letters to their ASCII numbers minus 55 (A = 10, B = 11, ...)
-    check_str = ''.join(str(int(char) if char.isdigit() else ord(char) - 55)
-                        for char in base_isin)
-
-    # Split into groups, with 1st, 3rd, 5th, ... digits to left group, and the
-    # 2nd, 4th, 6th, ... digits to right group. Then double the values in the
-    # group with the last digit and sum digits in each group
-    left_group = [int(check_str[i]) for i in range(0, len(check_str), 2)]
-    right_group = [int(check_str[i]) for i in range(1, len(check_str), 2)]
-
-    if len(check_str) % 2 == 0:
-        doubled_group = [sum(divmod(d * 2, 10)) for d in right_group]
-        unchanged_group = left_group
-    else:
-        # Odd length: double the left group
-        doubled_group = [sum(divmod(d * 2, 10)) for d in left_group]
-        unchanged_group = right_group
-
-    # Sum up digits in both groups, subtract modulus 10 of result for digit
-    totsum = sum(doubled_group) + sum(unchanged_group)
-    check_digit = (10 - (totsum % 10)) % 10
-    return base_isin + str(check_digit)
+def merge_intervals(intervals):
+    """
+    Merge overlapping or adjacent (start, end) date intervals and return them
+    sorted by start date
+    """
+    merged = []
+    for start, end in sorted(intervals):
+        if merged and start <= merged[-1][1] + timedelta(days=1):
+            if end > merged[-1][1]: merged[-1] = (merged[-1][0], end)
+        else:
+            merged.append((start, end))
+    return merged
+
+def subtract_intervals(intervals, covered):
+    """
+    Return the parts of the merged 'intervals' not covered by the merged
+    'covered' intervals (both sorted lists of (start, end) dates)
+    """
+    missing = []
+    for start, end in intervals:
+        for cov_start, cov_end in covered:
+            if cov_end < start or cov_start > end: continue
+            if cov_start > start:
+                missing.append((start, cov_start - timedelta(days=1)))
+            start = cov_end + timedelta(days=1)
+            if start > end: break
+        if start <= end: missing.append((start, end))
+    return missing
+
+def post_window(market_date_dt):
+    """
+    Return the (start, end) dates of daily returns needed for a post on
+    'market_date_dt', clipped to the range of available CRSP data
+    """
+    first_dt = datetime.strptime(start_dt, '%Y-%m-%d').date()
+    post_dt = market_date_dt.date()
+    start = max(post_dt - timedelta(days=lookback_days), first_dt)
+    end = min(post_dt + timedelta(days=max_horizon_days), lad)
+    return (start, end)
 
-def get_nearest_market_date(dt):
+def load_coverage(cn):
+    """
+    Return a dict of permno -> merged (start, end) date ranges already fetched
+    into the local returns table. Permnos fetched before coverage was tracked
+    are assumed covered from their first to their last stored return.
+    """
+    c_temp = cn.cursor()
+    c_temp.execute(f"""
+                   INSERT INTO {coverage_table} (permno, start_day, end_day)
+                   SELECT permno, MIN(mkt_day), MAX(mkt_day)
+                   FROM {performance_table}
+                   WHERE permno NOT IN (SELECT permno FROM {coverage_table})
+                   GROUP BY permno
+                   """)
+    cn.commit()
+
+    coverage = {}
+    c_temp.execute(f"""SELECT permno, start_day, end_day
+                       FROM {coverage_table}""")
+    for permno, start, end in c_temp.fetchall():
+        coverage.setdefault(permno, []).append((mc.day_date(start),
+                                                mc.day_date(end)))
+    return {permno: merge_intervals(ivs) for permno, ivs in coverage.items()}
+
+def plan_fetches(windows, coverage):
     """
-    Returns the nearest market date given the passed datetime 'dt' using the
-    New York Stock Exchange (NYSE) market calendar
+    Return the (permno, start, end) date ranges to fetch: per permno, the
+    union of the post 'windows' minus the ranges in 'coverage'
     """
-    # Load the NYSE calendar
-    nyse = mcal.get_calendar('NYSE')
+    plan = []
+    for permno, intervals in sorted(windows.items()):
+        missing = subtract_intervals(merge_intervals(intervals),
+                                     coverage.get(permno, []))
+        plan.extend((permno, start, end) for start, end in missing)
+    return plan
+
+def returns_batch_query(ranges):
+    """
+    Return the (query, params) pair fetching daily returns for several
+    (permno, start, end) ranges from crsp_q_stock.dsf in a single query
+    """
+    params = {}
+    conditions = []
+    for j, (permno, start, end) in enumerate(ranges):
+        params[f'p{j}'] = int(permno)
+        params[f's{j}'] = start.strftime('%Y-%m-%d')
+        params[f'e{j}'] = end.strftime('%Y-%m-%d')
+        conditions.append(f'(permno = :p{j} AND date BETWEEN :s{j} AND :e{j})')
 
-    date_str = dt.strftime('%Y-%m-%d')
+    query = f"""
+            SELECT permno, date, hsiccd, numtrd, ret, shrout, vol
+            FROM crsp_q_stock.dsf
+            WHERE {' OR '.join(conditions)}
+            """
+    return query, params
 
-    # Get the market schedule for a range around the date
-    start_range = (dt - timedelta(days=10)).strftime('%Y-%m-%d')
-    end_range = (dt + timedelta(days=10)).strftime('%Y-%m-%d')
-    schedule = nyse.schedule(start_date=start_range, end_date=end_range)
-    schedule['market_date'] = schedule['market_open'].dt.date
+def fetch_missing_returns(db, cn, windows, executor=None):
+    """
+    Fetch the daily returns missing locally for the post 'windows' (dict of
+    permno -> list of (start, end) dates) in batched multi-permno queries,
+    and record the fetched ranges in the coverage table. If a QueryExecutor
+    is passed, batches are fetched concurrently on its connection pool.
+    Returns the number of return rows written.
+    """
+    coverage = load_coverage(cn)
+    plan = plan_fetches(windows, coverage)
+    print(f"Fetching {len(plan)} date ranges for {len(windows)} permnos")
+    return fetch_planned_returns(db, cn, plan, coverage, executor)
 
-    # Check if the given date is a market day
-    if date_str in schedule['market_date']:
-        return pd.Timestamp(dt)
+def fetch_planned_returns(db, cn, plan, coverage, executor=None):
+    """
+    Fetch the planned (permno, start, end) date ranges in batched queries and
+    write the returns, their cumulative index, and the merged 'coverage'
+    (dict of permno -> merged ranges, updated in place). Returns the number
+    of return rows written.
+    """
+    columns = ['permno', 'hsiccd', 'mkt_day', 'numtrd', 'ret', 'shrout',
+               'vol']
+    batches = [plan[i:i + fetch_batch_size]
+               for i in range(0, len(plan), fetch_batch_size)]
+    group_size = executor.workers if executor is not None else 1
 
-    # If given date is not a market day, return next market date if available
-    future_schedule = schedule[schedule.index > dt]
-    if future_schedule.empty:
-        return pd.Timestamp(schedule.index[-1])
-    else:
-        return pd.Timestamp(future_schedule.index[0])
+    n_rows = 0
+    c_temp = cn.cursor()
+    for g in range(0, len(batches), group_size):
+        group = batches[g:g + group_size]
+        queries = [returns_batch_query(batch) for batch in group]
+        if executor is not None: results = executor.map(queries)
+        else: results = [ws.run_query(db, *queries[0])]
+
+        for batch, returninfo in zip(group, results):
+            returninfo['mkt_day'] = mc.day_numbers(returninfo['date'])
+            returninfo['permno'] = returninfo['permno'].astype('int64')
+
+            # Write the returns, their cumulative index, and the updated
+            # coverage in one transaction
+            with cn:
+                n_batch = ws.bulk_insert(c_temp, performance_table,
+                                         returninfo, columns)
+                for permno in {r[0] for r in batch}:
+                    fetched = [(s, e) for p, s, e in batch if p == permno]
+                    update_cum_idx(c_temp, permno,
+                                   mc.day_number(min(s for s, _ in fetched)))
+                    merged = merge_intervals(coverage.get(permno, []) +
+                                             fetched)
+                    coverage[permno] = merged
+                    c_temp.execute(f"""DELETE FROM {coverage_table}
+                                       WHERE permno = ?""", (permno,))
+                    c_temp.executemany(
+                        f"""INSERT INTO {coverage_table}
+                            (permno, start_day, end_day) VALUES (?, ?, ?)""",
+                        [(permno, mc.day_number(s), mc.day_number(e))
+                         for s, e in merged])
+
+            n_rows += n_batch
+        print(f"Wrote returns for {min(g + group_size, len(batches))} of "
+              f"{len(batches)} batches")
+
+    return n_rows
+
+def update_cum_idx(c, permno, from_day):
+    """
+    Recompute the cumulative return index of a permno for all stored rows
+    dated on or after day number 'from_day', continuing from the index of the
+    last row before it (or from 1 if there is none). Appends only touch the
+    new rows; back-fills rescale the rows after them. A missing ret counts as
+    a zero return, so the index carries through the day unchanged.
+    """
+    c.execute(f"""
+              SELECT cum_idx
+              FROM {performance_table}
+              WHERE permno = ? AND mkt_day < ?
+              ORDER BY mkt_day DESC
+              LIMIT 1
+              """, (permno, from_day))
+    row = c.fetchone()
+    cum = row[0] if row is not None and row[0] is not None else 1.0
 
-def are_returns_populated(cn, permno, start_date, end_date):
+    c.execute(f"""
+              SELECT mkt_day, ret
+              FROM {performance_table}
+              WHERE permno = ? AND mkt_day >= ?
+              ORDER BY mkt_day
+              """, (permno, from_day))
+    updates = []
+    for mkt_day, ret in c.fetchall():
+        cum *= 1.0 + (ret if ret is not None else 0.0)
+        updates.append((cum, permno, mkt_day))
+    c.executemany(f"""
+                  UPDATE {performance_table}
+                  SET cum_idx = ?
+                  WHERE permno = ? AND mkt_day = ?
+                  """, updates)
+
+def fetch_market_index(db, cn):
     """
-    Checks if there is a return in the desired time range; returns true
-    if there is a single return within the range
+    Fetch the CRSP daily market index series (crsp_q_stock.dsi) after the last
+    stored day through lad in one query. Returns the number of rows written.
     """
-    
+    c_temp = cn.cursor()
+    c_temp.execute(f"SELECT MAX(mkt_day) FROM {market_table}")
+    last_day = c_temp.fetchone()[0]
+    if last_day is None: start = start_dt
+    else: start = mc.day_date(last_day + 1).strftime('%Y-%m-%d')
+
     query = f"""
-            SELECT COUNT(*) FROM {performance_table}
-            WHERE permno = ? and mkt_date BETWEEN ? AND ?
+            SELECT date, {', '.join(market_columns)}
+            FROM crsp_q_stock.dsi
+            WHERE date BETWEEN :start AND :end
             """
+    market = ws.run_query(db, query, {'start': start, 'end': lad_str})
+    market['mkt_day'] = mc.day_numbers(market.pop('date'))
+    with cn:
+        return ws.bulk_insert(cn, market_table, market,
+                              ['mkt_day'] + market_columns)
+
+def fill_cum_idx(cn):
+    """ Compute the cumulative return index of every stored permno """
     c_temp = cn.cursor()
-    c_temp.execute(query, (permno, start_date, end_date))
-    ret_row = c_temp.fetchone()[0]
-    return ret_row > 0
+    with cn:
+        c_temp.execute(f"""SELECT permno, MIN(mkt_day)
+                           FROM {performance_table}
+                           GROUP BY permno""")
+        for permno, first_day in c_temp.fetchall():
+            update_cum_idx(cn.cursor(), permno, first_day)
+
+def add_cum_idx_column(cn):
+    """
+    Add the cum_idx column to a returns table created before the column
+    existed, and fill it for every stored permno. A rowid table gets a
+    covering index for cum_idx lookups; a WITHOUT ROWID table is already
+    clustered on (permno, mkt_day), so the index is dropped there.
+    """
+    c_temp = cn.cursor()
+    c_temp.execute(f"PRAGMA table_info({performance_table})")
+    if 'cum_idx' not in [r[1] for r in c_temp.fetchall()]:
+        c_temp.execute(f"""ALTER TABLE {performance_table}
+                           ADD COLUMN cum_idx REAL""")
+        fill_cum_idx(cn)
+
+    c_temp.execute("SELECT sql FROM sqlite_master WHERE name = ?",
+                   (performance_table,))
+    if 'WITHOUT ROWID' in c_temp.fetchone()[0].upper():
+        c_temp.execute(f"DROP INDEX IF EXISTS idx_{performance_table}_cum")
+    else:
+        c_temp.execute(f"""
+                       CREATE INDEX IF NOT EXISTS idx_{performance_table}_cum
+                       ON {performance_table} (permno, mkt_day, cum_idx)
+                       """)
+    cn.commit()
+
+def create_local_tables(cn):
+    """
+    Create the security, returns, coverage and market index tables and their
+    ISO date views. Tables with the former schema (TEXT permnos and dates)
+    are migrated in place, and the file is compacted afterwards.
+    """
+    migrated = False
+    for table, create_sql in local_schemas.items():
+        old_columns = ws.create_local_table(cn, table, create_sql,
+                                            day_columns[table], ('permno',))
+        if old_columns is None: continue
+        migrated = True
+        print(f"Migrated {table} to integer permnos and day numbers")
+        if table == performance_table and 'cum_idx' not in old_columns:
+            fill_cum_idx(cn)
+
+    add_cum_idx_column(cn)
+    if migrated: cn.execute("VACUUM")
+
+def period_return(cn, permno, start_date, end_date):
+    """
+    Return the compounded return of a permno after 'start_date' through
+    'end_date' from two cum_idx lookups, or None if the stored returns do not
+    cover the whole window (cum_idx is only comparable within one range of
+    the coverage table)
+    """
+    start_day = mc.day_number(start_date)
+    end_day = mc.day_number(end_date)
 
-def is_stockinfo_updated(cn, permno, desired_update_dt):
-    '''
-    Checks if the lastupd field for the security info matches the end date
-    '''
-    
-    query = f""" SELECT lastupd FROM {security_table} WHERE permno = ? """
     c_temp = cn.cursor()
-    c_temp.execute(query, (permno))
-    return c_temp.fetchone()
+    c_temp.execute(f"""
+                   SELECT COUNT(*) FROM {coverage_table}
+                   WHERE permno = ? AND start_day <= ? AND end_day >= ?
+                   """, (int(permno), start_day, end_day))
+    if c_temp.fetchone()[0] == 0: return None
+
+    c_temp.execute(period_return_sql, {'permno': int(permno),
+                                       'start': start_day, 'end': end_day})
+    row = c_temp.fetchone()
+    return row[0] if row is not None else None
 
 def main():
     global path_logfile_write
@@ -167,55 +504,51 @@ def main():
     conn.close()
 
     # Connect to the WRDS database
-    db = wrds.Connection(wrds_username=username)
+    db = ws.connect_wrds()
+    set_lad(get_latest_available_date(db))
 
     # Prepare to write to the SQlite security and performance tables
     conn_out = sqlite3.connect(path_submissions_db_write)
     c = conn_out.cursor()
-    c.execute(f"""
-              CREATE TABLE IF NOT EXISTS {security_table} (
-                  permno TEXT PRIMARY KEY,
-                  cusip9 TEXT,
-                  ticker TEXT,
-                  issuernm TEXT,
-                  primaryexch TEXT,
-                  securitytype TEXT,
-                  securitysubtype TEXT,
-                  lastupd DATE)
-              """)
-    
-    c.execute(f"""
-              CREATE TABLE IF NOT EXISTS {performance_table} (
-                  permno TEXT,
-                  hsiccd INTEGER,
-                  mkt_date DATE,
-                  numtrd REAL,
-                  ret REAL,
-                  shrout REAL,
-                  vol REAL,
-                  FOREIGN KEY (permno) REFERENCES {security_table}(permno),
-                  PRIMARY KEY (permno, mkt_date))
-              """)              
-    conn_out.commit()
+    create_local_tables(conn_out)
+
+    # Map each post to its nearest market date. Posts matched point-in-time
+    # carry their permno, whose security info is looked up by permno; CRSP
+    # security info of the others is resolved in bulk for their distinct
+    # (ticker, market date) pairs
+    df['market_date_dt'] = mc.nearest_sessions(df['created_utc'], unit='s')
+    df['market_date'] = df['market_date_dt'].dt.strftime('%Y-%m-%d')
+    if 'permno' in df: has_permno = df['permno'].notna()
+    else: has_permno = pd.Series(False, index=df.index)
+    names = ws.resolve_crsp_names(
+        db, df[~has_permno].rename(columns={'company_match': 'ticker'}))
+    name_groups = ws.group_crsp_names(names)
+    no_names = names.iloc[0:0]
+    permno_names = ws.get_crsp_names_by_permno(db, df.loc[has_permno,
+                                                          'permno'].unique())
+    permno_groups = {int(permno): rows.tail(1) for permno, rows
+                     in permno_names.groupby('permno', sort=False)}
+
+    # Current tickers of all resolved permnos, in bulk
+    current_tickers = get_current_tickers(
+        db, set(names['permno'].astype(int)) | set(permno_groups))
 
     # Iterate over submissions dataframe to populate new table
     count = 0
+    windows = {}
     for index, row in df.iterrows():
         ticker = row['company_match']
         post_date = datetime.utcfromtimestamp(row['created_utc'])
-        market_date_dt = get_nearest_market_date(post_date)
-        market_date = market_date_dt.strftime('%Y-%m-%d')
+        market_date_dt = row['market_date_dt']
+        market_date = row['market_date']
         update_info = True
         
-        # CRSP query for security metainfo as of post date
-        sql_query = f"""
-                    SELECT * 
-                    FROM crsp_q_stock.stocknames_v2
-                    WHERE ticker = '{ticker}'
-                    AND namedt <= '{market_date}'
-                    AND nameenddt >= '{market_date}'
-                    """
-        stockinfo_crsp = db.raw_sql(sql_query)
+        # CRSP security metainfo of the stored permno, otherwise as of post
+        # date by ticker (resolved in bulk)
+        if has_permno[index]:
+            stockinfo_crsp = permno_groups.get(int(row['permno']), no_names)
+        else:
+            stockinfo_crsp = name_groups.get((ticker, market_date), no_names)
 
         # Skip to next entry if query result is empty; no result implies the
         # ticker is probably invalid or not traded on a conventional exchange
@@ -241,22 +574,22 @@ def main():
             #stockinfo_crsp = stockinfo_crsp.tail(1).reset_index(drop=True)
             stockinfo_crsp = stockinfo_crsp.tail(1)
 
-        crsp_permno = str(stockinfo_crsp['permno'].iloc[0])
+        crsp_permno = int(stockinfo_crsp['permno'].iloc[0])
         
         # If permno already up-to-date in table, skip to next submission
         local_query = f"""
-                        SELECT lastupd
+                        SELECT lastupd_day
                         FROM {security_table}
-                        WHERE permno = '{crsp_permno}'
+                        WHERE permno = ?
                         """
-        c.execute(local_query)
+        c.execute(local_query, (crsp_permno,))
         result = c.fetchone()
         
         # Logic sequence for if permno is already populated in security db
         if result is not None:
             print(f"Stockinfo for permno = {crsp_permno} already exists")
 
-            lastupd_temp = datetime.strptime(result[0], '%Y-%m-%d').date()
+            lastupd_temp = mc.day_date(result[0])
             with open(path_logfile_write, 'a') as lf:
                 lf.write(f"Info for permno = {crsp_permno} already exists\n")
                 lf.write(f"Last updated on {lastupd_temp}\n\n")
@@ -276,14 +609,14 @@ def main():
                 crsp_securitytype = stockinfo_crsp['securitytype'].iloc[0]
                 crsp_securitysubtype = stockinfo_crsp['securitysubtype'].iloc[0]
                 crsp_issuernm = stockinfo_crsp['issuernm'].iloc[0]
-                crsp_currticker = get_current_ticker(db, crsp_permno)        
+                crsp_currticker = current_tickers.get(crsp_permno, 'NONE')
     
             
                 # Commit security info to SQlite table
                 insert_text = f"""
                             INSERT INTO {security_table} 
                             (permno, cusip9, ticker, issuernm, primaryexch, 
-                             securitytype, securitysubtype, lastupd)
+                             securitytype, securitysubtype, lastupd_day)
                             VALUES (?, ?, ?, ?, ?, ?, ?, ?)
                             ON CONFLICT(permno) DO UPDATE SET
                                 cusip9 = excluded.cusip9,
@@ -292,12 +625,12 @@ def main():
                                 primaryexch = excluded.primaryexch,
                                 securitytype = excluded.securitytype,
                                 securitysubtype = excluded.securitysubtype,
-                                lastupd = excluded.lastupd
+                                lastupd_day = excluded.lastupd_day
                                 """
                 c.execute(insert_text, 
                           (crsp_permno, crsp_cusip9, crsp_currticker, 
                            crsp_issuernm, crsp_primaryexch, crsp_securitytype, 
-                           crsp_securitysubtype, lad))
+                           crsp_securitysubtype, mc.day_number(lad)))
                 
                 conn_out.commit()
                 
@@ -320,59 +653,29 @@ def main():
                     lf.write(f"Post Date: {market_date}\n")
                     lf.write(f"Submission ID: {row['id']}\n\n")
 
-            # UPDATE PERFORMANCE TABLE
-            print(f"Checking if returns for {crsp_permno} are populated...")
-            
-            # If at least one performance row exists in range, skip iteration
-            if are_returns_populated(conn_out, crsp_permno, start_dt, lad_str):
-                print(f"Returns for {crsp_permno} already in db, skipping...")
-                with open(path_logfile_write, 'a') as lf:
-                    lf.write(f"Skipping {crsp_permno}, already in perf db\n\n")
-                continue
-    
-            else:
-                
-                # Get all returns from start date through current date
-                sql_query = f"""
-                        SELECT date, hsiccd, numtrd, ret, shrout, vol
-                        FROM crsp_q_stock.dsf
-                        WHERE permno = '{crsp_permno}'
-                        AND date >= '{start_dt}'
-                        AND date <= '{lad}'
-                        """
-            
-                returninfo = db.raw_sql(sql_query)
-                print(f"Pulled return info for {ticker} on {market_date}")
-                
-                # Update database with returns
-                insert_text = f"""
-                                INSERT OR REPLACE INTO {performance_table}
-                                (permno, hsiccd, mkt_date, numtrd, ret,
-                                 shrout, vol)
-                                VALUES (?, ?, ?, ?, ?, ?, ?)
-                                """
-            
-                for idx, r in returninfo.iterrows():
-                    c.execute(insert_text, (crsp_permno, r['hsiccd'], r['date'], 
-                                            r['numtrd'], r['ret'], r['shrout'], 
-                                            r['vol']))    
-                
-                conn_out.commit()
-    
-            # Print write info
-            print(f"Wrote returns for {ticker} starting on {market_date}")
-            with open(path_logfile_write, 'a') as lf:
-                lf.write("Wrote returns to database:\n")
-                lf.write(f"Ticker = {ticker}\n")
-                lf.write(f"Updated ticker = {crsp_currticker}\n")
-                lf.write(f"Post Date: {market_date}\n")
-                lf.write(f"Submission ID: {row['id']}\n\n")
-            
+        # Record the window of returns needed for this post; returns are
+        # fetched after the loop for all permnos at once
+        windows.setdefault(crsp_permno, []).append(post_window(market_date_dt))
         count += 1
         print(f"count = {count}")
-        with open(path_logfile_write, 'a') as lf:
-            lf.write("********** Program complete \n")
-            lf.write(f"********** Returns populated for {count} tickers \n\n")
+
+    # Fetch the returns missing locally for the merged post windows, with
+    # independent batches running concurrently on a small connection pool
+    executor = we.QueryExecutor(connection=db)
+    n_rows = fetch_missing_returns(db, conn_out, windows, executor)
+    executor.close()
+
+    # Extend the market index series used as abnormal return benchmarks
+    n_market = fetch_market_index(db, conn_out)
+    print(f"Wrote {n_market} market index rows")
+
+    # Rebuild the memory-mapped returns store from the updated table
+    rs.build_store(conn_out)
+    with open(path_logfile_write, 'a') as lf:
+        lf.write("********** Program complete \n")
+        lf.write(f"********** Returns windows planned for {count} posts \n")
+        lf.write(f"********** Returns populated for {len(windows)} permnos "
+                 f"({n_rows} rows) \n\n")
 
     conn_out.close()
 
@@ -0,0 +1,156 @@
+'''
+Precomputed New York Stock Exchange (NYSE) trading calendar. The full array of
+NYSE sessions from 2005 through a year past today is built once with
+pandas_market_calendars and cached on disk. Timestamps are then mapped to
+sessions with numpy.searchsorted, either one at a time or as whole arrays.
+
+Conventions:
+- A timestamp maps to its own date if that date is a session, otherwise to
+  the next session (weekends and holidays roll forward); time of day is
+  ignored
+- Session arithmetic ("k trading days after") works on session indexes, so
+  add_trading_days(dt, 0) is the nearest session and k < 0 steps backwards
+- Dates after the last cached session, and sessions shifted outside the
+  calendar, map to NaT rather than to the nearest end of the calendar
+
+The cache is rebuilt when it no longer extends past today.
+
+Dates in the local CRSP and submission databases are stored as integer day
+numbers (days since 1970-01-01, the integer value of numpy datetime64[D]);
+day_number, day_numbers and day_date convert to and from them.
+
+Author: Aaron M. Stahl (2024) // aaron.m.stahl@gmail.com // astahl3.github.io
+'''
+import os
+from datetime import datetime, timedelta
+import numpy as np
+import pandas as pd
+
+# Range of the precomputed calendar; sessions after today are included so
+# return horizons of recent posts can be mapped (future holidays are known)
+calendar_start = '2005-01-01'
+calendar_future_days = 400
+
+# Cached session array (numpy datetime64[D], sorted)
+path_calendar_cache = "/Users/astahl/fin_nlp_data/wrds/nyse_sessions.npy"
+
+# Loaded session array (populated on first use)
+_sessions = None
+
+# Day number zero of the integer date columns
+epoch = datetime(year=1970, month=1, day=1).date()
+
+def build_sessions():
+    ''' Return the NYSE sessions over the calendar range as datetime64[D] '''
+    import pandas_market_calendars as mcal
+
+    end = datetime.now().date() + timedelta(days=calendar_future_days)
+    nyse = mcal.get_calendar('NYSE')
+    schedule = nyse.schedule(start_date=calendar_start,
+                             end_date=end.strftime('%Y-%m-%d'))
+    return schedule.index.values.astype('datetime64[D]')
+
+def load_sessions():
+    '''
+    Return the NYSE session array, loading it from the disk cache on first use
+    and rebuilding the cache if it does not extend past today
+    '''
+    global _sessions
+    if _sessions is not None: return _sessions
+
+    today = np.datetime64(datetime.now().date(), 'D')
+    sessions = None
+    if os.path.exists(path_calendar_cache):
+        sessions = np.load(path_calendar_cache)
+        if sessions.size == 0 or sessions[-1] <= today: sessions = None
+
+    if sessions is None:
+        sessions = build_sessions()
+        os.makedirs(os.path.dirname(path_calendar_cache), exist_ok=True)
+        tmp_path = path_calendar_cache + '.tmp.npy'
+        np.save(tmp_path, sessions)
+        os.replace(tmp_path, path_calendar_cache)
+
+    _sessions = sessions
+    return _sessions
+
+def to_days(dts, unit=None):
+    '''
+    Convert a scalar or array of datetimes, dates, ISO strings or Timestamps
+    (or posix utc timestamps with unit='s') to a datetime64[D] array
+    '''
+    dts = pd.to_datetime(np.atleast_1d(dts), unit=unit)
+    return np.asarray(dts.values).astype('datetime64[D]')
+
+def day_numbers(dts, unit=None):
+    '''
+    Convert a scalar or array of dates (as in to_days) to an int64 array of
+    day numbers; posix utc timestamps (unit='s') map to their utc date
+    '''
+    return to_days(dts, unit).astype(np.int64)
+
+def day_number(dt):
+    ''' Return the day number of a date, datetime, ISO string or Timestamp '''
+    return int(day_numbers(dt)[0])
+
+def day_date(n):
+    ''' Return the date of day number 'n' '''
+    return epoch + timedelta(days=int(n))
+
+def session_index(dts, unit=None):
+    '''
+    Return the index in the session array of the nearest session on or after
+    each date in 'dts'; dates after the last session of the calendar get
+    the past-the-end index (the number of sessions)
+    '''
+    sessions = load_sessions()
+    return np.searchsorted(sessions, to_days(dts, unit), side='left')
+
+def sessions_at(idx):
+    '''
+    Return the sessions at the indexes 'idx' as a DatetimeIndex, NaT for
+    indexes outside the calendar
+    '''
+    sessions = load_sessions()
+    idx = np.asarray(idx)
+    valid = (idx >= 0) & (idx < sessions.size)
+    days = np.where(valid, sessions[np.where(valid, idx, 0)],
+                    np.datetime64('NaT', 'D'))
+    return pd.DatetimeIndex(days)
+
+def nearest_sessions(dts, unit=None):
+    '''
+    Map each date in 'dts' to its nearest session (same day if a session,
+    else the next one) and return a DatetimeIndex; NaT for dates after the
+    end of the calendar
+    '''
+    return sessions_at(session_index(dts, unit))
+
+def add_trading_days(dts, k, unit=None):
+    '''
+    Return the session 'k' trading days after the nearest session of each date
+    in 'dts' (k may be an int or an array broadcastable against 'dts'); NaT
+    where that session is outside the calendar
+    '''
+    idx = session_index(dts, unit)
+    past_end = idx == load_sessions().size
+    return sessions_at(np.where(past_end, -1, idx + np.asarray(k)))
+
+def trading_days_between(start_dts, end_dts):
+    '''
+    Return the number of trading days from the nearest session of each start
+    date to the nearest session of each end date; NaN where either date is
+    after the end of the calendar
+    '''
+    start_idx = session_index(start_dts)
+    end_idx = session_index(end_dts)
+    n_sessions = load_sessions().size
+    valid = (start_idx < n_sessions) & (end_idx < n_sessions)
+    return np.where(valid, end_idx - start_idx, np.nan)
+
+def get_nearest_market_date(dt):
+    '''
+    Returns the nearest market date (as a Timestamp) for the passed datetime
+    'dt' using the NYSE market calendar
+    '''
+    return nearest_sessions(dt)[0]
@@ -0,0 +1,365 @@
+'''
+Vectorized forward-return engine for the local CRSP returns table
+(crsp_returns in stock_performance.db, filled by crsp_performance_db.py).
+
+Each permno's daily returns are loaded once and turned into a cumulative
+log-return array with a leading zero, so the compounded return over any
+window of rows is a difference of two array entries:
+
+    cum[k] = sum(log(1 + ret[0:k]))
+    return over rows i..j-1 = exp(cum[j] - cum[i]) - 1
+
+Windows are located with numpy.searchsorted on each permno's date array, so
+the returns of every post for every horizon are computed with a handful of
+array operations per permno rather than one query and a Python product per
+post and horizon.
+
+A window (start, end] covers the returns dated after the start session
+through the end session, matching a buy at the close of the post's market
+date. Missing daily returns count as zero. A window gives NaN, not a partial
+return, unless it lies inside one range of the coverage table (crsp_coverage:
+the date ranges fetched per permno), since the rows on either side of a gap
+between fetched ranges are not consecutive sessions. Without coverage, only
+windows that end after the last stored return of a permno give NaN.
+
+Returns are read from the SQLite table or, if built, from the memory-mapped
+returns store of returns_store.py.
+
+Horizons are given as name -> (kind, n), where kind is 'calendar' (n calendar
+days after the market date, rolled forward to a session) or 'trading' (n
+trading days after the market date).
+
+Abnormal returns use the CRSP market index series (crsp_q_stock.dsi: vwretd,
+ewretd, sprtrn) stored in crsp_market_index, held in the same (dates, cum)
+form keyed by series name, so benchmark returns over every post's windows
+come from the same array lookups:
+
+    market-adjusted = r - r_m
+    beta-adjusted   = r - beta * r_m
+
+over the same window, with beta estimated by OLS of the security's daily
+returns on the benchmark's over the beta_window sessions through the market
+date (from cumulative sums of r, r_m, r_m^2 and r * r_m, so every post's
+beta is also a difference of array entries).
+
+Author: Aaron M. Stahl (2024) // aaron.m.stahl@gmail.com // astahl3.github.io
+'''
+import numpy as np
+import pandas as pd
+import market_calendar as mc
+import returns_store as rs
+
+# Local returns table
+returns_table = "crsp_returns"
+
+# Permnos per query when loading returns
+load_chunk_size = 500
+
+# Local coverage table of the date ranges fetched per permno
+coverage_table = "crsp_coverage"
+
+# Local market index table and its return series
+market_table = "crsp_market_index"
+market_series = ['vwretd', 'ewretd', 'sprtrn']
+default_benchmark = 'vwretd'
+
+# Sessions of daily returns through the market date used to estimate betas,
+# and the fewest sessions with a return for an estimate
+beta_window = 250
+beta_min_obs = 60
+
+# Default horizons of the submissions performance table
+default_horizons = {'return_1mo': ('calendar', 30),
+                    'return_2mo': ('calendar', 60),
+                    'return_3mo': ('calendar', 90),
+                    'return_6mo': ('calendar', 182),
+                    'return_12mo': ('calendar', 365)}
+
+def load_returns(cn, permnos=None):
+    '''
+    Load daily returns (permno, mkt_date, ret) from the local returns table
+    for the given permnos (all permnos if None), sorted by permno and date
+    '''
+    query = f"SELECT permno, mkt_day, ret FROM {returns_table}"
+    if permnos is None:
+        returns = pd.read_sql_query(query, cn)
+    else:
+        permnos = sorted({int(p) for p in permnos})
+        chunks = []
+        for i in range(0, len(permnos), load_chunk_size):
+            chunk = permnos[i:i + load_chunk_size]
+            placeholders = ', '.join('?' * len(chunk))
+            chunks.append(pd.read_sql_query(
+                query + f" WHERE permno IN ({placeholders})", cn,
+                params=chunk))
+        if chunks: returns = pd.concat(chunks, ignore_index=True)
+        else: returns = pd.DataFrame(columns=['permno', 'mkt_day', 'ret'])
+
+    # Day numbers to dates; permnos as strings, the keys of the return index
+    returns['mkt_date'] = returns.pop('mkt_day').values.astype(np.int64) \
+                          .astype('datetime64[D]')
+    returns['permno'] = returns['permno'].astype('int64').astype(str)
+    return returns.sort_values(['permno', 'mkt_date'], ignore_index=True)
+
+def build_return_index(returns):
+    '''
+    Build the per-permno arrays from a returns DataFrame (permno, mkt_date,
+    ret) sorted by permno and date. Returns a dict of permno -> (dates,
+    cum), with 'dates' as datetime64[D] and 'cum' the cumulative log returns
+    with a leading zero (len(cum) = len(dates) + 1).
+    '''
+    dates = pd.to_datetime(returns['mkt_date']).values.astype('datetime64[D]')
+    log_ret = np.log1p(pd.to_numeric(returns['ret'], errors='coerce')
+                       .fillna(0.0).values)
+
+    index = {}
+    for permno, rows in returns.groupby('permno', sort=False).indices.items():
+        cum = np.empty(len(rows) + 1)
+        cum[0] = 0.0
+        np.cumsum(log_ret[rows], out=cum[1:])
+        index[permno] = (dates[rows], cum)
+    return index
+
+def build_return_index_from_store(store, permnos=None):
+    '''
+    Build the same per-permno arrays as build_return_index directly from the
+    memory-mapped returns store (see returns_store.py), for the given permnos
+    (all permnos in the store if None)
+    '''
+    if permnos is None: permnos = store['permnos']
+
+    index = {}
+    for permno in {str(p) for p in permnos}:
+        block = rs.get_block(store, permno)
+        if block is None or block['session'].size == 0: continue
+        cum = np.empty(block['ret'].size + 1)
+        cum[0] = 0.0
+        np.cumsum(np.log1p(np.nan_to_num(block['ret'])), out=cum[1:])
+        index[permno] = (rs.session_dates(block['session']), cum)
+    return index
+
+def load_coverage(cn, permnos=None):
+    '''
+    Load the fetched date ranges of the given permnos (all permnos if None)
+    from the local coverage table as a dict of permno -> (range starts, range
+    ends), datetime64[D] arrays of the merged ranges sorted by start; None if
+    no coverage table is stored
+    '''
+    exists = cn.execute("SELECT 1 FROM sqlite_master WHERE name = ?",
+                        (coverage_table,)).fetchone()
+    if exists is None: return None
+    coverage = pd.read_sql_query(f"""
+                                 SELECT permno, start_day, end_day
+                                 FROM {coverage_table}
+                                 ORDER BY permno, start_day
+                                 """, cn)
+    coverage['permno'] = coverage['permno'].astype('int64').astype(str)
+    if permnos is not None:
+        coverage = coverage[coverage['permno'].isin(
+            {str(int(p)) for p in permnos})]
+
+    ranges = {}
+    for permno, group in coverage.groupby('permno', sort=False):
+        starts = group['start_day'].values.astype(np.int64)
+        ends = np.maximum.accumulate(group['end_day'].values.astype(np.int64))
+
+        # Merge overlapping or adjacent ranges, as crsp_performance_db does
+        first = np.concatenate(([True], starts[1:] > ends[:-1] + 1))
+        last = np.concatenate((first[1:], [True]))
+        ranges[permno] = (starts[first].astype('datetime64[D]'),
+                          ends[last].astype('datetime64[D]'))
+    return ranges
+
+def covered_windows(ranges, starts, ends):
+    '''
+    Return a boolean array, True where the window from 'starts' through
+    'ends' lies inside one of the (range starts, range ends) 'ranges'
+    '''
+    range_starts, range_ends = ranges
+    k = np.searchsorted(range_starts, starts, side='right') - 1
+    return (k >= 0) & (range_ends[np.maximum(k, 0)] >= ends)
+
+def period_returns(index, permnos, start_dates, end_dates, coverage=None):
+    '''
+    Return the compounded returns over the windows (start, end] for arrays of
+    permnos and start/end dates; NaN for unknown permnos, for windows that
+    end after the last stored return and, with a 'coverage' dict (see
+    load_coverage), for windows not inside one covered range. Permnos without
+    coverage ranges are taken as covered from their first to their last
+    stored return.
+    '''
+    permnos = pd.Series(np.asarray(permnos).astype(str))
+    starts = mc.to_days(start_dates)
+    ends = mc.to_days(end_dates)
+    out = np.full(len(permnos), np.nan)
+
+    for permno, rows in permnos.groupby(permnos).indices.items():
+        entry = index.get(permno)
+        if entry is None: continue
+        dates, cum = entry
+
+        i = np.searchsorted(dates, starts[rows], side='right')
+        j = np.searchsorted(dates, ends[rows], side='right')
+        result = np.expm1(cum[j] - cum[i])
+        result[(ends[rows] > dates[-1]) | np.isnat(starts[rows]) |
+               np.isnat(ends[rows])] = np.nan
+        if coverage is not None:
+            ranges = coverage.get(permno, (dates[:1], dates[-1:]))
+            result[~covered_windows(ranges, starts[rows],
+                                    ends[rows])] = np.nan
+        out[rows] = result
+    return out
+
+def horizon_end_dates(market_dates, horizons=None):
+    '''
+    Return a dict of horizon name -> end session (datetime64[D] array) for an
+    array of market dates
+    '''
+    if horizons is None: horizons = default_horizons
+    market_dates = mc.to_days(market_dates)
+
+    ends = {}
+    for name, (kind, n) in horizons.items():
+        if kind == 'calendar':
+            target = market_dates + np.timedelta64(n, 'D')
+            ends[name] = mc.to_days(mc.nearest_sessions(target))
+        elif kind == 'trading':
+            ends[name] = mc.to_days(mc.add_trading_days(market_dates, n))
+        else:
+            raise ValueError(f"Unknown horizon kind '{kind}' for {name}")
+    return ends
+
+def forward_returns(index, permnos, market_dates, horizons=None,
+                    coverage=None):
+    '''
+    Compute the forward returns of posts with the given permnos and market
+    dates for every horizon; returns a DataFrame with one column per horizon
+    '''
+    ends = horizon_end_dates(market_dates, horizons)
+    return pd.DataFrame({name: period_returns(index, permnos, market_dates,
+                                              end_dates, coverage)
+                         for name, end_dates in ends.items()})
+
+def load_market_index(cn):
+    '''
+    Load the market index series from the local market table and return them
+    in the form of the return index, as a dict of series name -> (dates, cum)
+    (empty if no market index is stored)
+    '''
+    exists = cn.execute("SELECT 1 FROM sqlite_master WHERE name = ?",
+                        (market_table,)).fetchone()
+    if exists is None: return {}
+    market = pd.read_sql_query(f"""
+                               SELECT mkt_day, {', '.join(market_series)}
+                               FROM {market_table}
+                               ORDER BY mkt_day
+                               """, cn)
+    if market.empty: return {}
+    dates = market['mkt_day'].values.astype(np.int64).astype('datetime64[D]')
+
+    index = {}
+    for name in market_series:
+        cum = np.empty(len(market) + 1)
+        cum[0] = 0.0
+        np.cumsum(np.log1p(market[name].fillna(0.0).values), out=cum[1:])
+        index[name] = (dates, cum)
+    return index
+
+def benchmark_returns(market_index, market_dates, horizons=None,
+                      benchmark=None):
+    '''
+    Compute the 'benchmark' series' returns over every horizon after each of
+    the market dates; returns a DataFrame with one column per horizon
+    '''
+    if benchmark is None: benchmark = default_benchmark
+    ends = horizon_end_dates(market_dates, horizons)
+    keys = np.full(len(mc.to_days(market_dates)), benchmark)
+    return pd.DataFrame({name: period_returns(market_index, keys,
+                                              market_dates, end_dates)
+                         for name, end_dates in ends.items()})
+
+def estimate_betas(index, market_index, permnos, market_dates,
+                   benchmark=None, coverage=None):
+    '''
+    Estimate the beta on the 'benchmark' series of each permno from its daily
+    returns over the beta_window sessions through each market date; NaN for
+    unknown permnos, for fewer than beta_min_obs returns, and without a stored
+    benchmark series. With a 'coverage' dict (see load_coverage), the sessions
+    are limited to the covered range holding the market date, and the beta is
+    NaN if no range holds it.
+    '''
+    if benchmark is None: benchmark = default_benchmark
+    permnos = pd.Series(np.asarray(permnos).astype(str))
+    days = mc.to_days(market_dates)
+    out = np.full(len(permnos), np.nan)
+    if benchmark not in market_index: return out
+
+    market_dates_m, market_cum = market_index[benchmark]
+    market_ret = np.expm1(np.diff(market_cum))
+
+    for permno, rows in permnos.groupby(permnos).indices.items():
+        entry = index.get(permno)
+        if entry is None: continue
+        dates, cum = entry
+
+        # Align the benchmark to the permno's dates; days without a
+        # benchmark return are left out of the sums
+        pos = np.minimum(np.searchsorted(market_dates_m, dates),
+                         market_ret.size - 1)
+        valid = market_dates_m[pos] == dates
+        m = np.where(valid, market_ret[pos], 0.0)
+        r = np.where(valid, np.expm1(np.diff(cum)), 0.0)
+
+        # Cumulative sums with a leading zero: n, m, r, m^2, m * r
+        sums = np.zeros((5, dates.size + 1))
+        for k, x in enumerate((valid.astype(float), m, r, m * m, m * r)):
+            np.cumsum(x, out=sums[k, 1:])
+
+        j = np.searchsorted(dates, days[rows], side='right')
+        i = np.maximum(j - beta_window, 0)
+        covered = np.ones(len(rows), dtype=bool)
+        if coverage is not None:
+            # Do not sum across a gap: start no earlier than the first
+            # session of the covered range holding the market date
+            ranges = coverage.get(permno, (dates[:1], dates[-1:]))
+            covered = covered_windows(ranges, days[rows], days[rows])
+            k = np.searchsorted(ranges[0], days[rows], side='right') - 1
+            i = np.maximum(i, np.searchsorted(dates,
+                                              ranges[0][np.maximum(k, 0)]))
+        n, sm, sr, smm, smr = sums[:, j] - sums[:, i]
+        var = n * smm - sm * sm
+        with np.errstate(divide='ignore', invalid='ignore'):
+            beta = (n * smr - sm * sr) / var
+        beta[(n < beta_min_obs) | (var <= 0) | ~covered] = np.nan
+        out[rows] = beta
+    return out
+
+def abnormal_column(name, prefix='abnormal'):
+    ''' Return the abnormal return column of horizon 'name' '''
+    return name.replace('return', prefix, 1)
+
+def abnormal_returns(index, market_index, permnos, market_dates,
+                     horizons=None, benchmark=None, beta_adjusted=False,
+                     coverage=None):
+    '''
+    Compute the forward returns of posts for every horizon along with their
+    market-adjusted abnormal returns (abnormal_*) against the 'benchmark'
+    series and, if 'beta_adjusted', the beta and beta-adjusted abnormal
+    returns (beta_abnormal_*); returns a DataFrame with those columns
+    '''
+    if horizons is None: horizons = default_horizons
+    perf = forward_returns(index, permnos, market_dates, horizons, coverage)
+    market = benchmark_returns(market_index, market_dates, horizons,
+                               benchmark)
+
+    for name in horizons:
+        perf[abnormal_column(name)] = perf[name] - market[name]
+
+    if beta_adjusted:
+        beta = estimate_betas(index, market_index, permnos, market_dates,
+                              benchmark, coverage)
+        perf['beta'] = beta
+        for name in horizons:
+            perf[abnormal_column(name, 'beta_abnormal')] = \
+                perf[name] - beta * market[name]
+    return perf
@@ -0,0 +1,175 @@
+'''
+Memory-mapped columnar store of the daily CRSP returns held in the crsp_returns
+table of stock_performance.db. The rows of each permno are kept as one
+contiguous block, sorted by date, in a set of flat numpy arrays:
+
+- session.npy (int32): index of the date in the NYSE session array of
+  market_calendar.py
+- ret.npy, vol.npy, shrout.npy (float64): daily return, volume and shares
+  outstanding (NaN where missing)
+- permnos.npy (int64) and offsets.npy (int64): the sorted permnos and the
+  start of each permno's block (offsets[i]:offsets[i + 1])
+
+The arrays are opened with numpy memory mapping, so loading the store reads
+almost nothing. Blocks and date windows are returned as zero-copy slices of
+the mapped arrays.
+
+The store is rebuilt from the SQLite table with build_store (run at the end
+of crsp_performance_db.py, or by running this file).
+
+Author: Aaron M. Stahl (2024) // aaron.m.stahl@gmail.com // astahl3.github.io
+'''
+import json
+import os
+import shutil
+import sqlite3
+import numpy as np
+import pandas as pd
+import market_calendar as mc
+
+# Version of the store layout; bump whenever the arrays below change
+store_version = 1
+
+# File paths for the returns database and the store directory
+path_returns_db = \
+    "/Users/astahl/fin_nlp_data/sqlite/wrds/stock_performance.db"
+path_store_dir = "/Users/astahl/fin_nlp_data/wrds/returns_store"
+
+# Local returns table and the value columns kept in the store
+returns_table = "crsp_returns"
+value_columns = ['ret', 'vol', 'shrout']
+
+def store_exists(path_dir=None):
+    ''' Return True if a store of the current version exists '''
+    if path_dir is None: path_dir = path_store_dir
+    path_meta = os.path.join(path_dir, 'meta.json')
+    if not os.path.exists(path_meta): return False
+    with open(path_meta, 'r') as f:
+        meta = json.load(f)
+    return meta.get('version') == store_version and \
+           meta.get('calendar_start') == mc.calendar_start
+
+def build_store(cn, path_dir=None):
+    '''
+    Rebuild the store from the returns table on connection 'cn'. The arrays
+    are written to a temporary directory which then replaces the old store.
+    '''
+    if path_dir is None: path_dir = path_store_dir
+
+    returns = pd.read_sql_query(f"""
+                                SELECT permno, mkt_day, ret, vol, shrout
+                                FROM {returns_table}
+                                ORDER BY permno, mkt_day
+                                """, cn)
+
+    # Map day numbers to session indexes; drop the (rare) non-session dates
+    sessions = mc.load_sessions()
+    days = returns['mkt_day'].values.astype(np.int64).astype('datetime64[D]')
+    session = np.searchsorted(sessions, days)
+    valid = (session < sessions.size) & \
+            (sessions[np.minimum(session, sessions.size - 1)] == days)
+    if not valid.all():
+        print(f"Dropping {int((~valid).sum())} returns on non-session dates")
+
+    permno = returns['permno'].astype(np.int64).values[valid]
+    permnos, starts = np.unique(permno, return_index=True)
+    offsets = np.append(starts, permno.size).astype(np.int64)
+
+    arrays = {'permnos': permnos,
+              'offsets': offsets,
+              'session': session[valid].astype(np.int32)}
+    for col in value_columns:
+        arrays[col] = pd.to_numeric(returns[col], errors='coerce') \
+                      .values.astype(np.float64)[valid]
+
+    # Directories left by an interrupted build are cleared first
+    tmp_dir = path_dir + '.tmp'
+    old_dir = path_dir + '.old'
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    shutil.rmtree(old_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+    for name, array in arrays.items():
+        np.save(os.path.join(tmp_dir, name + '.npy'), array)
+    with open(os.path.join(tmp_dir, 'meta.json'), 'w') as f:
+        json.dump({'version': store_version,
+                   'calendar_start': mc.calendar_start,
+                   'n_rows': int(permno.size),
+                   'n_permnos': int(permnos.size)}, f)
+
+    # Swap the new store in for the old one
+    if os.path.exists(path_dir): os.replace(path_dir, old_dir)
+    os.replace(tmp_dir, path_dir)
+    shutil.rmtree(old_dir, ignore_errors=True)
+
+def load_store(path_dir=None):
+    '''
+    Open the store with memory mapping and return a dict of the arrays, with
+    'lookup' mapping each permno to its position in 'permnos'
+    '''
+    if path_dir is None: path_dir = path_store_dir
+    if not store_exists(path_dir):
+        raise FileNotFoundError(f"No returns store found at {path_dir}")
+
+    store = {}
+    for name in ['permnos', 'offsets', 'session'] + value_columns:
+        store[name] = np.load(os.path.join(path_dir, name + '.npy'),
+                              mmap_mode='r')
+    store['lookup'] = {int(p): i for i, p in enumerate(store['permnos'])}
+    return store
+
+def get_block(store, permno):
+    '''
+    Return the block of a permno as a dict of zero-copy views (session and
+    the value columns), or None if the permno is not in the store
+    '''
+    i = store['lookup'].get(int(permno))
+    if i is None: return None
+    start, end = store['offsets'][i], store['offsets'][i + 1]
+    return {name: store[name][start:end]
+            for name in ['session'] + value_columns}
+
+def get_window(store, permno, start_date, end_date):
+    '''
+    Return the rows of a permno dated from 'start_date' through 'end_date'
+    (inclusive) as a dict of zero-copy views, or None if not in the store
+    '''
+    block = get_block(store, permno)
+    if block is None: return None
+    sessions = mc.load_sessions()
+    lo = np.searchsorted(sessions, mc.to_days(start_date)[0], side='left')
+    hi = np.searchsorted(sessions, mc.to_days(end_date)[0], side='right') - 1
+    i = np.searchsorted(block['session'], lo, side='left')
+    j = np.searchsorted(block['session'], hi, side='right')
+    return {name: values[i:j] for name, values in block.items()}
+
+def session_dates(session):
+    ''' Convert session indexes to dates (datetime64[D]) '''
+    return mc.load_sessions()[np.asarray(session)]
+
+def to_frame(store, permno, start_date=None, end_date=None):
+    '''
+    Return the rows of a permno (optionally within a date window) as a
+    DataFrame with mkt_date and the value columns, for analysis scripts
+    '''
+    if start_date is None: block = get_block(store, permno)
+    else: block = get_window(store, permno, start_date, end_date)
+    if block is None:
+        return pd.DataFrame(columns=['mkt_date'] + value_columns)
+
+    frame = pd.DataFrame({'mkt_date': session_dates(block['session'])})
+    for col in value_columns:
+        frame[col] = block[col]
+    return frame
+
+def main():
+
+    cn = sqlite3.connect(path_returns_db)
+    build_store(cn)
+    cn.close()
+
+    store = load_store()
+    print(f"Stored {store['session'].size} returns for "
+          f"{store['permnos'].size} permnos in {path_store_dir}")
+
+if __name__ == "__main__":
+    main()
@@ -4,15 +4,22 @@ datasets, focusing on US-listed stock names and returns in Datastream and CRSP.
 
 Author: Aaron M. Stahl (2024) // aaron.m.stahl@gmail.com // astahl3.github.io 
 '''
-import wrds
+import wrds_cache as wc
 import create_performance_db as pdb
+import wrds_sql as ws
 from datetime import datetime, timedelta
 
 # Global parameters
 username = 'astahl3'
 
-# Connect to the WRDS database
-db = wrds.Connection(wrds_username=username)
+# Connect to the WRDS database; repeated queries are served from the local
+# query cache (set FIN_NLP_WRDS_OFFLINE=1 to run from the cache only)
+db = wc.connect()
+
+# Name lookups are answered from the local security master mirror if synced
+# (see sync_security_master.py), otherwise from WRDS
+names_db = ws.get_name_connection(db)
+ds_names_db = ws.get_name_connection(db, 'tr_ds_equities')
 
 # IDs to investigate with sample queries for CRSP and Datastream
 ticker = 'CXW'
@@ -23,60 +30,61 @@ post_date = "2013-01-01"
 post_date_dt = datetime(year=2013, month=3, day=14)
 
 # CRSP sample name / stockinfo query via ticker
-query_crsp_names = f"""
+query_crsp_names = """
                     SELECT *
                     FROM crsp_q_stock.stocknames_v2
-                    WHERE ticker='{ticker}'
+                    WHERE ticker = :ticker
                     """
-crsp_names = db.raw_sql(query_crsp_names)
+crsp_names = ws.run_query(names_db, query_crsp_names, {'ticker': ticker})
 crsp_permno = crsp_names['permno'][0]
 
 # CRSP sample name / stockinfo query via cusip9
-query_crsp_names = f"""
+query_crsp_names = """
                     SELECT *
                     FROM crsp_q_stock.stocknames_v2
-                    WHERE cusip9='{cusip9}'
+                    WHERE cusip9 = :cusip9
                     """
-crsp_names = db.raw_sql(query_crsp_names)
+crsp_names = ws.run_query(names_db, query_crsp_names, {'cusip9': cusip9})
 crsp_permno = crsp_names['permno'][0]
 
-query_crsp_names_permno = f"""
+query_crsp_names_permno = """
                             SELECT *
                             FROM crsp_q_stock.stocknames_v2
-                            WHERE permno='{crsp_permno}'
+                            WHERE permno = :permno
                             """
-crsp_names_permno = db.raw_sql(query_crsp_names)
+crsp_names_permno = ws.run_query(names_db, query_crsp_names_permno,
+                                 {'permno': int(crsp_permno)})
 
 # Datastream sample name / stockinfo query
-isin = 'US' + crsp_names['cusip9']
-query_ds_names = f"""
+isin = ws.cusip9_to_isin(crsp_names['cusip9'][0])
+query_ds_names = """
                     SELECT *
                     FROM tr_ds_equities.wrds_ds_names
-                    WHERE isin = '{isin}'
+                    WHERE isin = :isin
                     """
-ds_names = db.raw_sql(query_ds_names)
+ds_names = ws.run_query(ds_names_db, query_ds_names, {'isin': isin})
 dscode = ds_names['dscode'][0]
 
 # Datastream sample stock return query
-query_ds_returns = f"""
+query_ds_returns = """
                     SELECT ri, ri_usd, marketdate, close
                     FROM tr_ds_equities.wrds_ds2dsf
-                    WHERE dscode='{dscode}'
+                    WHERE dscode = :dscode
                     """
-ds_returns = db.raw_sql(query_ds_returns)
+ds_returns = ws.run_query(db, query_ds_returns, {'dscode': dscode})
 
 # CRSP sample stock return query
-query_crsp_returns = f"""
+query_crsp_returns = """
                         SELECT *
                         FROM crsp_q_stock.dsf
-                        WHERE cusip = '{cusip}'
+                        WHERE cusip = :cusip
                         """
-crsp_returns = db.raw_sql(query_crsp_returns)
+crsp_returns = ws.run_query(db, query_crsp_returns, {'cusip': cusip})
 
 # CRSP security events 
-query_crsp_events = f"""
+query_crsp_events = """
                     SELECT *
                     FROM crsp_q_stock.mse
-                    WHERE cusip='{cusip}'
+                    WHERE cusip = :cusip
                     """
-crsp_events = db.raw_sql(query_crsp_events)
\ No newline at end of file
+crsp_events = ws.run_query(db, query_crsp_events, {'cusip': cusip})
\ No newline at end of file
@@ -0,0 +1,122 @@
+'''
+Mirror the WRDS security master tables into local SQLite files, so security
+name lookups (ticker -> permno on a date, permno -> current ticker, cusip ->
+permno, isin -> dscode) are answered locally and offline by the helpers in
+wrds_sql.py instead of one WRDS round trip per lookup.
+
+Each WRDS library is mirrored to its own file (e.g., crsp_q_stock.db), which
+wrds_sql.LocalConnection attaches under the library name, so the same SQL runs
+against WRDS and the mirror. Dates are stored as ISO 'YYYY-MM-DD' text, which
+compares correctly as strings and with the SQLite date() function.
+
+A sync writes each library to a temporary file, builds the indexes, and then
+swaps it in place of the previous mirror, so readers never see a partial copy.
+
+Usage:
+    python sync_security_master.py            # CRSP stocknames_v2 only
+    python sync_security_master.py --ds       # also Datastream wrds_ds_names
+
+Author: Aaron M. Stahl (2024) // aaron.m.stahl@gmail.com // astahl3.github.io
+'''
+import os
+import sqlite3
+import sys
+from datetime import datetime
+import pandas as pd
+import wrds
+import wrds_sql as ws
+
+# Global parameters
+username = 'astahl3'
+
+# Rows per chunk when pulling large tables from WRDS
+chunk_size = 500000
+
+# Tables to mirror: library -> {table: (date columns, indexes)}; each index is
+# a list of columns
+mirror_tables = {
+    'crsp_q_stock': {
+        'stocknames_v2': (['namedt', 'nameenddt'],
+                          [['ticker', 'namedt', 'nameenddt'],
+                           ['permno', 'namedt'],
+                           ['cusip'],
+                           ['cusip9']]),
+    },
+    'tr_ds_equities': {
+        'wrds_ds_names': (['startdate', 'enddate'],
+                          [['ibesticker', 'startdate', 'enddate'],
+                           ['dscode'],
+                           ['isin']]),
+    },
+}
+
+def fetch_table(db, library, table):
+    '''
+    Pull a full WRDS table; raw_sql streams it from the server in chunks of
+    'chunk_size' rows
+    '''
+    return db.raw_sql(f"SELECT * FROM {library}.{table}",
+                      chunksize=chunk_size)
+
+def to_iso_dates(df, date_columns):
+    ''' Convert the date columns of 'df' to ISO 'YYYY-MM-DD' strings '''
+    for col in date_columns:
+        if col not in df: continue
+        df[col] = pd.to_datetime(df[col], errors='coerce') \
+                    .dt.strftime('%Y-%m-%d')
+    return df
+
+def write_library(library, tables, path_dir=None):
+    '''
+    Write the DataFrames in 'tables' (table -> DataFrame) to a fresh mirror
+    file for 'library', build the indexes, and swap it in for the old mirror
+    '''
+    path_db = ws.mirror_path(library, path_dir)
+    tmp_path = path_db + '.tmp'
+    if os.path.exists(tmp_path): os.remove(tmp_path)
+
+    cn = sqlite3.connect(tmp_path)
+    c = cn.cursor()
+    for table, df in tables.items():
+        df.to_sql(table, cn, index=False)
+        for columns in mirror_tables[library][table][1]:
+            c.execute(f"CREATE INDEX idx_{table}_{'_'.join(columns)} "
+                      f"ON {table} ({', '.join(columns)})")
+
+    # Record when and what was synced
+    c.execute('''CREATE TABLE mirror_sync_log (
+                table_name TEXT,
+                n_rows INTEGER,
+                synced_at TEXT
+                )''')
+    synced_at = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    rows = [(table, len(df), synced_at) for table, df in tables.items()]
+    c.executemany("INSERT INTO mirror_sync_log VALUES (?, ?, ?)", rows)
+    cn.commit()
+    c.execute("ANALYZE")
+    cn.close()
+
+    os.replace(tmp_path, path_db)
+
+def sync_library(db, library, path_dir=None):
+    ''' Mirror all tables of a WRDS library listed in mirror_tables '''
+    tables = {}
+    for table, (date_columns, _) in mirror_tables[library].items():
+        df = fetch_table(db, library, table)
+        tables[table] = to_iso_dates(df, date_columns)
+        print(f"Fetched {len(df)} rows from {library}.{table}")
+    write_library(library, tables, path_dir)
+
+def main():
+
+    os.makedirs(ws.path_mirror_dir, exist_ok=True)
+    libraries = ['crsp_q_stock']
+    if '--ds' in sys.argv[1:]: libraries.append('tr_ds_equities')
+
+    db = wrds.Connection(wrds_username=username)
+    for library in libraries:
+        sync_library(db, library)
+    db.close()
+
+if __name__ == "__main__":
+    main()
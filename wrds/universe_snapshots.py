@@ -0,0 +1,238 @@
+'''
+Monthly point-in-time membership of the market-cap universe built by
+create_stock_db.py. For every month in a date range, the universe is taken on
+the month's first NYSE session with the same server-side join
+(wrds_ds2dsf -> wrds_ds_names -> stocknames_v2), a year of months per query,
+and stored as a compact table keyed by (month, permno). Matching a 2012 post
+against the 2012 universe instead of today's is then a single lookup.
+
+Months are integer keys YYYYMM (e.g., 201203). Only securities with a CRSP
+match are stored; if several Datastream quotes map to one permno in a month,
+the one with the largest market cap is kept. Fetched months are recorded in
+a snapshot log table, even when they return no rows, and skipped, so reruns
+only fetch new months.
+
+    python universe_snapshots.py [start_date] [end_date]
+
+Lookups load the table once into a dict of month -> frozenset of permnos:
+
+    import universe_snapshots as us
+    us.in_universe(14593, '2012-03-14')
+
+Author: Aaron M. Stahl (2024) // aaron.m.stahl@gmail.com // astahl3.github.io
+'''
+import sys
+import numbers
+import sqlite3
+from datetime import datetime, timezone
+import numpy as np
+import wrds_sql as ws
+import market_calendar as mc
+import create_stock_db as csdb
+
+# Database path and membership table
+path_universe_db = \
+    "/Users/astahl/fin_nlp_data/sqlite/wrds/universe_membership.db"
+membership_table = "universe_membership"
+snapshot_log_table = "snapshot_log"
+
+# Default snapshot range (through the latest available CRSP date)
+snapshot_start = '2012-01-01'
+snapshot_end = '2024-03-28'
+
+# Months of snapshots fetched per server query
+months_per_query = 12
+
+# Membership of each month (snapshot_day is the integer day number of the
+# session the universe was taken on; exchange is the Datastream primary
+# exchange mnemonic)
+membership_schema = f"""
+    CREATE TABLE IF NOT EXISTS {membership_table} (
+        month INTEGER,
+        permno INTEGER,
+        dscode TEXT,
+        snapshot_day INTEGER,
+        mktcap REAL,
+        exchange TEXT,
+        PRIMARY KEY (month, permno))
+    WITHOUT ROWID
+    """
+
+# Months fetched from the server, with the session each was taken on and the
+# number of membership rows it returned
+snapshot_log_schema = f"""
+    CREATE TABLE IF NOT EXISTS {snapshot_log_table} (
+        month INTEGER PRIMARY KEY,
+        snapshot_day INTEGER,
+        n_rows INTEGER)
+    """
+
+# Loaded membership, month -> frozenset of permnos (populated on first use)
+_membership = None
+
+def month_key(dt):
+    '''
+    Return the YYYYMM month key of a date, datetime, Timestamp, ISO date
+    string, or posix utc timestamp
+    '''
+    if isinstance(dt, str): return int(dt[:4]) * 100 + int(dt[5:7])
+    if isinstance(dt, numbers.Real):
+        dt = datetime.fromtimestamp(dt, timezone.utc)
+    return dt.year * 100 + dt.month
+
+def snapshot_sessions(start_date, end_date):
+    '''
+    Return the first NYSE session of each month from 'start_date' through
+    'end_date' as a list of dates
+    '''
+    sessions = mc.load_sessions()
+    sessions = sessions[(sessions >= np.datetime64(start_date, 'D')) &
+                        (sessions <= np.datetime64(end_date, 'D'))]
+    months = sessions.astype('datetime64[M]')
+    first = np.concatenate(([True], months[1:] != months[:-1]))
+    return [mc.day_date(n) for n in sessions[first].astype(np.int64)]
+
+def stored_months(cn):
+    ''' Return the set of month keys already fetched, from the snapshot log '''
+    return {row[0] for row in
+            cn.execute(f"SELECT month FROM {snapshot_log_table}")}
+
+def iter_snapshots(db, sessions, region=None, mktcap_cutoff=None):
+    '''
+    Yield the universe rows for each session in 'sessions' in streamed
+    DataFrame chunks, with one server query per months_per_query sessions
+    '''
+    if region is None: region = csdb.region
+    if mktcap_cutoff is None: mktcap_cutoff = csdb.mktcap_cutoff
+    query = csdb.universe_sql.format(
+        match="""d.marketdate = ANY(:marketdates)
+                 AND d.region = :region
+                 AND d.mktcap >= :mktcap_cutoff""")
+
+    for i in range(0, len(sessions), months_per_query):
+        params = {'marketdates': sessions[i:i + months_per_query],
+                  'region': region, 'mktcap_cutoff': mktcap_cutoff}
+        yield from ws.iter_query(db, query, params, csdb.universe_chunk_size)
+
+def snapshot_rows(chunk):
+    '''
+    Return the membership rows of a DataFrame chunk of universe rows,
+    dropping securities without a CRSP permno
+    '''
+    chunk = chunk[chunk['permno'].notna()]
+    days = mc.day_numbers(chunk['marketdate'])
+    months = days.astype('datetime64[D]').astype('datetime64[M]')
+    months = months.astype(np.int64)
+    months = (1970 + months // 12) * 100 + months % 12 + 1
+    return [(int(month), int(permno), dscode, int(day), mktcap, exchange)
+            for month, permno, dscode, day, mktcap, exchange
+            in zip(months, chunk['permno'], chunk['dscode'], days,
+                   chunk['mktcap'], chunk['primexchmnem'])]
+
+def build_membership(db, cn, start_date=None, end_date=None):
+    '''
+    Add the monthly universe membership from 'start_date' through
+    'end_date' to SQLite connection 'cn', skipping months already stored;
+    returns the number of months added
+    '''
+    if start_date is None: start_date = snapshot_start
+    if end_date is None: end_date = snapshot_end
+
+    with cn:
+        cn.execute(membership_schema)
+        cn.execute(f"""CREATE INDEX IF NOT EXISTS idx_{membership_table}_permno
+                       ON {membership_table} (permno, month)""")
+        cn.execute(snapshot_log_schema)
+
+        # Tables built before the log: months with rows were fetched
+        cn.execute(f"""
+            INSERT OR IGNORE INTO {snapshot_log_table}
+            (month, snapshot_day, n_rows)
+            SELECT month, MIN(snapshot_day), COUNT(*)
+            FROM {membership_table} GROUP BY month
+            """)
+
+    done = stored_months(cn)
+    sessions = [s for s in snapshot_sessions(start_date, end_date)
+                if month_key(s) not in done]
+
+    for i in range(0, len(sessions), months_per_query):
+        group = sessions[i:i + months_per_query]
+        n_rows = dict.fromkeys(map(month_key, group), 0)
+
+        # Rows arrive largest market cap first, so OR IGNORE keeps the
+        # largest quote of each (month, permno)
+        for chunk in iter_snapshots(db, group):
+            rows = snapshot_rows(chunk)
+            with cn:
+                cn.executemany(f"""
+                    INSERT OR IGNORE INTO {membership_table}
+                    (month, permno, dscode, snapshot_day, mktcap, exchange)
+                    VALUES (?, ?, ?, ?, ?, ?)
+                    """, rows)
+            for row in rows: n_rows[row[0]] += 1
+
+        # Log the group's months once all of their rows are stored
+        with cn:
+            cn.executemany(f"""
+                INSERT OR REPLACE INTO {snapshot_log_table}
+                (month, snapshot_day, n_rows) VALUES (?, ?, ?)
+                """, [(month_key(s), mc.day_number(s), n_rows[month_key(s)])
+                      for s in group])
+    return len(sessions)
+
+def load_membership(path_db=None):
+    '''
+    Return the membership as a dict of month key -> frozenset of permnos,
+    loading it from the membership table on first use
+    '''
+    global _membership
+    if _membership is not None and path_db is None: return _membership
+
+    cn = sqlite3.connect(path_db or path_universe_db)
+    members = {}
+    for month, permno in cn.execute(f"""SELECT month, permno
+                                        FROM {membership_table}"""):
+        members.setdefault(month, set()).add(permno)
+    cn.close()
+
+    membership = {month: frozenset(p) for month, p in members.items()}
+    if path_db is None: _membership = membership
+    return membership
+
+def members_on(dt, membership=None):
+    ''' Return the frozenset of permnos in the universe on date 'dt' '''
+    if membership is None: membership = load_membership()
+    return membership.get(month_key(dt), frozenset())
+
+def in_universe(permno, dt, membership=None):
+    ''' Return True if 'permno' was in the universe on date 'dt' '''
+    return int(permno) in members_on(dt, membership)
+
+def get_member(cn, permno, dt):
+    '''
+    Return the (dscode, snapshot date, mktcap, exchange) of 'permno' in the
+    universe on date 'dt', or None if it was not a member
+    '''
+    row = cn.execute(f"""SELECT dscode, snapshot_day, mktcap, exchange
+                         FROM {membership_table}
+                         WHERE month = ? AND permno = ?""",
+                     (month_key(dt), int(permno))).fetchone()
+    if row is None: return None
+    return (row[0], mc.day_date(row[1]), row[2], row[3])
+
+def main():
+    start_date = sys.argv[1] if len(sys.argv) > 1 else snapshot_start
+    end_date = sys.argv[2] if len(sys.argv) > 2 else snapshot_end
+
+    db = ws.connect_wrds()
+    cn = sqlite3.connect(path_universe_db)
+    n_months = build_membership(db, cn, start_date, end_date)
+    n_rows = cn.execute(f"SELECT COUNT(*) FROM {membership_table}").fetchone()
+    print(f"Added {n_months} monthly snapshots from {start_date} to "
+          f"{end_date}; {n_rows[0]} memberships stored in {path_universe_db}")
+    cn.close()
+    db.close()
+
+if __name__ == "__main__":
+    main()
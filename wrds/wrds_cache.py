@@ -0,0 +1,160 @@
+'''
+Content-addressed on-disk cache for WRDS query results. Reruns of the wrds/
+scripts (and notebooks) during development repeat the same remote queries;
+CachedConnection wraps a wrds.Connection and serves repeated raw_sql calls
+from compressed Parquet files instead.
+
+- Key: SHA-256 of the normalized SQL (whitespace collapsed), the bound
+  parameters, and 'dataset_version', so results are refetched once the WRDS
+  data is updated (bump dataset_version with each CRSP/Datastream refresh)
+- Expiry: entries older than 'cache_ttl' seconds are refetched
+- Eviction: least recently used entries are removed once the cache exceeds
+  'max_cache_bytes'; each connection walks the cache directory once and then
+  keeps a running size, so it only walks it again when the limit is passed
+- Offline mode: cache misses raise CacheMissError immediately instead of
+  connecting to WRDS (set FIN_NLP_WRDS_OFFLINE=1 or pass offline=True)
+
+Usage:
+    import wrds_cache as wc
+    db = wc.connect()
+    df = db.raw_sql("SELECT ...")
+
+Author: Aaron M. Stahl (2024) // aaron.m.stahl@gmail.com // astahl3.github.io
+'''
+import hashlib
+import json
+import os
+import re
+import time
+import pandas as pd
+import wrds
+import wrds_sql as ws
+
+# Global parameters
+username = 'astahl3'
+
+# Cache location and limits
+path_cache_dir = "/Users/astahl/fin_nlp_data/wrds/query_cache"
+max_cache_bytes = 2 * 1024 ** 3 # 2 GB
+cache_ttl = 30 * 24 * 3600 # seconds
+parquet_compression = 'zstd'
+
+# Version of the WRDS data the cached results were pulled from
+dataset_version = 'crsp_q_stock:2024-03-28'
+
+# Environment variable enabling offline mode
+offline_env_var = 'FIN_NLP_WRDS_OFFLINE'
+
+class CacheMissError(Exception):
+    ''' Raised in offline mode when a query result is not in the cache '''
+
+def normalize_sql(sql):
+    ''' Collapse whitespace so formatting changes do not change the key '''
+    return re.sub(r'\s+', ' ', sql).strip()
+
+def cache_key(sql, params=None, version=None):
+    ''' Return the cache key of a query, its parameters, and data version '''
+    if version is None: version = dataset_version
+    payload = json.dumps([normalize_sql(sql), params, version],
+                         sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+def cache_path(key, path_dir=None):
+    ''' Return the Parquet file path of a cache key '''
+    if path_dir is None: path_dir = path_cache_dir
+    return os.path.join(path_dir, key[:2], key + '.parquet')
+
+def cache_entries(path_dir=None):
+    ''' Return the (access time, size, path) of every entry in the cache '''
+    if path_dir is None: path_dir = path_cache_dir
+
+    entries = []
+    for root, _, files in os.walk(path_dir):
+        for name in files:
+            if not name.endswith('.parquet'): continue
+            path = os.path.join(root, name)
+            st = os.stat(path)
+            entries.append((st.st_atime, st.st_size, path))
+    return entries
+
+def evict(path_dir=None, max_bytes=None):
+    '''
+    Remove the least recently used entries (by access time) until the cache
+    is within 'max_bytes'; returns the remaining cache size in bytes
+    '''
+    if max_bytes is None: max_bytes = max_cache_bytes
+
+    entries = cache_entries(path_dir)
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_bytes: break
+        os.remove(path)
+        total -= size
+    return total
+
+class CachedConnection:
+    '''
+    Wraps a WRDS connection (or None in offline mode) and caches raw_sql
+    results on disk. Exposes raw_sql and close like wrds.Connection.
+    '''
+    def __init__(self, db=None, offline=False, path_dir=None, ttl=None,
+                 version=None):
+        self.db = db
+        self.offline = offline
+        self.path_dir = path_dir if path_dir is not None else path_cache_dir
+        self.ttl = ttl if ttl is not None else cache_ttl
+        self.version = version if version is not None else dataset_version
+        self.paramstyle = getattr(db, 'paramstyle', ws.wrds_paramstyle)
+
+        # Running cache size in bytes (walked on the first write)
+        self.cache_bytes = None
+
+    def raw_sql(self, sql, params=None, **kwargs):
+        # Results are cached whole, so streamed queries return one DataFrame
+        kwargs.pop('return_iter', None)
+        kwargs.pop('chunksize', None)
+        key = cache_key(sql, params, self.version)
+        path = cache_path(key, self.path_dir)
+
+        # Serve from the cache if fresh; record the access for LRU eviction
+        if os.path.exists(path):
+            st = os.stat(path)
+            if time.time() - st.st_mtime <= self.ttl:
+                os.utime(path, (time.time(), st.st_mtime))
+                return pd.read_parquet(path)
+
+        if self.offline or self.db is None:
+            raise CacheMissError(f"No cached result for query "
+                                 f"{normalize_sql(sql)[:200]}")
+
+        result = self.db.raw_sql(sql, params=params, **kwargs)
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = path + '.tmp'
+        result.to_parquet(tmp_path, compression=parquet_compression,
+                          index=False)
+        os.replace(tmp_path, path)
+
+        # Evict only once the running size passes the limit; rewritten
+        # entries are counted twice, which at worst evicts early
+        if self.cache_bytes is None:
+            self.cache_bytes = sum(size for _, size, _
+                                   in cache_entries(self.path_dir))
+        else:
+            self.cache_bytes += os.path.getsize(path)
+        if self.cache_bytes > max_cache_bytes:
+            self.cache_bytes = evict(self.path_dir)
+        return result
+
+    def close(self):
+        if self.db is not None: self.db.close()
+
+def connect(offline=None, **kwargs):
+    '''
+    Return a CachedConnection to WRDS; in offline mode (argument, or the
+    FIN_NLP_WRDS_OFFLINE environment variable) no connection is opened
+    '''
+    if offline is None:
+        offline = os.environ.get(offline_env_var, '') not in ('', '0')
+    db = None if offline else wrds.Connection(wrds_username=username)
+    return CachedConnection(db, offline=offline, **kwargs)
@@ -0,0 +1,234 @@
+'''
+Concurrent query executor for WRDS. A single wrds.Connection runs one query at
+a time, and most of the wall time of a fetch loop is spent waiting on network
+latency. QueryExecutor keeps a small pool of connections and runs independent
+queries (name lookups, dsf windows, Datastream lookups) on worker threads, with
+a cap on concurrent queries, a minimum interval between query starts, and
+retry with exponential backoff. Results are returned in the order the queries
+were submitted, regardless of completion order.
+
+Connections are opened only when a query finds no idle one, so a few batches
+never open more sessions than they need. An existing connection (e.g., the
+script's own WRDS session) can be lent to the pool, and a single query runs
+on the calling thread. Only connection and operational errors are retried;
+SQL and programming errors are raised at once.
+
+Queries are written with :name placeholders and run through
+wrds_sql.run_query, so the executor works against WRDS and against local
+SQLite stand-ins (wrds_sql.LocalConnection) alike.
+
+Running this file benchmarks serial against concurrent execution of name
+lookups on the local security master mirror, with artificial latency added to
+every query to mimic the round trip to WRDS.
+
+Author: Aaron M. Stahl (2024) // aaron.m.stahl@gmail.com // astahl3.github.io
+'''
+import queue
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import wrds_sql as ws
+
+# Default executor settings; WRDS limits concurrent sessions per user, so the
+# pool is kept small
+max_workers = 4 # concurrent queries (and pooled connections)
+max_retries = 3 # attempts after the first failure
+backoff_base = 1.0 # seconds; doubled after each failed attempt
+min_query_interval = 0.0 # seconds between query starts (rate limit)
+
+# Errors retried on a fresh connection: dropped or refused connections and
+# operational failures on the server, matched by class name (SQLAlchemy,
+# psycopg2) so the database drivers stay optional
+transient_errors = {'OperationalError', 'InterfaceError'}
+
+# SQLite also reports SQL errors as OperationalError; only lock contention is
+# transient there
+sqlite_transient_messages = ('locked', 'busy')
+
+# Benchmark settings
+benchmark_latency = 0.2 # seconds added to each query
+benchmark_queries = 40
+
+def connect_wrds():
+    ''' Open a new WRDS (or WRDS stand-in) connection '''
+    return ws.connect_wrds()
+
+def is_transient(error):
+    '''
+    Return True if 'error' (or an exception it was raised from) is a
+    connection or operational error worth retrying
+    '''
+    while error is not None:
+        if isinstance(error, sqlite3.OperationalError):
+            message = str(error).lower()
+            return any(m in message for m in sqlite_transient_messages)
+        if isinstance(error, (ConnectionError, TimeoutError)): return True
+        if getattr(error, 'connection_invalidated', False): return True
+        if {cls.__name__ for cls in type(error).__mro__} & transient_errors:
+            return True
+        error = error.__cause__ or error.__context__
+    return False
+
+class LatencyConnection:
+    '''
+    Wraps a connection and sleeps 'latency' seconds before each query, to
+    mimic network round trips when benchmarking against a local stand-in
+    '''
+    def __init__(self, connection, latency):
+        self.connection = connection
+        self.latency = latency
+        self.paramstyle = getattr(connection, 'paramstyle', ws.wrds_paramstyle)
+
+    def raw_sql(self, sql, params=None, **kwargs):
+        time.sleep(self.latency)
+        return self.connection.raw_sql(sql, params=params, **kwargs)
+
+    def close(self):
+        self.connection.close()
+
+class QueryExecutor:
+    '''
+    Runs queries concurrently on a pool of connections created on demand by
+    'connect' (a function returning a new connection). An open 'connection'
+    may be lent to the pool; it is used first and left open on close. A
+    query failing with a transient error is retried on a fresh connection
+    after an exponential backoff.
+    '''
+    def __init__(self, connect=None, workers=None, retries=None,
+                 backoff=None, interval=None, connection=None):
+        self.connect = connect if connect is not None else connect_wrds
+        self.workers = workers if workers is not None else max_workers
+        self.retries = retries if retries is not None else max_retries
+        self.backoff = backoff if backoff is not None else backoff_base
+        self.interval = interval if interval is not None \
+                        else min_query_interval
+
+        self.pool = queue.Queue()
+        self.connections = []
+        self.lock = threading.Lock()
+        self.next_start = 0.0
+        self.threads = ThreadPoolExecutor(max_workers=self.workers)
+
+        # Lent connection: pooled, but owned (and closed) by the caller
+        self.lent = connection
+        if connection is not None: self.pool.put(connection)
+
+    def acquire(self):
+        ''' Take an idle connection from the pool, or open a new one '''
+        try:
+            return self.pool.get_nowait()
+        except queue.Empty:
+            connection = self.connect()
+            with self.lock:
+                self.connections.append(connection)
+            return connection
+
+    def discard(self, connection):
+        '''
+        Close a connection that failed and drop it from the pool (a lent
+        connection is only dropped)
+        '''
+        with self.lock:
+            if connection in self.connections:
+                self.connections.remove(connection)
+        if connection is self.lent: return
+        try:
+            connection.close()
+        except Exception:
+            pass
+
+    def wait_turn(self):
+        ''' Block until the rate limit allows the next query to start '''
+        if self.interval <= 0: return
+        with self.lock:
+            now = time.monotonic()
+            start = max(now, self.next_start)
+            self.next_start = start + self.interval
+        if start > now: time.sleep(start - now)
+
+    def run(self, query, params=None):
+        ''' Run one query with retries and return its DataFrame result '''
+        for attempt in range(self.retries + 1):
+            connection = self.acquire()
+            try:
+                self.wait_turn()
+                result = ws.run_query(connection, query, params)
+            except Exception as error:
+                if not is_transient(error):
+                    self.pool.put(connection)
+                    raise
+                self.discard(connection)
+                if attempt == self.retries: raise
+                time.sleep(self.backoff * 2 ** attempt)
+            else:
+                self.pool.put(connection)
+                return result
+
+    def map(self, queries):
+        '''
+        Run a list of (query, params) pairs concurrently and return their
+        results in the same order; a single query runs on the calling thread
+        '''
+        if len(queries) == 1: return [self.run(*queries[0])]
+        return list(self.threads.map(lambda qp: self.run(*qp), queries))
+
+    def close(self):
+        ''' Shut down the worker threads and close all pooled connections '''
+        self.threads.shutdown(wait=True)
+        with self.lock:
+            connections = self.connections
+            self.connections = []
+        for connection in connections:
+            connection.close()
+
+def benchmark(workers=None, latency=None, n_queries=None):
+    '''
+    Time serial against concurrent name lookups on the local mirror with
+    'latency' seconds added to each query; returns (serial, concurrent) times
+    '''
+    if workers is None: workers = max_workers
+    if latency is None: latency = benchmark_latency
+    if n_queries is None: n_queries = benchmark_queries
+
+    def connect():
+        return LatencyConnection(ws.connect_local_mirror(), latency)
+
+    query = """
+            SELECT permno, ticker, namedt, nameenddt
+            FROM crsp_q_stock.stocknames_v2
+            WHERE permno = :permno
+            """
+    queries = [(query, {'permno': 10000 + i}) for i in range(n_queries)]
+
+    serial = QueryExecutor(connect, workers=1)
+    t0 = time.perf_counter()
+    serial_results = serial.map(queries)
+    serial_time = time.perf_counter() - t0
+    serial.close()
+
+    concurrent = QueryExecutor(connect, workers=workers)
+    t0 = time.perf_counter()
+    concurrent_results = concurrent.map(queries)
+    concurrent_time = time.perf_counter() - t0
+    concurrent.close()
+
+    # Results must match query for query
+    for a, b in zip(serial_results, concurrent_results):
+        assert a.equals(b)
+
+    return serial_time, concurrent_time
+
+def main():
+
+    if ws.connect_local_mirror() is None:
+        print("No local mirror found; run sync_security_master.py first")
+        return
+
+    serial_time, concurrent_time = benchmark()
+    print(f"{benchmark_queries} queries at {benchmark_latency}s latency")
+    print(f"Serial: {serial_time:.2f}s")
+    print(f"Concurrent ({max_workers} workers): {concurrent_time:.2f}s")
+
+if __name__ == "__main__":
+    main()
@@ -58,36 +58,606 @@ WRDS Datastream
 
 Author: Aaron M. Stahl (2024) // aaron.m.stahl@gmail.com // astahl3.github.io 
 '''
+import os
+import re
+import sqlite3
+from functools import lru_cache
 import pandas as pd
 import wrds
 
 # Global parameters
 username = 'astahl3'
 
-def get_crsp_stockinfo(db, ticker, start_date=None, end_date=None):
-    
-    query = f'''
-            SELECT *
-            FROM crsp_q_stock.stocknames_v2
-            WHERE ticker = \'{ticker}\'
-            AND namedt <= \'{start_date}\'
-            AND nameenddt >= \'{end_date}\'
-            '''
-            
-    return(db.raw_sql(query))
-    
-def get_ds_stockinfo(db, ticker, start_date=None, end_date=None):
+# Local mirror of the WRDS security master tables (see sync_security_master.py)
+# with one SQLite file per WRDS library, attached under the library name so
+# the same SQL runs locally and on WRDS
+path_mirror_dir = "/Users/astahl/fin_nlp_data/sqlite/wrds/mirror"
+mirror_libraries = ['crsp_q_stock', 'tr_ds_equities']
+use_local_mirror = True # answer name lookups from the mirror when available
+_local_mirror = None
+
+# Local crosswalk of security identifiers (see build_crosswalk.py)
+path_crosswalk_db = \
+    "/Users/astahl/fin_nlp_data/sqlite/wrds/mirror/crosswalk.db"
+crosswalk_table = 'security_crosswalk'
+
+# Datastream name fields kept in the crosswalk
+ds_name_fields = ['dscode', 'isin', 'ismajorsec', 'dscmpyname', 'dsqtname',
+                  'primexchmnem', 'ticker', 'ibesticker']
+
+# Environment variable selecting the synthetic WRDS stand-in (see
+# wrds_standin.py): the stand-in directory, or 1 for the default one
+standin_env_var = 'FIN_NLP_WRDS_STANDIN'
+
+# Placeholder style of the WRDS connection driver (psycopg2: %(name)s). Queries
+# in this file are written with :name placeholders and converted as needed;
+# connections that accept :name directly (e.g., sqlite3) set 'paramstyle'
+wrds_paramstyle = 'pyformat'
+
+# Pairs per chunk for bulk name resolution (two bound parameters per pair)
+resolve_chunk_size = 400
+
+# Values per array parameter in '= ANY(:name)' batch lookups
+any_chunk_size = 1000
+
+# Rows per DataFrame when streaming a query result (iter_query)
+stream_chunk_size = 50000
+
+# Suffix of the views presenting the integer day columns of local tables
+# (days since 1970-01-01) as ISO dates
+iso_view_suffix = '_iso'
+
+# Fields returned by bulk CRSP name resolution
+crsp_name_fields = ['permno', 'cusip9', 'issuernm', 'primaryexch',
+                    'securitytype', 'securitysubtype', 'namedt', 'nameenddt']
+
+def char_value(char):
+    '''
+    Return the numeric value of a CUSIP/ISIN character (0-9 as is, A = 10,
+    B = 11, ..., Z = 35, * = 36, @ = 37, # = 38)
+    '''
+    if char.isdigit(): return int(char)
+    if char.isalpha(): return ord(char.upper()) - 55
+    return {'*': 36, '@': 37, '#': 38}[char]
+
+@lru_cache(maxsize=None)
+def cusip_check_digit(cusip):
+    '''
+    Return the check digit of the 8-character 'cusip': double the values in
+    even positions (2nd, 4th, ...), sum the digits of all values, and take
+    the tens complement
+    '''
+    total = 0
+    for i, char in enumerate(cusip[:8]):
+        value = char_value(char)
+        if i % 2 == 1: value *= 2
+        total += value // 10 + value % 10
+    return str((10 - total % 10) % 10)
+
+def cusip_to_cusip9(cusip):
+    ''' Append the check digit to an 8-character CUSIP '''
+    return cusip[:8] + cusip_check_digit(cusip[:8])
+
+@lru_cache(maxsize=None)
+def cusip9_to_isin(cusip9, country_code='US'):
+    '''
+    Return the ISIN of the passed 'cusip9' and (optional) 'country_code': the
+    characters are converted to digits (A = 10, ...), and the check digit is
+    computed with the Luhn algorithm, doubling every second digit starting
+    from the rightmost one
+    '''
+    base_isin = country_code + cusip9
+    digits = ''.join(str(char_value(char)) for char in base_isin)
+
+    total = 0
+    for i, digit in enumerate(reversed(digits)):
+        value = int(digit) * 2 if i % 2 == 0 else int(digit)
+        total += value // 10 + value % 10
+    return base_isin + str((10 - total % 10) % 10)
+
+def cusip9s_to_isins(cusip9s, country_code='US'):
+    '''
+    Convert a Series of CUSIP9s to ISINs, computing each distinct CUSIP9 once
+    (missing values stay missing)
+    '''
+    cusip9s = pd.Series(cusip9s)
+    isins = {c: cusip9_to_isin(c, country_code)
+             for c in cusip9s.dropna().unique()}
+    return cusip9s.map(isins)
+
+def isin_to_components(isin):
+    '''
+    Split ISIN ('isin') into components and return the two-digit country code,
+    CUSIP, CUSIP check digit, and ISIN check digit
+    '''
+    if len(isin) != 12: raise ValueError("ISIN must be 12 characters long")
+    return isin[0:2], isin[2:10], isin[10], isin[11]
+
+def isin_to_cusip(isin):
+    ''' Return the 8-character CUSIP of a 12-character ISIN '''
+    if len(isin) != 12: raise ValueError("ISIN must be 12 characters long")
+    return isin[2:10]
+
+class LocalConnection:
+    '''
+    Minimal stand-in for wrds.Connection backed by SQLite files, one per WRDS
+    library, attached under the library name (e.g., crsp_q_stock). Exposes
+    raw_sql and close, and accepts :name placeholders. Like wrds.Connection,
+    raw_sql(..., chunksize=n, return_iter=True) returns an iterator of
+    DataFrames of up to n rows.
+    '''
+    paramstyle = 'named'
+
+    def __init__(self, path_dir, libraries=None):
+        if libraries is None: libraries = mirror_libraries
+        self.connection = sqlite3.connect(':memory:', check_same_thread=False)
+        self.libraries = []
+        for library in libraries:
+            path_db = os.path.join(path_dir, library + '.db')
+            if not os.path.exists(path_db): continue
+            self.libraries.append(library)
+            self.connection.execute("ATTACH DATABASE ? AS " + library,
+                                    (path_db,))
+
+    def raw_sql(self, sql, params=None, chunksize=None, return_iter=False,
+                **kwargs):
+        if return_iter:
+            return pd.read_sql_query(sql, self.connection, params=params,
+                                     chunksize=chunksize)
+        return pd.read_sql_query(sql, self.connection, params=params)
+
+    def close(self):
+        self.connection.close()
+
+def mirror_path(library, path_dir=None):
+    ''' Return the path of the local mirror file for a WRDS library '''
+    if path_dir is None: path_dir = path_mirror_dir
+    return os.path.join(path_dir, library + '.db')
+
+def connect_local_mirror(path_dir=None):
+    '''
+    Return a LocalConnection to the local security master mirror, or None if
+    the mirror has not been synced yet
+    '''
+    if path_dir is None: path_dir = path_mirror_dir
+    if not os.path.exists(mirror_path('crsp_q_stock', path_dir)): return None
+    return LocalConnection(path_dir)
+
+def connect_wrds():
+    '''
+    Open a connection to WRDS, or to the local WRDS stand-in if the
+    FIN_NLP_WRDS_STANDIN environment variable is set
+    '''
+    standin = os.environ.get(standin_env_var, '')
+    if standin in ('', '0'):
+        return wrds.Connection(wrds_username=username)
+
+    import wrds_standin
+    return wrds_standin.connect_standin(None if standin == '1' else standin)
+
+def get_name_connection(db, library='crsp_q_stock'):
+    '''
+    Return the connection to use for security name lookups in 'library': the
+    local mirror if enabled and synced, otherwise the passed WRDS connection
+    (or local connection, e.g., the WRDS stand-in)
+    '''
+    global _local_mirror
+    if not use_local_mirror or isinstance(db, LocalConnection): return db
+    if _local_mirror is None: _local_mirror = connect_local_mirror()
+    if _local_mirror is None or library not in _local_mirror.libraries:
+        return db
+    return _local_mirror
+
+@lru_cache(maxsize=256)
+def prepare_query(query, paramstyle, array_sizes=()):
+    '''
+    Return 'query' written with :name placeholders in the connection's
+    'paramstyle'. Cached, so repeated lookups reuse the converted SQL.
+
+    Array parameters ('= ANY(:name)') are bound as arrays on WRDS; for
+    connections without arrays (SQLite), each (name, size) in 'array_sizes'
+    is expanded to 'IN (:name_0, ..., :name_<size-1>)'
+    '''
+    for name, size in array_sizes:
+        placeholders = ', '.join(f':{name}_{i}' for i in range(size))
+        query = re.sub(rf'=\s*ANY\s*\(\s*:{name}\s*\)',
+                       f'IN ({placeholders})', query)
+    if paramstyle == 'pyformat':
+        query = re.sub(r'(?<![:\w]):([A-Za-z_]\w*)', r'%(\1)s', query)
+    return query
+
+def run_query(db, query, params=None, **kwargs):
+    '''
+    Run 'query' written with :name placeholders on connection 'db' with the
+    bound 'params' dict, converting placeholders to the connection's style.
+    List values are array parameters, for use as '= ANY(:name)'. Other
+    keyword arguments are passed on to db.raw_sql.
+    '''
+    if not params: return db.raw_sql(query, params=params, **kwargs)
+
+    paramstyle = getattr(db, 'paramstyle', wrds_paramstyle)
+    arrays = {name: list(value) for name, value in params.items()
+              if isinstance(value, (list, tuple))}
+    params = dict(params)
+    array_sizes = ()
+    if paramstyle == 'pyformat':
+        params.update(arrays)
+    else:
+        for name, values in arrays.items():
+            del params[name]
+            params.update({f'{name}_{i}': v for i, v in enumerate(values)})
+        array_sizes = tuple(sorted((name, len(values))
+                                   for name, values in arrays.items()))
+
+    return db.raw_sql(prepare_query(query, paramstyle, array_sizes),
+                      params=params, **kwargs)
+
+def iter_query(db, query, params=None, chunk_size=None):
+    '''
+    Run 'query' as in run_query and yield the result in DataFrames of up to
+    'chunk_size' rows as they are fetched. Connections that cannot stream
+    (e.g., the query cache) yield the whole result at once.
+    '''
+    if chunk_size is None: chunk_size = stream_chunk_size
+    result = run_query(db, query, params, chunksize=chunk_size,
+                       return_iter=True)
+    if isinstance(result, pd.DataFrame):
+        yield result
+        return
+    yield from result
+
+def run_query_chunked(db, query, params, name, chunk_size=None):
+    '''
+    Run 'query' once per chunk of the array parameter 'name' in 'params' and
+    return the concatenated results
+    '''
+    if chunk_size is None: chunk_size = any_chunk_size
+    values = list(dict.fromkeys(params[name]))
+
+    results = []
+    for i in range(0, len(values), chunk_size):
+        results.append(run_query(db, query, {**params,
+                                             name: values[i:i + chunk_size]}))
+    if not results: return run_query(db, query, {**params, name: []})
+    return pd.concat(results, ignore_index=True)
+
+def resolve_crsp_names(db, pairs, chunk_size=None):
+    '''
+    Resolve many (ticker, market_date) pairs to CRSP security info with one
+    interval join against crsp_q_stock.stocknames_v2 per chunk of pairs,
+    instead of one query per pair. The distinct pairs are sent as a VALUES
+    list of bound parameters; the SQL runs on PostgreSQL (WRDS) and on a
+    SQLite stand-in with the same schema.
+
+    Parameters:
+    -----------
+    - db: WRDS connection, or any connection object exposing raw_sql
+    - pairs (DataFrame): columns 'ticker' and 'market_date' (YYYY-MM-DD)
+    - chunk_size (int, optional): distinct pairs per query
+
+    Returns:
+    --------
+    - DataFrame: one row per matching name record, with the 'ticker' and
+      'market_date' of the pair followed by the fields in crsp_name_fields
+      (pairs without a match are absent)
     
+    Answered from the local security master mirror if it is available.
+    '''
+    if chunk_size is None: chunk_size = resolve_chunk_size
+    db = get_name_connection(db)
+
+    distinct_pairs = pairs[['ticker', 'market_date']].dropna() \
+                     .drop_duplicates().astype(str).values.tolist()
+
+    select_fields = ', '.join(f's.{f}' for f in crsp_name_fields)
+    results = []
+    for i in range(0, len(distinct_pairs), chunk_size):
+        chunk = distinct_pairs[i:i + chunk_size]
+
+        params = {}
+        values = []
+        for j, (ticker, market_date) in enumerate(chunk):
+            params[f't{j}'] = ticker
+            params[f'd{j}'] = market_date
+            values.append(f'(:t{j}, :d{j})')
+
+        query = f"""
+                WITH pairs (ticker, market_date) AS (
+                    VALUES {', '.join(values)}
+                )
+                SELECT  p.ticker, p.market_date, {select_fields}
+                FROM    pairs p
+                JOIN    crsp_q_stock.stocknames_v2 s
+                ON      s.ticker = p.ticker
+                AND     s.namedt <= date(p.market_date)
+                AND     s.nameenddt >= date(p.market_date)
+                ORDER BY p.ticker, p.market_date, s.namedt
+                """
+        results.append(run_query(db, query, params))
+
+    if not results:
+        return pd.DataFrame(columns=['ticker', 'market_date'] +
+                            crsp_name_fields)
+    return pd.concat(results, ignore_index=True)
+
+def get_crsp_names_by_permno(db, permnos):
+    '''
+    Return the name records (fields in crsp_name_fields) of many permnos from
+    crsp_q_stock.stocknames_v2, sorted by permno and namedt, with one query
+    per chunk of permnos. Answered from the local security master mirror if
+    it is available.
+    '''
+    query = f"""
+            SELECT  {', '.join(crsp_name_fields)}
+            FROM    crsp_q_stock.stocknames_v2
+            WHERE   permno = ANY(:permnos)
+            ORDER BY permno, namedt
+            """
+    permnos = [int(p) for p in permnos]
+    return run_query_chunked(get_name_connection(db), query,
+                             {'permnos': permnos}, 'permnos')
+
+def group_crsp_names(names):
+    '''
+    Return a dict of (ticker, market_date) -> DataFrame of the name records
+    resolved for that pair (index reset), for per-row lookups after a bulk
+    resolve_crsp_names call
+    '''
+    return {key: group.reset_index(drop=True)
+            for key, group in names.groupby(['ticker', 'market_date'])}
+
+def get_ds_return_indices(db, ranges, chunk_size=None):
+    '''
+    Fetch the Datastream return index series (ri, ri_usd, close) for many
+    (dscode, start_date, end_date) ranges with one query per chunk of ranges
+    against tr_ds_equities.wrds_ds2dsf, instead of one query per date.
+
+    Returns a DataFrame with dscode, marketdate (datetime64), ri, ri_usd and
+    close, sorted by dscode and marketdate.
+    '''
+    if chunk_size is None: chunk_size = resolve_chunk_size
+
+    results = []
+    for i in range(0, len(ranges), chunk_size):
+        chunk = ranges[i:i + chunk_size]
+
+        params = {}
+        conditions = []
+        for j, (dscode, start_date, end_date) in enumerate(chunk):
+            params[f'c{j}'] = dscode
+            params[f's{j}'] = str(start_date)[:10]
+            params[f'e{j}'] = str(end_date)[:10]
+            conditions.append(f'(dscode = :c{j} AND marketdate '
+                              f'BETWEEN :s{j} AND :e{j})')
+
+        query = f"""
+                SELECT dscode, marketdate, ri, ri_usd, close
+                FROM tr_ds_equities.wrds_ds2dsf
+                WHERE {' OR '.join(conditions)}
+                """
+        results.append(run_query(db, query, params))
+
+    if not results:
+        return pd.DataFrame(columns=['dscode', 'marketdate', 'ri', 'ri_usd',
+                                     'close'])
+    series = pd.concat(results, ignore_index=True)
+    series['marketdate'] = pd.to_datetime(series['marketdate'])
+    return series.sort_values(['dscode', 'marketdate'], ignore_index=True)
+
+def asof_lookup(dates, values, targets, floor=None):
+    '''
+    As-of (backward fill) lookup in a series sorted by date: for each target
+    date, return (value, date) of the last observation with a non-null value
+    on or before it, or (None, None) if there is none on or after 'floor'
+    '''
+    dates = pd.DatetimeIndex(dates)
+    observed = pd.notna(values)
+    dates = dates[observed]
+    values = pd.Series(values)[observed].tolist()
+
+    found = []
+    for target in pd.DatetimeIndex(targets):
+        k = dates.searchsorted(target, side='right') - 1
+        if k < 0 or (floor is not None and dates[k] < pd.Timestamp(floor)):
+            found.append((None, None))
+        else:
+            found.append((values[k], dates[k]))
+    return found
+
+def frame_to_rows(df, columns=None):
+    '''
+    Convert the 'columns' of DataFrame 'df' (all columns if None) to a list
+    of tuples of plain Python values for sqlite3: datetime columns become ISO
+    'YYYY-MM-DD' strings, numpy scalars become int/float, and NaN/NaT None
+    '''
+    if columns is None: columns = list(df.columns)
+    frame = df[columns].copy()
+    for col in columns:
+        if pd.api.types.is_datetime64_any_dtype(frame[col]):
+            frame[col] = frame[col].dt.strftime('%Y-%m-%d')
+    frame = frame.astype(object).where(frame.notna(), None)
+    return list(frame.itertuples(index=False, name=None))
+
+def bulk_insert(cn, table, df, columns=None, conflict='REPLACE'):
+    '''
+    Insert the rows of DataFrame 'df' into SQLite 'table' with one
+    executemany call, mapping DataFrame columns to table columns by name.
+    'conflict' is the INSERT OR <conflict> clause (None for a plain INSERT).
+    Does not commit; callers wrap each batch in a transaction (with cn:).
+    Returns the number of rows inserted.
+    '''
+    if columns is None: columns = list(df.columns)
+    rows = frame_to_rows(df, columns)
+    if not rows: return 0
+
+    verb = f"INSERT OR {conflict}" if conflict else "INSERT"
+    placeholders = ', '.join('?' * len(columns))
+    cn.executemany(f"""{verb} INTO {table} ({', '.join(columns)})
+                       VALUES ({placeholders})""", rows)
+    return len(rows)
+
+def iso_date_sql(column):
+    ''' Return the SQLite expression of integer day 'column' as an ISO date '''
+    return f"date({column} * 86400, 'unixepoch')"
+
+def day_number_sql(column):
+    ''' Return the SQLite expression of ISO date 'column' as a day number '''
+    return f"CAST(julianday(substr({column}, 1, 10)) - 2440587.5 AS INTEGER)"
+
+def create_iso_view(cn, table, day_columns):
+    '''
+    (Re)create the view <table>_iso of local 'table', showing each integer
+    day column in 'day_columns' (dict of day column -> ISO column name) as an
+    ISO date under its ISO column name
+    '''
+    columns = [r[1] for r in cn.execute(f"PRAGMA table_info({table})")]
+    fields = ', '.join(f"{iso_date_sql(col)} AS {day_columns[col]}"
+                       if col in day_columns else col for col in columns)
+    cn.execute(f"DROP VIEW IF EXISTS {table}{iso_view_suffix}")
+    cn.execute(f"""CREATE VIEW {table}{iso_view_suffix}
+                   AS SELECT {fields} FROM {table}""")
+
+def create_local_table(cn, table, create_sql, day_columns, int_columns=()):
+    '''
+    Create local SQLite 'table' with 'create_sql' (CREATE TABLE IF NOT
+    EXISTS) and its ISO view. A table with the former schema (ISO date TEXT
+    columns named as in 'day_columns', TEXT 'int_columns') is migrated in
+    place in one transaction. Returns the former columns of a migrated table,
+    otherwise None.
+    '''
+    old_columns = [r[1] for r in cn.execute(f"PRAGMA table_info({table})")]
+    if not old_columns or set(day_columns) <= set(old_columns):
+        cn.execute(create_sql)
+        create_iso_view(cn, table, day_columns)
+        cn.commit()
+        return None
+
+    # Keep references to the table in other tables' schemas when renaming
+    cn.execute("PRAGMA legacy_alter_table = ON")
+    with cn:
+        cn.execute("BEGIN")
+        cn.execute(f"ALTER TABLE {table} RENAME TO {table}_old")
+        cn.execute(create_sql)
+        columns = [r[1] for r in cn.execute(f"PRAGMA table_info({table})")]
+        fields = []
+        for col in columns:
+            if col in day_columns:
+                fields.append(day_number_sql(day_columns[col]))
+            elif col in int_columns:
+                fields.append(f"CAST({col} AS INTEGER)")
+            elif col in old_columns:
+                fields.append(col)
+            else:
+                fields.append('NULL')
+        cn.execute(f"""INSERT OR REPLACE INTO {table} ({', '.join(columns)})
+                       SELECT {', '.join(fields)} FROM {table}_old""")
+        cn.execute(f"DROP TABLE {table}_old")
+        create_iso_view(cn, table, day_columns)
+    cn.execute("PRAGMA legacy_alter_table = OFF")
+    return old_columns
+
+def crosswalk_exists():
+    ''' Return True if the local identifier crosswalk has been built '''
+    return os.path.exists(path_crosswalk_db)
+
+def lookup_crosswalk(column, values, chunk_size=None):
+    '''
+    Return the crosswalk rows whose 'column' (e.g., permno, cusip9, isin,
+    dscode) is in 'values', from the local crosswalk database
+    '''
+    if chunk_size is None: chunk_size = resolve_chunk_size
+    values = list(dict.fromkeys(values))
+
+    cn = sqlite3.connect(path_crosswalk_db)
+    results = []
+    for i in range(0, len(values), chunk_size):
+        chunk = values[i:i + chunk_size]
+        placeholders = ', '.join('?' * len(chunk))
+        results.append(pd.read_sql_query(f"""
+                                         SELECT *
+                                         FROM {crosswalk_table}
+                                         WHERE {column} IN ({placeholders})
+                                         """, cn, params=chunk))
+    cn.close()
+
+    if not results: return pd.DataFrame()
+    return pd.concat(results, ignore_index=True)
+
+def get_ds_names_by_isin(db, isin):
+    '''
+    Return the Datastream name fields (ds_name_fields) of the securities with
+    ISIN 'isin', from the local crosswalk if built, otherwise from WRDS
+    '''
+    if crosswalk_exists() and not isinstance(db, LocalConnection):
+        rows = lookup_crosswalk('isin', [isin])
+        if rows.empty: return pd.DataFrame(columns=ds_name_fields)
+        return rows[ds_name_fields].dropna(subset=['dscode']) \
+                   .drop_duplicates().reset_index(drop=True)
+
     query = f"""
-            SELECT *
+            SELECT {', '.join(ds_name_fields)}
             FROM tr_ds_equities.wrds_ds_names
-            WHERE ibesticker = '@:{ticker}'
-            AND startdate <= '{start_date}'
-            AND enddate >= '{end_date}'
+            WHERE isin = :isin
             """
-    
-    return(db.raw_sql(query))
-    
+    return run_query(get_name_connection(db, 'tr_ds_equities'), query,
+                     {'isin': isin})
+
+# Name lookups by ticker as of a date range; tickers are bound parameters
+crsp_stockinfo_sql = '''
+    SELECT *
+    FROM crsp_q_stock.stocknames_v2
+    WHERE ticker {match}
+    AND namedt <= :start_date
+    AND nameenddt >= :end_date
+    '''
+
+ds_stockinfo_sql = '''
+    SELECT *
+    FROM tr_ds_equities.wrds_ds_names
+    WHERE ibesticker {match}
+    AND startdate <= :start_date
+    AND enddate >= :end_date
+    '''
+
+def get_crsp_stockinfo(db, ticker, start_date=None, end_date=None):
+    ''' Return the CRSP name records of 'ticker' spanning the date range '''
+    return run_query(get_name_connection(db),
+                     crsp_stockinfo_sql.format(match='= :ticker'),
+                     {'ticker': ticker, 'start_date': str(start_date),
+                      'end_date': str(end_date)})
+
+def get_crsp_stockinfo_many(db, tickers, start_date=None, end_date=None):
+    '''
+    Return the CRSP name records of many tickers spanning the date range,
+    with one query per chunk of tickers
+    '''
+    return run_query_chunked(get_name_connection(db),
+                             crsp_stockinfo_sql.format(
+                                 match='= ANY(:tickers)'),
+                             {'tickers': list(tickers),
+                              'start_date': str(start_date),
+                              'end_date': str(end_date)}, 'tickers')
+
+def get_ds_stockinfo(db, ticker, start_date=None, end_date=None):
+    ''' Return the Datastream name records of 'ticker' (I/B/E/S ticker) '''
+    return run_query(get_name_connection(db, 'tr_ds_equities'),
+                     ds_stockinfo_sql.format(match='= :ibesticker'),
+                     {'ibesticker': '@:' + ticker,
+                      'start_date': str(start_date),
+                      'end_date': str(end_date)})
+
+def get_ds_stockinfo_many(db, tickers, start_date=None, end_date=None):
+    '''
+    Return the Datastream name records of many tickers spanning the date
+    range, with one query per chunk of tickers
+    '''
+    return run_query_chunked(get_name_connection(db, 'tr_ds_equities'),
+                             ds_stockinfo_sql.format(
+                                 match='= ANY(:ibestickers)'),
+                             {'ibestickers': ['@:' + t for t in tickers],
+                              'start_date': str(start_date),
+                              'end_date': str(end_date)}, 'ibestickers')
+
 def get_stock_prices_from_ticker(db, ticker, start_date=None, end_date=None):
     # SAMPLE QUERY
     ''' r = db.raw_sql("SELECT date, cusip, prc 
@@ -103,7 +673,7 @@ def get_stock_prices_from_ticker(db, ticker, start_date=None, end_date=None):
 def main():    
 
     # Sample query for security metainfo and dscode
-    db = wrds.Connection(wrds_username=username)
+    db = connect_wrds()
     ticker = 'FB'
     start_date = '2022-01-01'
     end_date = '2022-01-31'
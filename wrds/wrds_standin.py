@@ -0,0 +1,364 @@
+'''
+Local stand-in for the WRDS database, for running and benchmarking the wrds/
+scripts offline (no credentials, no quota). A synthetic data generator writes
+SQLite files with the same schemas as the WRDS tables used in this project:
+
+- crsp_q_stock.db: stocknames_v2, dsf, dsi
+- tr_ds_equities.db: wrds_ds_names, wrds_ds2dsf
+
+StandinConnection attaches the files under the WRDS library names (like the
+local security master mirror in wrds_sql.py), so the scripts' SQL runs
+unchanged. It exposes a wrds.Connection-compatible raw_sql, sleeps a
+configurable latency before each query to mimic the round trip to WRDS, and
+counts queries and rows so the round-trip behaviour of a script can be
+measured.
+
+The generated universe holds 200 securities per unit of 'scale' with daily
+data on NYSE sessions. Some securities change ticker midway, some are
+delisted early, and every security has a consistent CUSIP9/ISIN pair and a
+Datastream dscode, so CRSP-Datastream links resolve as they do on WRDS.
+Daily returns load on a synthetic market index (dsi) with a random beta.
+
+Scripts connect through wrds_sql.connect_wrds, which returns a stand-in
+connection when the FIN_NLP_WRDS_STANDIN environment variable is set (to the
+stand-in directory, or to 1 for the default one).
+
+Running this file times the fetch patterns of crsp_performance_db.py and
+create_performance_db.py against the stand-in: one query per security against
+the batched multi-security queries, serially and on a QueryExecutor pool.
+
+Usage:
+    python wrds_standin.py                      # benchmark (generates once)
+    python wrds_standin.py --generate [scale]   # regenerate, then benchmark
+
+Author: Aaron M. Stahl (2024) // aaron.m.stahl@gmail.com // astahl3.github.io
+'''
+import os
+import random
+import sqlite3
+import string
+import sys
+import time
+from datetime import datetime, timedelta
+import pandas as pd
+import market_calendar as mc
+import wrds_sql as ws
+import wrds_executor as we
+
+# Stand-in location and generator parameters
+path_standin_dir = "/Users/astahl/fin_nlp_data/sqlite/wrds/standin"
+securities_per_scale = 200
+standin_start = '2012-01-01'
+standin_end = '2024-03-28'
+standin_seed = 1
+
+# Latency (seconds) added to each query by default
+standin_latency = 0.05
+
+# Benchmark settings: securities fetched, and window of each fetch (days)
+benchmark_securities = 100
+benchmark_window_days = 400
+
+# Table schemas, as on WRDS (subset of columns used in this project)
+standin_schemas = {
+    'crsp_q_stock': {
+        'stocknames_v2': '''permno INTEGER, permco INTEGER, namedt DATE,
+                            nameenddt DATE, cusip TEXT, cusip9 TEXT,
+                            ticker TEXT, issuernm TEXT, primaryexch TEXT,
+                            securitytype TEXT, securitysubtype TEXT,
+                            sharetype TEXT, securitybegdt DATE,
+                            securityenddt DATE, tradingstatusflg TEXT''',
+        'dsf': '''permno INTEGER, permco INTEGER, date DATE, cusip TEXT,
+                  hsiccd INTEGER, prc REAL, ret REAL, vol REAL,
+                  shrout REAL, numtrd REAL, cfacpr REAL, cfacshr REAL''',
+        'dsi': '''date DATE, vwretd REAL, vwretx REAL, ewretd REAL,
+                  ewretx REAL, sprtrn REAL, spindx REAL''',
+    },
+    'tr_ds_equities': {
+        'wrds_ds_names': '''dscode TEXT, isin TEXT, ismajorsec TEXT,
+                            dscmpyname TEXT, dsqtname TEXT, dssecname TEXT,
+                            primexchmnem TEXT, ticker TEXT, ibesticker TEXT,
+                            startdate DATE, enddate DATE, delistdate DATE,
+                            cmpyctrycode TEXT''',
+        'wrds_ds2dsf': '''dscode TEXT, marketdate DATE, ri REAL,
+                          ri_usd REAL, close REAL, currency TEXT,
+                          mktcap REAL, mktcap_usd REAL, region TEXT''',
+    },
+}
+
+# Indexes, as the WRDS tables are indexed on their identifier columns
+standin_indexes = {
+    'crsp_q_stock': [('stocknames_v2', 'ticker, namedt'),
+                     ('stocknames_v2', 'permno'),
+                     ('stocknames_v2', 'cusip9'),
+                     ('dsf', 'permno, date'),
+                     ('dsi', 'date')],
+    'tr_ds_equities': [('wrds_ds_names', 'isin'),
+                       ('wrds_ds_names', 'ibesticker'),
+                       ('wrds_ds_names', 'dscode'),
+                       ('wrds_ds2dsf', 'dscode, marketdate'),
+                       ('wrds_ds2dsf', 'marketdate')],
+}
+
+class StandinConnection(ws.LocalConnection):
+    '''
+    wrds.Connection-compatible connection to the stand-in files, with
+    'latency' seconds added to every query and query/row counters
+    '''
+    def __init__(self, path_dir=None, latency=None):
+        if path_dir is None: path_dir = path_standin_dir
+        super().__init__(path_dir, list(standin_schemas))
+        self.latency = latency if latency is not None else standin_latency
+        self.n_queries = 0
+        self.n_rows = 0
+
+    def raw_sql(self, sql, params=None, **kwargs):
+        time.sleep(self.latency)
+        result = super().raw_sql(sql, params=params, **kwargs)
+        self.n_queries += 1
+        if not isinstance(result, pd.DataFrame):
+            return self.count_rows(result)
+        self.n_rows += len(result)
+        return result
+
+    def count_rows(self, chunks):
+        ''' Count the rows of a streamed result as its chunks are consumed '''
+        for chunk in chunks:
+            self.n_rows += len(chunk)
+            yield chunk
+
+    def stats(self):
+        ''' Return the number of queries run and rows returned '''
+        return {'n_queries': self.n_queries, 'n_rows': self.n_rows}
+
+def connect_standin(path_dir=None, latency=None):
+    ''' Return a StandinConnection, generating the stand-in if missing '''
+    if path_dir is None: path_dir = path_standin_dir
+    if not all(os.path.exists(ws.mirror_path(library, path_dir))
+               for library in standin_schemas):
+        generate_standin(path_dir)
+    return StandinConnection(path_dir, latency)
+
+def random_ticker(rng, used):
+    ''' Return a new random ticker of 2-4 letters not in 'used' '''
+    while True:
+        ticker = ''.join(rng.choice(string.ascii_uppercase)
+                         for _ in range(rng.randint(2, 4)))
+        if ticker not in used:
+            used.add(ticker)
+            return ticker
+
+def generate_securities(rng, n_securities, sessions):
+    '''
+    Return a list of synthetic securities, each a dict of identifiers, name
+    periods (start, end, ticker), and first/last session index
+    '''
+    used = set()
+    securities = []
+    for i in range(n_securities):
+        # Listing period: most securities span the whole range
+        first = 0 if rng.random() < 0.8 else rng.randrange(len(sessions) // 2)
+        last = len(sessions) - 1 if rng.random() < 0.85 else \
+               rng.randrange(first + 250, len(sessions) + 250)
+        last = min(last, len(sessions) - 1)
+
+        # Ticker history: some securities change ticker once
+        names = [(first, last, random_ticker(rng, used))]
+        if rng.random() < 0.1 and last - first > 500:
+            change = rng.randrange(first + 250, last - 250)
+            names = [(first, change - 1, names[0][2]),
+                     (change, last, random_ticker(rng, used))]
+
+        cusip = f'{rng.randrange(16 ** 6):06X}10'
+        cusip9 = ws.cusip_to_cusip9(cusip)
+        securities.append({'permno': 10000 + i,
+                           'permco': 50000 + i,
+                           'cusip': cusip,
+                           'cusip9': cusip9,
+                           'isin': ws.cusip9_to_isin(cusip9),
+                           'dscode': f'9{i:05X}',
+                           'hsiccd': rng.choice([2834, 3571, 3674, 6022,
+                                                 7372]),
+                           'issuernm': f'SYNTHETIC COMPANY {i} INC',
+                           'first': first,
+                           'last': last,
+                           'names': names})
+    return securities
+
+def generate_standin(path_dir=None, scale=1.0, seed=None):
+    '''
+    Generate the stand-in SQLite files in 'path_dir' with
+    securities_per_scale * scale securities
+    '''
+    if path_dir is None: path_dir = path_standin_dir
+    if seed is None: seed = standin_seed
+    rng = random.Random(seed)
+    os.makedirs(path_dir, exist_ok=True)
+
+    sessions = [str(d) for d in mc.load_sessions()
+                if standin_start <= str(d) <= standin_end]
+    n_securities = max(1, int(securities_per_scale * scale))
+    securities = generate_securities(rng, n_securities, sessions)
+
+    # Create the tables in fresh files
+    cns = {}
+    for library, tables in standin_schemas.items():
+        path_db = ws.mirror_path(library, path_dir)
+        if os.path.exists(path_db): os.remove(path_db)
+        cns[library] = sqlite3.connect(path_db)
+        for table, columns in tables.items():
+            cns[library].execute(f"CREATE TABLE {table} ({columns})")
+    crsp, ds = cns['crsp_q_stock'], cns['tr_ds_equities']
+
+    # Market index: a random walk that security returns load on
+    market = [rng.gauss(0.0003, 0.01) for _ in sessions]
+    spindx = 1250.0
+    dsi_rows = []
+    for date, ret in zip(sessions, market):
+        spindx *= 1 + ret - 0.00008
+        dsi_rows.append((date, ret, ret - 0.00008, ret + rng.gauss(0, 0.002),
+                         ret - 0.00008, ret - 0.00008, spindx))
+    crsp.executemany("INSERT INTO dsi VALUES (?, ?, ?, ?, ?, ?, ?)",
+                     dsi_rows)
+
+    for sec in securities:
+        end_date = sessions[sec['last']]
+        delisted = sec['last'] < len(sessions) - 1
+        crsp_end = end_date if delisted else '9999-12-31'
+
+        # Name tables
+        for start, end, ticker in sec['names']:
+            name_end = sessions[end] if end < sec['last'] else crsp_end
+            crsp.execute("INSERT INTO stocknames_v2 VALUES "
+                         "(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                         (sec['permno'], sec['permco'], sessions[start],
+                          name_end, sec['cusip'], sec['cusip9'], ticker,
+                          sec['issuernm'], 'Q', 'EQTY', 'COM', 'NS',
+                          sessions[sec['first']], crsp_end,
+                          'D' if delisted else 'A'))
+            ds.execute("INSERT INTO wrds_ds_names VALUES "
+                       "(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                       (sec['dscode'], sec['isin'], 'Y', sec['issuernm'],
+                        ticker, sec['issuernm'], 'NAS', ticker,
+                        '@:' + ticker, sessions[start], name_end,
+                        end_date if delisted else None, 'US'))
+
+        # Daily files: a random walk in price with a constant share count
+        beta = rng.uniform(0.5, 1.5)
+        prc = rng.uniform(5, 200)
+        ri = 100.0
+        shrout = rng.uniform(1e4, 1e7)
+        crsp_rows = []
+        ds_rows = []
+        for k in range(sec['first'], sec['last'] + 1):
+            ret = beta * market[k] + rng.gauss(0.0, 0.015)
+            if k > sec['first']:
+                prc *= 1 + ret
+                ri *= 1 + ret
+            vol = rng.uniform(1e4, 1e6)
+            mktcap = prc * shrout * 1000
+            crsp_rows.append((sec['permno'], sec['permco'], sessions[k],
+                              sec['cusip'], sec['hsiccd'], prc,
+                              ret if k > sec['first'] else None, vol,
+                              shrout, vol / 100, 1.0, 1.0))
+            ds_rows.append((sec['dscode'], sessions[k], ri, ri, prc, 'USD',
+                            mktcap, mktcap, 'US'))
+        crsp.executemany("INSERT INTO dsf VALUES "
+                         "(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", crsp_rows)
+        ds.executemany("INSERT INTO wrds_ds2dsf VALUES "
+                       "(?, ?, ?, ?, ?, ?, ?, ?, ?)", ds_rows)
+
+    for library, indexes in standin_indexes.items():
+        for table, columns in indexes:
+            name = f"idx_{table}_{columns.replace(', ', '_')}"
+            cns[library].execute(f"CREATE INDEX {name} ON {table} ({columns})")
+        cns[library].commit()
+        cns[library].close()
+
+    return securities
+
+def timed(conn, fetch):
+    ''' Run 'fetch' and return (seconds, queries, rows) on 'conn' '''
+    before = conn.stats()
+    t0 = time.perf_counter()
+    fetch()
+    seconds = time.perf_counter() - t0
+    after = conn.stats()
+    return (seconds, after['n_queries'] - before['n_queries'],
+            after['n_rows'] - before['n_rows'])
+
+def benchmark(path_dir=None, latency=None, n_securities=None):
+    '''
+    Time per-security against batched fetches of CRSP daily returns and
+    Datastream return indices on the stand-in; returns a dict of label ->
+    (seconds, queries, rows)
+    '''
+    import crsp_performance_db as cpd
+
+    if n_securities is None: n_securities = benchmark_securities
+    conn = connect_standin(path_dir, latency)
+
+    # Random post windows on securities listed in the stand-in
+    crsp_names = conn.raw_sql("""SELECT DISTINCT permno, cusip9
+                                 FROM crsp_q_stock.stocknames_v2""")
+    crsp_names['isin'] = ws.cusip9s_to_isins(crsp_names['cusip9'])
+    names = crsp_names.merge(conn.raw_sql("""
+                                          SELECT DISTINCT dscode, isin
+                                          FROM tr_ds_equities.wrds_ds_names
+                                          """), on='isin')
+    lad = datetime.strptime(conn.raw_sql(
+        "SELECT MAX(date) AS lad FROM crsp_q_stock.dsi")['lad'].iloc[0],
+        '%Y-%m-%d').date()
+    rng = random.Random(standin_seed)
+    sample = names.sample(min(n_securities, len(names)),
+                          random_state=standin_seed)
+    crsp_ranges = []
+    ds_ranges = []
+    for permno, dscode in zip(sample['permno'], sample['dscode']):
+        start = lad - timedelta(days=rng.randrange(benchmark_window_days,
+                                                   3000))
+        end = start + timedelta(days=benchmark_window_days)
+        crsp_ranges.append((int(permno), start, end))
+        ds_ranges.append((dscode, start, end))
+
+    batches = [crsp_ranges[i:i + cpd.fetch_batch_size]
+               for i in range(0, len(crsp_ranges), cpd.fetch_batch_size)]
+    executor = we.QueryExecutor(lambda: StandinConnection(path_dir, latency))
+
+    results = {}
+    results['crsp per permno'] = timed(conn, lambda: [
+        ws.run_query(conn, *cpd.returns_batch_query([r]))
+        for r in crsp_ranges])
+    results['crsp batched'] = timed(conn, lambda: [
+        ws.run_query(conn, *cpd.returns_batch_query(batch))
+        for batch in batches])
+    t0 = time.perf_counter()
+    executor.map([cpd.returns_batch_query([r]) for r in crsp_ranges])
+    results['crsp per permno, pooled'] = (time.perf_counter() - t0,
+                                          len(crsp_ranges), None)
+    results['ds per dscode'] = timed(conn, lambda: [
+        ws.get_ds_return_indices(conn, [r]) for r in ds_ranges])
+    results['ds batched'] = timed(conn, lambda: ws.get_ds_return_indices(
+        conn, ds_ranges))
+
+    executor.close()
+    conn.close()
+    return results
+
+def main():
+
+    if '--generate' in sys.argv[1:]:
+        args = [a for a in sys.argv[1:] if a != '--generate']
+        scale = float(args[0]) if args else 1.0
+        securities = generate_standin(scale=scale)
+        print(f"Generated {len(securities)} securities in "
+              f"{path_standin_dir}")
+
+    results = benchmark()
+    print(f"{benchmark_securities} securities at {standin_latency}s latency")
+    for label, (seconds, n_queries, n_rows) in results.items():
+        rows = f", {n_rows} rows" if n_rows is not None else ''
+        print(f"{label}: {seconds:.2f}s, {n_queries} queries{rows}")
+
+if __name__ == "__main__":
+    main()